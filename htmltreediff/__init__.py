@@ -27,9 +27,17 @@ Text Diff Usage
 ... ])
 >>> html_diff == expected
 True
+
+Budget Usage
+>>> from htmltreediff import Budget
+>>> budget = Budget(seconds=10)
+>>> html_diff = diff('<p>one two</p>', '<p>one three</p>', budget=budget)
+>>> budget.degraded
+False
 """
 
+from htmltreediff.diff_core import Budget
 from htmltreediff.html import diff
 from htmltreediff.util import html_equal
 
-__all__ = ['diff', 'html_equal']
+__all__ = ['Budget', 'diff', 'html_equal']
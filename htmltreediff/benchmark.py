@@ -0,0 +1,301 @@
+"""
+Timing benchmarks for the parts of the diff that dominate on large documents.
+
+Run them from the command line, optionally giving the names of the benchmarks
+to run:
+
+    $ python -m htmltreediff.benchmark matchers
+"""
+import random
+import sys
+import time
+
+from htmltreediff.diff_core import Differ, match_blocks, match_node_hash
+from htmltreediff.matchers import matchers
+from htmltreediff.text import _word_split_regexes, multi_split, split_text
+from htmltreediff.util import (
+    NodeIndex,
+    SimilarityCascade,
+    approximate_text_similarity,
+    parse_minidom,
+    text_similarity,
+)
+
+_words = (
+    'alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu '
+    'policy section shall the of and'
+).split()
+
+
+def _paragraph(rand, length=12):
+    return '<p>%s</p>' % ' '.join(rand.choice(_words) for _ in range(length))
+
+
+def wide_documents(width, edits, seed=0):
+    """
+    Return the html of two documents with `width` sibling paragraphs, where
+    the new document has `edits` paragraphs changed, inserted or deleted.
+    """
+    rand = random.Random(seed)
+    old = [_paragraph(rand) for _ in range(width)]
+    new = list(old)
+    for _ in range(edits):
+        i = rand.randrange(len(new))
+        action = rand.choice(['change', 'insert', 'delete'])
+        if action == 'change':
+            new[i] = _paragraph(rand)
+        elif action == 'insert':
+            new.insert(i, _paragraph(rand))
+        else:
+            del new[i]
+    return ''.join(old), ''.join(new)
+
+
+def _best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark_matchers(widths=(500, 2000, 8000), edits=20, repeat=3):
+    """
+    Time each matcher on the body children of wide documents. Yield tuples of
+    (width, matcher name, seconds, number of matched children).
+    """
+    for width in widths:
+        old_html, new_html = wide_documents(width, edits)
+        index = NodeIndex()
+        old_children = index.children(index.add(parse_minidom(old_html)))
+        new_children = index.children(index.add(parse_minidom(new_html)))
+        for name in sorted(matchers):
+            def run():
+                return match_blocks(
+                    match_node_hash,
+                    old_children,
+                    new_children,
+                    index,
+                    name,
+                )
+            seconds, blocks = _best_time(run, repeat)
+            matched = sum(size for _, _, size in blocks)
+            yield width, name, seconds, matched
+
+
+def edited_tables(rows, edited, seed=0):
+    """
+    Return the html of two tables with `rows` rows, where a run of `edited`
+    rows in the middle has been rewritten, so that it becomes one gap of
+    rows that aren't similar to each other.
+    """
+    rand = random.Random(seed)
+    vocabulary = ['w%d' % i for i in range(10 * rows)]
+
+    def row():
+        return '<tr><td>%s</td></tr>' % ' '.join(
+            rand.choice(vocabulary) for _ in range(12))
+    old = [row() for _ in range(rows)]
+    new = list(old)
+    start = (rows - edited) // 2
+    for i in range(start, start + edited):
+        new[i] = row()
+    return (
+        '<table>%s</table>' % ''.join(old),
+        '<table>%s</table>' % ''.join(new),
+    )
+
+
+def repetitive_tables(rows, seed=0):
+    """
+    Return the html of two tables with `rows` rows of 20 words, where the
+    words of each table cycle through the same 120 words, with a different
+    tenth of them swapped for others. Comparing the text of the tables takes
+    difflib time quadratic in their length.
+    """
+    rand = random.Random(seed)
+
+    def table():
+        words = [
+            'w%d' % (i % 120 if rand.random() > 0.1 else rand.randrange(120))
+            for i in range(20 * rows)
+        ]
+        return '<table>%s</table>' % ''.join(
+            '<tr><td>%s</td></tr>' % ' '.join(words[i:i + 20])
+            for i in range(0, len(words), 20)
+        )
+    return table(), table()
+
+
+def benchmark_fuzzy(sizes=(100, 300), repeat=3):
+    """
+    Time the edit script for tables with a gap of edited rows, where fuzzy
+    matching compares the rows pairwise. Yield tuples of (rows, edited rows,
+    seconds, length of the edit script, similarity memo hits and misses).
+    """
+    for rows in sizes:
+        edited = rows // 6
+        old_html, new_html = edited_tables(rows * 2, edited)
+        old_dom = parse_minidom(old_html)
+        new_dom = parse_minidom(new_html)
+
+        def run():
+            differ = Differ(old_dom, new_dom)
+            return differ, differ.get_edit_script()
+        seconds, (differ, edit_script) = _best_time(run, repeat)
+        yield (
+            rows * 2,
+            edited,
+            seconds,
+            len(edit_script),
+            differ.memo.hits,
+            differ.memo.misses,
+        )
+
+
+def benchmark_bounds(sizes=(50, 200), repeat=3):
+    """
+    Compare every pair of paragraphs from two lists, where half of the new
+    paragraphs are edits of old ones, with the similarity cascade and with
+    text_similarity alone. Yield tuples of (pairs, text_similarity seconds,
+    cascade seconds, pairs rejected by length, bitset, multiset and exact
+    comparison, similar pairs).
+    """
+    for size in sizes:
+        rand = random.Random(0)
+        vocabulary = ['w%d' % i for i in range(10 * size)]
+
+        def paragraph():
+            return [
+                rand.choice(vocabulary)
+                for _ in range(rand.randint(1, 30))
+            ]
+        old = [paragraph() for _ in range(size)]
+        new = [paragraph() for _ in range(size // 2)]
+        for original in rand.sample(old, size - len(new)):
+            edited = list(original)
+            edited[rand.randrange(len(edited))] = rand.choice(vocabulary)
+            new.append(edited)
+        index = NodeIndex()
+        nodes = [
+            index.add(parse_minidom('<p>%s</p>' % ' '.join(words)))
+            for words in old + new
+        ]
+        pairs = [(a, b) for a in nodes[:size] for b in nodes[size:]]
+
+        def exact():
+            return [text_similarity(a, b, index) >= 0.4 for a, b in pairs]
+
+        def cascade():
+            cascade = SimilarityCascade(index)
+            for a, b in pairs:
+                cascade.similar(a, b, 0.4)
+            return cascade
+        exact_seconds, _ = _best_time(exact, repeat)
+        cascade_seconds, cascade = _best_time(cascade, repeat)
+        yield (len(pairs), exact_seconds, cascade_seconds) + tuple(
+            cascade.rejected[stage] for stage in cascade.stages
+        ) + (cascade.accepted,)
+
+
+def benchmark_tokenize(sizes=(1000, 10000, 100000), repeat=3):
+    """
+    Time split_text against splitting by each word split regex in turn, on
+    a single long passage of text. Yield tuples of (characters, tokens,
+    multi_split seconds, split_text seconds).
+    """
+    rand = random.Random(0)
+    words = _words + ["don't", '1-800-555-1234', '1/2/2003', '&amp;', '42,']
+    for size in sizes:
+        text = ''
+        while len(text) < size:
+            text += rand.choice(words) + rand.choice([' ', ' ', '. ', '\n'])
+        old_seconds, tokens = _best_time(
+            lambda: multi_split(text, _word_split_regexes),
+            repeat,
+        )
+        new_seconds, _ = _best_time(lambda: split_text(text), repeat)
+        yield len(text), len(tokens), old_seconds, new_seconds
+
+
+def benchmark_ratio(widths=(10, 100, 1000), edits=5, repeat=3):
+    """
+    Time the text similarity of two wide documents with each text ratio
+    backend. Yield tuples of (width, words, backend, seconds, ratio).
+    """
+    for width in widths:
+        old_html, new_html = wide_documents(width, edits)
+        index = NodeIndex()
+        old_root = index.add(parse_minidom(old_html))
+        new_root = index.add(parse_minidom(new_html))
+        words = len(index.words(old_root)[0])
+        for backend in ['difflib', 'lcs']:
+            seconds, ratio = _best_time(
+                lambda: text_similarity(old_root, new_root, index, backend),
+                repeat,
+            )
+            yield width, words, backend, seconds, ratio
+
+
+def benchmark_approximate(widths=(100, 1000, 5000), edits=50, repeat=3):
+    """
+    Time the text similarity of two wide documents, with their small
+    vocabulary of often repeated words, against its estimate from sketches.
+    Yield tuples of (width, words, text_similarity seconds, approximate
+    seconds, ratio, estimate).
+    """
+    for width in widths:
+        old_html, new_html = wide_documents(width, edits)
+        index = NodeIndex()
+        old_root = index.add(parse_minidom(old_html))
+        new_root = index.add(parse_minidom(new_html))
+        words = len(index.words(old_root)[0])
+        index.words(new_root)
+        exact_seconds, ratio = _best_time(
+            lambda: text_similarity(old_root, new_root, index),
+            repeat,
+        )
+
+        def approximate():
+            index.sketches.clear()
+            return approximate_text_similarity(old_root, new_root, index)
+        approximate_seconds, estimate = _best_time(approximate, repeat)
+        yield (
+            width,
+            words,
+            exact_seconds,
+            approximate_seconds,
+            ratio,
+            estimate,
+        )
+
+
+benchmarks = {
+    'approximate': benchmark_approximate,
+    'bounds': benchmark_bounds,
+    'fuzzy': benchmark_fuzzy,
+    'matchers': benchmark_matchers,
+    'ratio': benchmark_ratio,
+    'tokenize': benchmark_tokenize,
+}
+
+
+def main(argv=None, out=None, **options):
+    if argv is None:
+        argv = sys.argv  # pragma: no cover
+    if out is None:
+        out = sys.stdout  # pragma: no cover
+    names = argv[1:] or sorted(benchmarks)
+    for name in names:
+        out.write('%s\n' % name)
+        for row in benchmarks[name](**options):
+            out.write('  %s\n' % '\t'.join(
+                '%.4f' % value if isinstance(value, float) else str(value)
+                for value in row
+            ))
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
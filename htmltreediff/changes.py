@@ -1,129 +1,316 @@
-from htmltreediff.text import split_text
+from bisect import bisect_right
+
 from htmltreediff.util import (
-    ancestors,
-    insert_or_append,
-    is_element,
+    NodeIndex,
+    as_tree,
     is_text,
-    node_compare,
     remove_node,
+    split_node,
     unwrap,
     walk_dom,
-    wrap,
-    wrap_inner,
 )
-from htmltreediff.diff_core import Differ
-from htmltreediff.edit_script_runner import EditScriptRunner
+from htmltreediff.diff_core import Differ, get_opcodes
 
 
 def split_text_nodes(dom):
+    """
+    Split every text node in the dom into one text node per word, in place.
+
+    Edit script locations count text nodes split this way. The diff itself
+    never splits a dom like this: diff_index reads the text as if it were
+    split, and the runners split only the text that the changes reach. Split
+    a dom with this to run an edit script on it without split_text, or to
+    check the locations of a script against it.
+    """
     for text_node in list(walk_dom(dom)):
         if not is_text(text_node):
             continue
         split_node(text_node)
 
 
-def split_node(node):
-    # Split text node in into user-friendly chunks.
-    pieces = split_text(node.nodeValue)
-    if len(pieces) <= 1:
-        return
-    parent = node.parentNode
-    for piece in pieces:
-        piece_node = node.ownerDocument.createTextNode(piece)
-        parent.insertBefore(piece_node, node)
-    remove_node(node)
+def diff_index():
+    """
+    Return an empty NodeIndex that reads documents as if all their text nodes
+    were split into words, leaving the documents themselves alone.
+    """
+    return NodeIndex(split_text=True)
+
 
+def dom_diff(old_dom, new_dom, matcher=None):
+    index = diff_index()
+    old_root = index.add(old_dom)
+    new_root = index.add(new_dom)
+    return indexed_dom_diff(old_dom, old_root, new_root, index, matcher)
 
-def dom_diff(old_dom, new_dom):
-    # Split all the text nodes in the old and new dom.
-    split_text_nodes(old_dom)
-    split_text_nodes(new_dom)
 
-    # Get the edit script from the diff algorithm
-    differ = Differ(old_dom, new_dom)
-    edit_script = differ.get_edit_script()
-    # Run the edit script, then use the inserted and deleted nodes metadata to
-    #     show changes.
-    runner = EditScriptRunner(old_dom, edit_script)
-    dom = runner.run_edit_script()
-    add_changes_markup(dom, runner.ins_nodes, runner.del_nodes)
-    return dom
+def indexed_dom_diff(old_dom, old_root, new_root, index, matcher=None,
+                     budget=None, backend='difflib'):
+    """
+    Like dom_diff, for documents that are already in a diff_index, given by
+    their root ids. The old dom gets the changes markup; it can be a minidom
+    document, or a util.Tree over the old document. The new document is only
+    read through the index, so it doesn't have to be kept around.
+
+    The work is bounded by the budget, if one is given, and text is compared
+    with the given WordMatcher backend.
+    """
+    differ = MarkupDiffer(
+        as_tree(old_dom),
+        old_root,
+        new_root,
+        index,
+        matcher,
+        budget,
+        backend,
+    )
+    differ.get_changes()
+    return old_dom
+
+
+class MarkupDiffer(Differ):
+    """
+    A Differ that makes its changes to the old tree as it goes, and then marks
+    them up, instead of writing an edit script for EditScriptRunner to run.
+
+    The changes are the ones that running the edit script would make, but
+    whole subtrees at a time. A deleted subtree is taken out as it is, and an
+    inserted one is built in one go, so that only its root needs a <del> or
+    <ins>, and no node is looked up by its location.
+    """
+    def __init__(self, tree, old_root, new_root, index, matcher=None,
+                 budget=None, backend='difflib'):
+        Differ.__init__(
+            self,
+            old_root,
+            new_root,
+            index,
+            matcher,
+            budget,
+            backend,
+        )
+        self.tree = tree
+        # The tree nodes of the old nodes that are waiting to be diffed.
+        self.tree_nodes = {old_root: tree.root}
+        self.parent = None
+        # The children of the parent, as they are being edited.
+        self.children = None
+        self.ins_nodes = []
+        self.del_nodes = []
+
+    def get_changes(self):
+        """Return the old tree, with <ins> and <del> markup for the changes."""
+        self.run()
+        add_changes_markup(self.tree, self.ins_nodes, self.del_nodes)
+        return self.tree
+
+    def diff_location(self, old_node, new_node, old_location, new_location):
+        if self.index.text_value(old_node) is not None:
+            # Text has no children to diff.
+            return []
+        parent = self.parent = self.tree_nodes.pop(old_node)
+        self.line_up_children(parent, old_node)
+        matches = Differ.diff_location(
+            self,
+            old_node,
+            new_node,
+            old_location,
+            new_location,
+        )
+        for old_child, _, location, _ in matches:
+            if self.index.text_value(old_child) is None:
+                self.tree_nodes[old_child] = self.children[location[-1]]
+        return matches
+
+    def line_up_children(self, parent, node):
+        """
+        Line up the children of the parent with the children of the node in
+        the index, where each text node can be several pieces. A text child
+        stands for its first piece, and the rest are None, until it is split
+        by split_edited.
+        """
+        tree = self.tree
+        index = self.index
+        pieces = iter(index.children(node))
+        self.children = []
+        self.texts = {}  # child index of a text child -> its pieces
+        for child in tree.child_nodes(parent):
+            self.children.append(child)
+            text = tree.text(child)
+            if text is None:
+                next(pieces)
+                continue
+            # Take pieces until they add up to the text. Empty text has one
+            # empty piece.
+            texts = [index.text_value(next(pieces))]
+            length = len(texts[0])
+            while length < len(text):
+                texts.append(index.text_value(next(pieces)))
+                length += len(texts[-1])
+            if len(texts) > 1:
+                self.texts[len(self.children) - 1] = texts
+                self.children.extend([None] * (len(texts) - 1))
+
+    def match_children(self, old_children, new_children):
+        matching_blocks, recursion_indices = Differ.match_children(
+            self,
+            old_children,
+            new_children,
+        )
+        if self.texts:
+            self.split_edited(get_opcodes(matching_blocks))
+        return matching_blocks, recursion_indices
+
+    def split_edited(self, opcodes):
+        """
+        Split the text children that the edits delete from or insert into
+        into their pieces, before any of the edits are made. Text children
+        that are left alone stay whole.
+        """
+        starts = sorted(self.texts)
+        edited = set()
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                continue
+            # Deletes take children i1 to i2, and inserts go before child i2,
+            # which only needs splitting if it is a later piece of a text
+            # child.
+            position = max(bisect_right(starts, i1) - 1, 0)
+            while position < len(starts) and starts[position] < i2:
+                start = starts[position]
+                if start + len(self.texts[start]) > i1:
+                    edited.add(start)
+                position += 1
+        for start in edited:
+            texts = self.texts[start]
+            self.children[start:start + len(texts)] = self.tree.split_text(
+                self.children[start],
+                texts,
+            )
+
+    def next_child(self, child_index):
+        if child_index < len(self.children):
+            return self.children[child_index]
+        return None
+
+    def delete(self, location, node):
+        child_index = location[-1]
+        node = self.children.pop(child_index)
+        next_sibling = self.next_child(child_index)
+        self.tree.remove(node)
+        self.del_nodes.append((node, self.parent, next_sibling))
+
+    def insert(self, location, node):
+        node = self.build(node)
+        if node is not None:
+            child_index = location[-1]
+            next_sibling = self.next_child(child_index)
+            self.tree.insert_before(self.parent, node, next_sibling)
+            self.children.insert(child_index, node)
+            self.ins_nodes.append(node)
+
+    def build(self, node):
+        """Create the subtree of a node in the index, in the old tree."""
+        tree = self.tree
+        root = tree.create_node(**self.node_properties(node))
+        stack = [(root, node)]
+        while stack:
+            tree_node, node = stack.pop()
+            if tree_node is None:
+                continue
+            for child in self.index.children(node):
+                tree_child = tree.create_node(**self.node_properties(child))
+                if tree_child is not None:
+                    tree.append_child(tree_node, tree_child)
+                stack.append((tree_child, child))
+        return root
 
 
 def add_changes_markup(dom, ins_nodes, del_nodes):
     """
-    Add <ins> and <del> tags to the dom to show changes.
+    Add <ins> and <del> tags to the dom to show changes. The dom can be a
+    minidom document or a util.Tree. The deleted nodes are given as (node,
+    parent, next sibling), with the place they were deleted from.
     """
+    tree = as_tree(dom)
     # add markup for inserted and deleted sections
-    for node in reversed(del_nodes):
+    for node, parent, next_sibling in reversed(del_nodes):
         # diff algorithm deletes nodes in reverse order, so un-reverse the
         # order for this iteration
-        insert_or_append(node.orig_parent, node, node.orig_next_sibling)
-        wrap(node, 'del')
+        tree.insert_before(parent, node, next_sibling)
+        tree.wrap(node, 'del')
     for node in ins_nodes:
-        wrap(node, 'ins')
+        tree.wrap(node, 'ins')
     # Perform post-processing and cleanup.
-    remove_nesting(dom, 'del')
-    remove_nesting(dom, 'ins')
-    sort_del_before_ins(dom)
-    merge_adjacent(dom, 'del')
-    merge_adjacent(dom, 'ins')
+    remove_nesting(tree, 'del')
+    remove_nesting(tree, 'ins')
+    sort_del_before_ins(tree)
+    merge_adjacent(tree, 'del')
+    merge_adjacent(tree, 'ins')
 
 
 def remove_nesting(dom, tag_name):
     """
     Unwrap items in the node list that have ancestors with the same tag.
     """
-    for node in dom.getElementsByTagName(tag_name):
-        for ancestor in ancestors(node):
-            if ancestor is node:
-                continue
-            if ancestor is dom.documentElement:
-                break
-            if ancestor.tagName == tag_name:
-                unwrap(node)
+    tree = as_tree(dom)
+    for node in tree.elements_by_tag_name(tag_name):
+        ancestor = tree.parent(node)
+        while ancestor is not None:
+            if tree.tag_name(ancestor) == tag_name:
+                tree.unwrap(node)
                 break
+            ancestor = tree.parent(ancestor)
 
 
-def sort_nodes(dom, cmp_func):
+def sort_del_before_ins(dom):
     """
-    Sort the nodes of the dom in-place, based on a comparison function.
+    Move each <del> before the <ins> tags right before it.
     """
-    dom.normalize()
-    for node in list(walk_dom(dom, elements_only=True)):
-        prev_sib = node.previousSibling
-        while prev_sib and cmp_func(prev_sib, node) == 1:
-            node.parentNode.insertBefore(node, prev_sib)
-            prev_sib = node.previousSibling
-
-
-def sort_del_before_ins(dom):
-    sort_nodes(dom, cmp_func=node_compare)
+    tree = as_tree(dom)
+    tree.normalize()
+    run_starts = {}  # last <ins> of a run -> first <ins> of the run
+    for node in tree.elements_by_tag_name('del'):
+        # Find the sibling that the node goes before, and move it there in
+        # one step, since each move may be linear in the number of siblings.
+        # Each <del> after a run of <ins> tags goes before the same one, so
+        # the run is only walked once.
+        last = tree.previous_sibling(node)
+        target = run_starts.get(last)
+        if target is None:
+            prev_sib = last
+            while prev_sib is not None and tree.tag_name(prev_sib) == 'ins':
+                target = prev_sib
+                prev_sib = tree.previous_sibling(prev_sib)
+            run_starts[last] = target
+        if target is not None:
+            tree.insert_before(tree.parent(node), node, target)
 
 
 def merge_adjacent(dom, tag_name):
     """
     Merge all adjacent tags with the specified tag name.
-    Return the number of merges performed.
     """
-    for node in dom.getElementsByTagName(tag_name):
-        prev_sib = node.previousSibling
-        if prev_sib and prev_sib.nodeName == node.tagName:
-            for child in list(node.childNodes):
-                prev_sib.appendChild(child)
-            remove_node(node)
+    tree = as_tree(dom)
+    for node in tree.elements_by_tag_name(tag_name):
+        prev_sib = tree.previous_sibling(node)
+        if prev_sib is not None and tree.tag_name(prev_sib) == tag_name:
+            for child in list(tree.child_nodes(node)):
+                tree.append_child(prev_sib, child)
+            tree.remove(node)
 
 
-def distribute(node):
+def distribute(node, dom=None):
     """
     Wrap a copy of the given element around the contents of each of its
-    children, removing the node in the process.
+    children, removing the node in the process. The node is in the given
+    util.Tree, or in a minidom document if none is given.
     """
-    children = list(c for c in node.childNodes if is_element(c))
-    unwrap(node)
-    tag_name = node.tagName
+    tree = as_tree(node.ownerDocument if dom is None else dom)
+    children = [c for c in tree.child_nodes(node) if tree.is_element(c)]
+    tree.unwrap(node)
+    tag_name = tree.tag_name(node)
     for c in children:
-        wrap_inner(c, tag_name)
+        tree.wrap_inner(c, tag_name)
 
 
 def _strip_changes_new(node):
@@ -1,40 +1,170 @@
 import difflib
+import time
 from xml.dom import Node
 
-from htmltreediff.text import is_text_junk
+from htmltreediff.matchers import difflib_blocks, get_matcher, unique_anchors
 from htmltreediff.util import (
-    copy_dom,
     HashableTree,
     FuzzyHashableTree,
-    is_text,
-    get_child,
-    get_location,
-    remove_node,
-    insert_or_append,
-    attribute_dict,
-    walk_dom,
+    NodeIndex,
+    SimilarityMemo,
 )
 
 
-def match_node_hash(node):
-    if is_text(node):
-        return node.nodeValue
-    return HashableTree(node)
+def match_node_hash(node, index):
+    text = index.text_value(node)
+    if text is not None:
+        return text
+    return HashableTree(node, index)
 
 
-def fuzzy_match_node_hash(node):
-    if is_text(node):
-        return node.nodeValue
-    return FuzzyHashableTree(node)
+def fuzzy_match_node_hash(node, index, memo=None):
+    text = index.text_value(node)
+    if text is not None:
+        return text
+    return FuzzyHashableTree(node, index, memo)
+
+
+class Budget(object):
+    """
+    A limit on the work that a diff does: seconds of wall-clock time, fuzzy
+    comparisons of node text, and nodes visited. Limits that are None are not
+    checked.
+
+    Once a limit is reached, the diff falls back from the full strategy to
+    exact matching, which only fuzzy matches children where what is left of
+    the limits covers it, and then to replacing the rest of the tree block by
+    block. The limits start over at each fallback, and budget.degraded is set
+    once there has been one.
+
+    htmltreediff.diff restarts the clock when it is called. Only matching is
+    bounded: parsing the documents and marking up the changes are not, and on
+    large documents they can take most of the time.
+
+    >>> budget = Budget(comparisons=2)
+    >>> budget.spend(comparisons=1)
+    >>> budget.strategy, budget.degraded
+    ('full', False)
+    >>> budget.spend(comparisons=1)
+    >>> budget.strategy, budget.degraded
+    ('exact', True)
+    """
+    strategies = ['full', 'exact', 'replace']
+    # About the most that difflib takes per pair of words, on long texts that
+    # repeat the same few words. Most text takes a tenth of that or less.
+    word_pair_seconds = 5e-8
+
+    def __init__(self, seconds=None, comparisons=None, nodes=None):
+        self.seconds = seconds
+        self.comparisons = comparisons
+        self.nodes = nodes
+        self.strategy = 'full'
+        self.start()
+
+    def start(self):
+        """Start the limits over."""
+        self.started = time.time()
+        self.compared = 0
+        self.visited = 0
+
+    @property
+    def degraded(self):
+        return self.strategy != 'full'
+
+    def spend(self, comparisons=0, nodes=0):
+        """
+        Count work done, and fall back to the next strategy if that reached
+        a limit.
+        """
+        self.compared += comparisons
+        self.visited += nodes
+        if self.strategy != 'replace' and self.exhausted():
+            self.degrade()
+
+    def degrade(self, strategy=None):
+        """
+        Fall back to the next strategy, or to the given one, and start the
+        limits over.
+        """
+        if strategy is None:
+            strategy = self.strategies[
+                self.strategies.index(self.strategy) + 1
+            ]
+        self.strategy = strategy
+        self.start()
+
+    def affords(self, comparisons=0, nodes=0, word_pairs=0):
+        """
+        Return whether that many more comparisons and nodes, and comparisons
+        of that many pairs of words, stay within the limits. Nodes are taken
+        to cost as much time as the ones visited so far, and pairs of words
+        word_pair_seconds each.
+        """
+        if (
+            self.comparisons is not None and
+            self.compared + comparisons > self.comparisons
+        ):
+            return False
+        if self.nodes is not None and self.visited + nodes > self.nodes:
+            return False
+        if self.seconds is not None and nodes and self.visited:
+            elapsed = time.time() - self.started
+            if elapsed * (self.visited + nodes) / self.visited > self.seconds:
+                return False
+        if self.seconds is not None and word_pairs:
+            elapsed = time.time() - self.started
+            if elapsed + word_pairs * self.word_pair_seconds > self.seconds:
+                return False
+        return True
+
+    def exhausted(self):
+        if self.comparisons is not None and self.compared >= self.comparisons:
+            return True
+        if self.nodes is not None and self.visited >= self.nodes:
+            return True
+        if self.seconds is not None:
+            return time.time() - self.started >= self.seconds
+        return False
 
 
 class Differ():
-    def __init__(self, old_dom, new_dom):
+    def __init__(self, old_dom, new_dom, index=None, matcher=None,
+                 budget=None, backend='difflib'):
+        """
+        The documents are read into a compact NodeIndex, and the diff runs on
+        that, so the documents themselves are never modified. To diff trees
+        that are already indexed, pass in the index, and give the roots as
+        their node ids in it.
+
+        Sibling nodes are lined up with the given matcher, one of the names
+        in htmltreediff.matchers, or the default matcher if none is given.
+
+        Text similarity results are kept in self.memo while the diff runs,
+        and dropped when it is done. Its hits and misses counts stay, to
+        show how many comparisons were saved. Text is compared with the
+        given WordMatcher backend.
+
+        Pass a Budget to bound the work that the diff does. Once it runs
+        out, the rest of the tree is diffed with cheaper strategies, and
+        budget.degraded is set.
+        """
         self.edit_script = []
-        self.old_dom = copy_dom(old_dom)
-        self.new_dom = copy_dom(new_dom)
-
-    def get_edit_script(self):
+        self.subtrees = False
+        self.location = location_list
+        self.budget = budget
+        self.matcher = get_matcher(matcher)
+        if index is None:
+            # Digest both documents up front, so that subtree comparisons
+            # during matching don't have to walk the trees again.
+            index = NodeIndex()
+            old_dom = index.add(old_dom)
+            new_dom = index.add(new_dom)
+        self.index = index
+        self.memo = SimilarityMemo(index, budget, backend)
+        self.old_root = old_dom
+        self.new_root = new_dom
+
+    def get_edit_script(self, subtrees=False, handles=False):
         """
         Take two doms, and output an edit script transforming one into the
         other.
@@ -50,69 +180,162 @@ class Differ():
             {node_type, tag_name, attributes, node_value.}
         Any properties that would be empty may be ommitted. attributes is an
         attribute dictionary.
+
+        Inserted and deleted subtrees take one entry per node, children
+        deleted before their parent and inserted after it. With subtrees,
+        they take one entry each instead:
+        - ('delete_subtree', location, node_properties)
+            delete the node, together with its descendants
+        - ('insert_subtree', location, node_properties)
+            insert the node, where node_properties also has a list of the
+            properties of its child nodes as 'children', and so on down
+
+        With handles, the locations are left as the location handles that
+        run() passes around, for a runner that finds nodes by them.
         """
-        # start diff at the body element
-        self.diff_location([], [])
+        self.subtrees = subtrees
+        if handles:
+            self.location = lambda location: location
+        self.run()
         return self.edit_script
 
-    def diff_location(self, old_location, new_location):
+    def run(self):
+        """
+        Diff the two trees, calling self.delete and self.insert for each
+        change, in the order that the edit script lists them.
+
+        Locations are passed around as handles, which are () for the root,
+        and (parent location, child index) below it, so that a child's
+        location is made without copying its parent's. They are only turned
+        into lists of indices by location_list, for an edit script that
+        doesn't keep the handles.
+        """
+        # Start diff at the body element. Each diffed location gives back
+        # the matched child locations to diff next. Keep them on a stack, so
+        # that they are diffed depth first, in document order, without
+        # recursion.
+        worklist = [(self.old_root, self.new_root, (), ())]
+        while worklist:
+            worklist.extend(reversed(self.diff_location(*worklist.pop())))
+        self.memo.clear()
+
+    def diff_location(self, old_node, new_node, old_location, new_location):
         # Here we match up the children of the given locations. This is done in
         # three steps. First we use full tree equality to match up children
         # that are identical all the way down. Then, we use a heuristic
         # function to match up children that are similar, based on text
         # content. Lastly, we just use node tag types to match up elements. For
         # the text-similar matches and the tag-only matches, we still have more
-        # work to do, so we recurse on these. The non-matching parts that
-        # remain are used to output edit script entries.
-        old_children = list(
-            get_location(self.old_dom, old_location).childNodes,
-        )
-        new_children = list(
-            get_location(self.new_dom, new_location).childNodes,
-        )
+        # work to do, so we return these, to be diffed next. The non-matching
+        # parts that remain are used to output edit script entries.
+        old_children = self.index.children(old_node)
+        new_children = self.index.children(new_node)
         if not old_children and not new_children:
-            return
+            return []
+        if self.budget is not None:
+            self.budget.spend(nodes=len(old_children) + len(new_children))
 
         matching_blocks, recursion_indices = self.match_children(
             old_children,
             new_children,
         )
 
-        # Apply changes for this level.
-        for tag, i1, i2, j1, j2 in adjusted_ops(get_opcodes(matching_blocks)):
+        # Apply changes for this level. The ops are in document order, and
+        # their old indices already account for the ops before them, so the
+        # old child at an index is found by undoing the offset so far.
+        ops = list(adjusted_ops(get_opcodes(matching_blocks)))
+        offset = 0
+        for tag, i1, i2, j1, j2 in ops:
             if tag == 'delete':
                 assert j1 == j2
                 # delete range from right to left
-                children = reversed(list(enumerate(old_children[i1:i2])))
-                for index, child in children:
-                    self.delete(old_location + [i1 + index], child)
-                    old_children.pop(i1 + index)
+                for index in reversed(range(i1, i2)):
+                    self.delete(
+                        (old_location, index),
+                        old_children[index - offset],
+                    )
+                offset -= i2 - i1
             elif tag == 'insert':
                 assert i1 == i2
                 # insert range from left to right
                 for index, child in enumerate(new_children[j1:j2]):
-                    self.insert(new_location + [i1 + index], child)
-                    old_children.insert(i1 + index, child)
-            recursion_indices = list(
-                adjust_indices(recursion_indices, i1, i2, j1, j2),
+                    self.insert((new_location, i1 + index), child)
+                offset += j2 - j1
+
+        # Go on to the deeper level.
+        adjusted_indices = adjust_indices(recursion_indices, ops)
+        return [
+            (
+                old_children[old_index],
+                new_children[new_index],
+                (old_location, location_index),
+                (new_location, new_index),
             )
-
-        # Recurse to deeper level.
-        for old_index, new_index in recursion_indices:
-            self.diff_location(
-                old_location + [old_index],
-                new_location + [new_index],
+            for (old_index, new_index), (location_index, _) in zip(
+                recursion_indices,
+                adjusted_indices,
             )
+        ]
 
     def match_children(self, old_children, new_children):
-        # Find whole-tree matches and fuzzy matches.
-        sm = match_blocks(match_node_hash, old_children, new_children)
+        # Identical children at the start and end are matched up front, so
+        # that only the window of children in between has to be hashed and
+        # matched.
+        old_length = len(old_children)
+        new_length = len(new_children)
+        prefix, suffix = common_affixes(old_children, new_children, self.index)
+        old_stop = old_length - suffix
+        new_stop = new_length - suffix
+        wide = max(old_stop, new_stop) - prefix >= wide_node_size
+        if self.budget is not None and wide:
+            # Matching a wide node is one call that the budget can't cut
+            # short, so it has to afford the children up front, or the rest
+            # of the tree is replaced.
+            width = old_stop + new_stop - 2 * prefix
+            if self.budget.strategy != 'replace':
+                if self.budget.affords(nodes=width):
+                    self.budget.spend(nodes=width)
+                else:
+                    self.budget.degrade('replace')
+        strategy = 'full' if self.budget is None else self.budget.strategy
+
+        # Find whole-tree matches and fuzzy matches. Out of budget, the
+        # children in between are replaced as a block.
+        if strategy == 'replace':
+            blocks = [(old_stop - prefix, new_stop - prefix, 0)]
+        elif wide:
+            blocks = anchored_blocks(
+                old_children[prefix:old_stop],
+                new_children[prefix:new_stop],
+                self.index,
+                self.matcher,
+            )
+        else:
+            popular = None
+            if (prefix or suffix) and self.matcher is difflib_blocks:
+                popular = popular_digests(new_children, self.index) or set()
+            blocks = match_blocks(
+                match_node_hash,
+                old_children[prefix:old_stop],
+                new_children[prefix:new_stop],
+                self.index,
+                self.matcher,
+                popular,
+            )
+        matching_blocks = []
+        if prefix:
+            matching_blocks.append((0, 0, prefix))
+        for a, b, size in blocks[:-1]:
+            matching_blocks.append((prefix + a, prefix + b, size))
+        if suffix:
+            matching_blocks.append((old_stop, new_stop, suffix))
+        matching_blocks.append((old_length, new_length, 0))  # sentinel
+
         # If the match is very poor, pretend there were no exact matching
         # blocks at all.
-        if sm.ratio() < 0.3:
-            matching_blocks = [(len(old_children), len(new_children), 0)]
-        else:
-            matching_blocks = sm.get_matching_blocks()
+        matches = sum(size for a, b, size in matching_blocks)
+        if ratio(matches, old_length + new_length) < 0.3:
+            matching_blocks = [(old_length, new_length, 0)]
 
         # In each gap between exact matches, find fuzzy matches.
         gaps = get_nonmatching_blocks(matching_blocks)
@@ -120,12 +343,24 @@ class Differ():
         fuzzy_matching_blocks = [(0, 0, 0)]
         for nonmatch in gaps:
             alo, ahi, blo, bhi = nonmatch
-            sm_fuzzy = match_blocks(
-                fuzzy_match_node_hash,
+            if not self.bound_gap(
+                old_children[alo:ahi],
+                new_children[blo:bhi],
+            ):
+                del fuzzy_matching_blocks[-1]
+                fuzzy_matching_blocks.append((ahi, bhi, 0))
+                continue
+            blocks = match_blocks(
+                lambda node, index: fuzzy_match_node_hash(
+                    node,
+                    index,
+                    self.memo,
+                ),
                 old_children[alo:ahi],
                 new_children[blo:bhi],
+                self.index,
+                self.matcher,
             )
-            blocks = sm_fuzzy.get_matching_blocks()
             # Move blocks over to the position of the gap.
             blocks = [
                 (alo + a, blo + b, size)
@@ -146,36 +381,151 @@ class Differ():
 
         return matching_blocks, recursion_indices
 
+    def bound_gap(self, old_children, new_children):
+        """
+        Bound the text similarity of the children in a gap between exact
+        matches, and return whether the budget can cover fuzzy matching them.
+        If it can't, the gap is only matched exactly, and a budget that is
+        still on the full strategy falls back to exact matching.
+        """
+        budget = self.budget
+        pairs = len(old_children) * len(new_children)
+        if budget is not None:
+            if budget.strategy == 'replace':
+                return False
+            # A gap can take a comparison for each pair of children, so one
+            # that the budget can't cover is given up before bounding it.
+            if not budget.affords(comparisons=pairs):
+                self.give_up_gap()
+                return False
+        word_pairs = 0
+        for a_nodes, b_nodes in gap_groups(
+            old_children,
+            new_children,
+            self.index,
+        ):
+            word_pairs += self.memo.bound(
+                a_nodes,
+                b_nodes,
+                FuzzyHashableTree.cutoff,
+            )
+        # The pairs that the bounds let through are compared word by word,
+        # which the budget has to have time for. A single comparison is left
+        # to the memo, which estimates it instead if it is too large.
+        if budget is None or pairs == 1 or budget.affords(
+            word_pairs=word_pairs,
+        ):
+            return True
+        self.give_up_gap()
+        return False
+
+    def give_up_gap(self):
+        # With the full strategy, the first gap that the budget can't cover
+        # falls back to exact matching. After that, each gap that it can't
+        # cover is matched exactly, and the rest still get fuzzy matched.
+        if not self.budget.degraded:
+            self.budget.degrade()
+
     def delete(self, location, node):
-        # delete from the bottom up, children before parent, right to left
-        for child_index, child in reversed(list(enumerate(node.childNodes))):
-            self.delete(location + [child_index], child)
-        # write deletion to the edit script
-        self.edit_script.append((
-            'delete',
-            location,
-            node_properties(node),
-        ))
-        # actually delete the node
-        assert node.parentNode == get_location(self.old_dom, location[:-1])
-        assert node.ownerDocument == self.old_dom
-        remove_node(node)
+        if self.subtrees:
+            self.edit_script.append((
+                'delete_subtree',
+                self.location(location),
+                self.node_properties(node),
+            ))
+            return
+        # delete from the bottom up, children before parent, right to left,
+        # which is the reverse of walking the subtree top down, left to right
+        deletions = []
+        for location, node in self.walk(location, node):
+            deletions.append((
+                'delete',
+                self.location(location),
+                self.node_properties(node),
+            ))
+        # write deletions to the edit script
+        self.edit_script.extend(reversed(deletions))
+
+    def node_properties(self, node):
+        return label_properties(self.index.label(node))
 
     def insert(self, location, node):
-        # write insertion to the edit script
-        self.edit_script.append((
-            'insert',
-            location,
-            node_properties(node),
-        ))
-        # actually insert the node
-        node_copy = node.cloneNode(deep=False)
-        parent = get_location(self.old_dom, location[:-1])
-        next_sibling = get_child(parent, location[-1])
-        insert_or_append(parent, node_copy, next_sibling)
+        if self.subtrees:
+            self.edit_script.append((
+                'insert_subtree',
+                self.location(location),
+                self.subtree_properties(node),
+            ))
+            return
         # insert from the top down, parent before children, left to right
-        for child_index, child in enumerate(node.childNodes):
-            self.insert(location + [child_index], child)
+        for location, node in self.walk(location, node):
+            # write insertion to the edit script
+            self.edit_script.append((
+                'insert',
+                self.location(location),
+                self.node_properties(node),
+            ))
+
+    def subtree_properties(self, node):
+        """
+        Return the node properties of a node, with the properties of its
+        children, and theirs, as 'children'.
+        """
+        root = self.node_properties(node)
+        stack = [(root, node)]
+        while stack:
+            properties, node = stack.pop()
+            children = self.index.children(node)
+            if children:
+                properties['children'] = [
+                    self.node_properties(child) for child in children
+                ]
+                stack.extend(zip(properties['children'], children))
+        return root
+
+    def walk(self, location, node):
+        """
+        Yield (location, node) for the node and all its descendants, top down
+        and left to right.
+        """
+        stack = [(location, node)]
+        while stack:
+            location, node = stack.pop()
+            yield location, node
+            children = self.index.children(node)
+            for child_index in reversed(range(len(children))):
+                stack.append(((location, child_index), children[child_index]))
+
+
+def location_list(location):
+    """
+    Turn a location handle into the list of child indices that it stands
+    for.
+
+    >>> location_list((((), 2), 0))
+    [2, 0]
+    >>> location_list(())
+    []
+    """
+    indices = []
+    while location:
+        location, index = location
+        indices.append(index)
+    indices.reverse()
+    return indices
+
+
+def location_handle(indices):
+    """
+    Turn a list of child indices into a location handle.
+
+    >>> location_handle([2, 0])
+    (((), 2), 0)
+    """
+    location = ()
+    for index in indices:
+        location = (location, index)
+    return location
 
 
 def adjusted_ops(opcodes):
@@ -199,44 +549,36 @@ def adjusted_ops(opcodes):
     >>> list(adjusted_ops(sequence_opcodes('bc', 'ab')))
     [('insert', 0, 0, 0, 1), ('delete', 2, 3, 2, 2)]
     """
-    while opcodes:
-        op = opcodes.pop(0)
-        tag, i1, i2, j1, j2 = op
-        shift = 0
+    offset = 0
+    for tag, i1, i2, j1, j2 in opcodes:
         if tag == 'equal':
             continue
         if tag == 'replace':
             # change the single replace op into a delete then insert
             # pay careful attention to the variables here, there's no typo
-            opcodes = [
+            ops = [
                 ('delete', i1, i2, j1, j1),
                 ('insert', i2, i2, j1, j2),
-            ] + opcodes
-            continue
-        yield op
-        if tag == 'delete':
-            shift = -(i2 - i1)
-        elif tag == 'insert':
-            shift = +(j2 - j1)
-        new_opcodes = []
-        for tag, i1, i2, j1, j2 in opcodes:
-            new_opcodes.append((
-                tag,
-                i1 + shift,
-                i2 + shift,
-                j1,
-                j2,
-            ))
-        opcodes = new_opcodes
+            ]
+        else:
+            ops = [(tag, i1, i2, j1, j2)]
+        for tag, i1, i2, j1, j2 in ops:
+            yield (tag, i1 + offset, i2 + offset, j1, j2)
+            if tag == 'delete':
+                offset -= i2 - i1
+            elif tag == 'insert':
+                offset += j2 - j1
 
 
-def node_properties(node):
+def label_properties(label):
+    """Turn a node_label into the node properties of an edit script entry."""
+    node_type, node_name, node_value, attributes = label
     d = {}
-    d['node_type'] = node.nodeType
-    d['node_name'] = node.nodeName
-    d['node_value'] = node.nodeValue
-    d['attributes'] = attribute_dict(node)
-    if node.nodeType == Node.TEXT_NODE:
+    d['node_type'] = node_type
+    d['node_name'] = node_name
+    d['node_value'] = node_value
+    d['attributes'] = dict(attributes)
+    if node_type == Node.TEXT_NODE:
         del d['node_name']  # don't include node name for text nodes
     for key, value in list(d.items()):
         if not value:
@@ -244,6 +586,95 @@ def node_properties(node):
     return d
 
 
+def common_affixes(old_children, new_children, index):
+    """
+    Return the lengths of the common prefix and suffix of two lists of nodes,
+    comparing whole subtrees. The two never overlap.
+
+    The affixes are only as long as difflib would match them the same way
+    within the whole lists:
+
+    - difflib lines up a node with the first equal node it finds, so the
+      prefix stops before any significant node that comes again later in
+      either list, and the suffix after any that came earlier.
+    - difflib lets a match take in the equal junk next to it, so the junk
+      where the prefix meets the differing children could go either way. If
+      there is any, it is left out of the prefix, together with the run of
+      non-junk nodes before it, so that difflib still makes that choice.
+    - difflib never matches junk on its own, so a prefix of only junk is
+      left out.
+
+    The same goes for the suffix.
+
+    >>> from htmltreediff.util import parse_minidom
+    >>> old_dom = parse_minidom('<p>one</p><p>two</p><p>six</p><p>ten</p>')
+    >>> new_dom = parse_minidom('<p>one</p><p>new</p><p>ten</p>')
+    >>> index = NodeIndex()
+    >>> old_children = index.children(index.add(old_dom))
+    >>> new_children = index.children(index.add(new_dom))
+    >>> common_affixes(old_children, new_children, index)
+    (1, 1)
+    >>> common_affixes(old_children, old_children, index)
+    (4, 0)
+    >>> old_dom = parse_minidom('<p>one</p><br/><p>two</p><br/><p>six</p>')
+    >>> new_dom = parse_minidom('<p>one</p><br/><p>two</p><br/><p>new</p>')
+    >>> old_children = index.children(index.add(old_dom))
+    >>> new_children = index.children(index.add(new_dom))
+    >>> common_affixes(old_children, new_children, index)
+    (2, 0)
+    """
+    limit = min(len(old_children), len(new_children))
+    prefix = _common_prefix(old_children, new_children, limit, index)
+    suffix = _common_prefix(
+        old_children[::-1],
+        new_children[::-1],
+        limit - prefix,
+        index,
+    )
+    return prefix, suffix
+
+
+def _common_prefix(old_children, new_children, limit, index):
+    digest = index.digest
+    significant = index.significant
+    prefix = 0
+    while (
+        prefix < limit and
+        digest(old_children[prefix]) == digest(new_children[prefix])
+    ):
+        prefix += 1
+    common = prefix
+    later = set(digest(c) for c in old_children[prefix:])
+    later.update(digest(c) for c in new_children[prefix:])
+    for i in range(prefix - 1, -1, -1):
+        child_digest = digest(old_children[i])
+        if significant[old_children[i]] and child_digest in later:
+            prefix = i
+        later.add(child_digest)
+    if prefix < common or (
+        prefix and not significant[old_children[prefix - 1]]
+    ):
+        while prefix and not significant[old_children[prefix - 1]]:
+            prefix -= 1
+        while prefix and significant[old_children[prefix - 1]]:
+            prefix -= 1
+    if not any(significant[child] for child in old_children[:prefix]):
+        prefix = 0
+    return prefix
+
+
+def ratio(matches, length):
+    """
+    Compute a similarity ratio the way difflib.SequenceMatcher does.
+
+    >>> ratio(3, 8), ratio(0, 0)
+    (0.75, 1.0)
+    """
+    if length:
+        return 2.0 * matches / length
+    return 1.0
+
+
 def match_indices(match):
     """
     Yield index tuples (old_index, new_index) for each place in the match.
@@ -260,25 +691,178 @@ def get_opcodes(matching_blocks):
     return sm.get_opcodes()
 
 
-def _is_junk(hashable_node):
+def _is_junk(hashable_node, index):
     if isinstance(hashable_node, basestring):
-        return is_text_junk(hashable_node)
+        return index.is_junk_text(hashable_node)
     # Nodes with no text or just whitespace are junk.
-    for descendant in walk_dom(hashable_node.node):
-        if is_text(descendant):
-            if not is_text_junk(descendant.nodeValue):
-                return False
-    return True
+    return not index.has_significant_text(hashable_node.node)
+
+
+def match_blocks(
+    hash_func,
+    old_children,
+    new_children,
+    index,
+    matcher=None,
+    popular=None,
+):
+    """Use a sequence matcher to find matching blocks.
+
+    The matcher is a name or function from htmltreediff.matchers, and
+    defaults to difflib. difflib ignores items that are very common in the new
+    list. When matching a window of a longer list, pass in the digests that
+    are popular in the whole list, so that the window is matched the same way.
+    """
+    old_hashes = [hash_func(c, index) for c in old_children]
+    new_hashes = [hash_func(c, index) for c in new_children]
+    if popular is not None:
+        popular = set(
+            h for h, c in zip(new_hashes, new_children)
+            if index.digest(c) in popular
+        )
+    return get_matcher(matcher)(
+        old_hashes,
+        new_hashes,
+        lambda hashable_node: _is_junk(hashable_node, index),
+        popular=popular,
+    )
+
+
+# Lists of siblings at least this long are matched in windows, between
+# anchors, by anchored_blocks.
+wide_node_size = 200
 
 
-def match_blocks(hash_func, old_children, new_children):
-    """Use difflib to find matching blocks."""
-    sm = difflib.SequenceMatcher(
-        _is_junk,
-        a=[hash_func(c) for c in old_children],
-        b=[hash_func(c) for c in new_children],
+def anchored_blocks(old_children, new_children, index, matcher=None):
+    """
+    Find matching blocks between two long lists of nodes, one window at a
+    time. Significant subtrees that occur exactly once in each list, in the
+    same order, are anchors. The windows between anchors are matched on their
+    own, and difflib does not treat popular nodes as junk in them.
+
+    >>> from htmltreediff.util import parse_minidom
+    >>> old_dom = parse_minidom('<p>a</p><p>x</p><p>b</p><p>x</p><p>c</p>')
+    >>> new_dom = parse_minidom('<p>a</p><p>b</p><p>x</p><p>y</p><p>c</p>')
+    >>> index = NodeIndex()
+    >>> old_children = index.children(index.add(old_dom))
+    >>> new_children = index.children(index.add(new_dom))
+    >>> anchored_blocks(old_children, new_children, index)
+    [(0, 0, 1), (2, 1, 2), (4, 4, 1), (5, 5, 0)]
+    """
+    digest = index.digest
+    significant = index.significant
+    old_digests = [digest(c) for c in old_children]
+    new_digests = [digest(c) for c in new_children]
+    junk = set(
+        digest(c) for c in old_children + new_children
+        if not significant[c]
+    )
+    old_length = len(old_children)
+    new_length = len(new_children)
+    anchors = unique_anchors(
+        old_digests,
+        new_digests,
+        0, old_length,
+        0, new_length,
+        junk.__contains__,
+    )
+    anchors.append((old_length, new_length))  # sentinel
+
+    blocks = []
+    i = j = 0
+    for anchor_i, anchor_j in anchors:
+        # Equal nodes at the edges of a window, junk or not, go with the
+        # anchors next to them.
+        prefix = 0
+        while (
+            i + prefix < anchor_i and j + prefix < anchor_j and
+            old_digests[i + prefix] == new_digests[j + prefix]
+        ):
+            prefix += 1
+        suffix = 0
+        while (
+            i + prefix < anchor_i - suffix and
+            j + prefix < anchor_j - suffix and
+            old_digests[anchor_i - 1 - suffix] ==
+            new_digests[anchor_j - 1 - suffix]
+        ):
+            suffix += 1
+        blocks.append((i, j, prefix))
+        window = match_blocks(
+            match_node_hash,
+            old_children[i + prefix:anchor_i - suffix],
+            new_children[j + prefix:anchor_j - suffix],
+            index,
+            matcher,
+            popular=set(),
+        )
+        for a, b, size in window:
+            blocks.append((i + prefix + a, j + prefix + b, size))
+        blocks.append((anchor_i - suffix, anchor_j - suffix, suffix))
+        blocks.append((anchor_i, anchor_j, 1))
+        i = anchor_i + 1
+        j = anchor_j + 1
+
+    # Join adjacent blocks, and end with the sentinel.
+    matching_blocks = []
+    for a, b, size in blocks[:-1]:
+        if not size:
+            continue
+        if matching_blocks:
+            last_a, last_b, last_size = matching_blocks[-1]
+            if last_a + last_size == a and last_b + last_size == b:
+                matching_blocks[-1] = (last_a, last_b, last_size + size)
+                continue
+        matching_blocks.append((a, b, size))
+    matching_blocks.append((old_length, new_length, 0))
+    return matching_blocks
+
+
+def gap_groups(old_children, new_children, index):
+    """
+    Yield the groups of elements in a gap whose pairs can be fuzzy matches,
+    as (a_nodes, b_nodes).
+
+    Fuzzy matching compares elements with the same label, old against new,
+    and new against new, so those are the pairs in each group.
+    """
+    old_groups = {}
+    new_groups = {}
+    for children, groups in [
+        (old_children, old_groups),
+        (new_children, new_groups),
+    ]:
+        for child in children:
+            if index.text_value(child) is None:
+                label = index.label_ids[child]
+                groups.setdefault(label, []).append(child)
+    for label, new_group in new_groups.iteritems():
+        yield old_groups.get(label, []) + new_group, new_group
+
+
+# difflib.SequenceMatcher's autojunk heuristic only looks for popular items
+# in sequences at least this long. An item is popular there if it makes up
+# more than one in a hundred items, plus one.
+autojunk_min_length = 200
+
+
+def popular_digests(children, index):
+    """
+    Return the digests that difflib would treat as popular in a list of
+    nodes, or None if the list is too short for difflib to look for them.
+    """
+    if len(children) < autojunk_min_length:
+        return None
+    counts = {}
+    for child in children:
+        if index.significant[child]:
+            digest = index.digest(child)
+            counts[digest] = counts.get(digest, 0) + 1
+    limit = len(children) // 100 + 1
+    return set(
+        digest for digest, count in counts.items()
+        if count > limit
     )
-    return sm
 
 
 def get_nonmatching_blocks(matching_blocks):
@@ -315,9 +899,22 @@ def merge_blocks(a_blocks, b_blocks):
     return combined_blocks
 
 
-def adjust_indices(indices, i1, i2, j1, j2):
-    shift = (j2 - j1) - (i2 - i1)
+def adjust_indices(indices, ops):
+    """
+    Move (old_index, new_index) pairs to account for a list of ops from
+    adjusted_ops. Both the indices and the ops must be in document order, so
+    that this is a single pass.
+
+    >>> ops = [('insert', 0, 0, 0, 2), ('delete', 3, 4, 2, 2)]
+    >>> list(adjust_indices([(0, 2), (1, 3), (3, 4)], ops))
+    [(2, 2), (3, 3), (4, 4)]
+    """
+    ops = iter(ops)
+    op = next(ops, None)
+    shift = 0
     for a, b in indices:
-        if a >= i2:
-            a += shift
-        yield a, b
+        while op is not None and a + shift >= op[2]:
+            tag, i1, i2, j1, j2 = op
+            shift += (j2 - j1) - (i2 - i1)
+            op = next(ops, None)
+        yield a + shift, b
@@ -1,17 +1,141 @@
-from xml.dom import Node
-
+from htmltreediff.diff_core import location_handle, location_list
 from htmltreediff.util import (
+    DomTree,
     get_child,
-    get_location,
+    is_text,
     remove_node,
     insert_or_append,
+    split_node,
+    walk_dom,
 )
 
 
+def create_node(dom, **properties):
+    """
+    Create a node from the node properties of an edit script entry. Return
+    None for node types that don't get inserted.
+    """
+    return DomTree(dom).create_node(**properties)
+
+
+def create_subtree(properties, create, append_child):
+    """
+    Create a node and its descendants from the node properties of an
+    insert_subtree entry, with create(**node_properties), which returns None
+    for nodes that don't get inserted, and append_child(parent, child).
+    Return the node, or None.
+    """
+    def create_from(properties):
+        properties = dict(properties)
+        children = properties.pop('children', [])
+        return create(**properties), children
+
+    root, children = create_from(properties)
+    stack = [(root, children)]
+    while stack:
+        node, children = stack.pop()
+        if node is None:
+            continue
+        for child_properties in children:
+            child, grandchildren = create_from(child_properties)
+            if child is not None:
+                append_child(node, child)
+            stack.append((child, grandchildren))
+    return root
+
+
+class LocationCache(object):
+    """
+    Find the nodes at location handles, as the Differ passes them around: ()
+    for the root, and (parent location, child index) below it.
+
+    The nodes along the last location found are kept, by the identity of
+    their handles. A new location is followed up through its parents only
+    until it reaches a kept handle, and then down from that node, reusing
+    the kept nodes for as long as the child indices are the same. The Differ
+    makes the location of a child from the handle of its parent, so a
+    location next to the last one takes a single child lookup, however deep
+    it is, even if its handle was made separately, such as from a list.
+    An edit only moves the children of the node it is made in, so after one,
+    the nodes below that parent are dropped with edited().
+    """
+    def __init__(self, root, get_child):
+        self.get_child = get_child
+        self.handles = [()]
+        self.nodes = [root]
+        self.depths = {id(()): 0}  # id of a kept handle -> its depth
+
+    def depth(self, location):
+        """Return the depth of a kept handle, or None."""
+        depth = self.depths.get(id(location))
+        if depth is not None and self.handles[depth] is location:
+            return depth
+        return None
+
+    def find(self, location):
+        # Climb up to a kept handle, or to the root.
+        path = []
+        handle = location
+        depth = 0
+        while handle:
+            known = self.depth(handle)
+            if known is not None:
+                depth = known
+                break
+            path.append(handle)
+            handle = handle[0]
+        # Walk down from its node. A handle with the same child index as the
+        # kept one below the same parent leads to the same node, even if it
+        # was made separately, as deletes and inserts in the same parent are,
+        # and then it is kept in its place.
+        for handle in reversed(path):
+            depth += 1
+            if (
+                depth < len(self.handles) and
+                self.handles[depth][1] == handle[1]
+            ):
+                del self.depths[id(self.handles[depth])]
+            else:
+                self.keep(depth - 1)
+                node = self.get_child(self.nodes[-1], handle[1])
+                if node is None:
+                    raise ValueError(
+                        'Node at location %s does not exist.' %
+                        location_list(location),
+                    )
+                self.handles.append(None)
+                self.nodes.append(node)
+            self.depths[id(handle)] = depth
+            self.handles[depth] = handle
+        self.keep(depth)
+        return self.nodes[depth]
+
+    def keep(self, depth):
+        """Drop the kept nodes below the given depth."""
+        for handle in self.handles[depth + 1:]:
+            del self.depths[id(handle)]
+        del self.handles[depth + 1:]
+        del self.nodes[depth + 1:]
+
+    def edited(self, location):
+        """Drop the nodes below the parent of an edited location."""
+        depth = self.depth(location[0])
+        self.keep(depth or 0)
+
+
 class EditScriptRunner(object):
-    def __init__(self, dom, edit_script):
+    def __init__(self, dom, edit_script, split_text=False):
+        """
+        The edit script locations count text nodes split into words, as
+        changes.split_text_nodes does. With split_text, the dom may still
+        have whole text nodes, and the ones among the children of each node
+        that the script reaches into are split on the way.
+        """
         self.dom = dom
         self.edit_script = edit_script
+        self.split_text = split_text
+        self.split_parents = set()
+        self.locations = LocationCache(dom.documentElement, self.get_child)
         self.del_nodes = []
         self.ins_nodes = []
 
@@ -20,9 +144,7 @@ class EditScriptRunner(object):
         parent = node.parentNode
         next_sibling = node.nextSibling
         remove_node(node)
-        node.orig_parent = parent
-        node.orig_next_sibling = next_sibling
-        self.del_nodes.append(node)
+        self.del_nodes.append((node, parent, next_sibling))
 
     def action_insert(
         self,
@@ -33,15 +155,28 @@ class EditScriptRunner(object):
         node_value=None,
         attributes=None,
     ):
-        node = None
-        if node_type == Node.ELEMENT_NODE:
-            node = self.dom.createElement(node_name)
-            if attributes:
-                for key, value in attributes.items():
-                    node.setAttribute(key, value)
-        elif node_type == Node.TEXT_NODE:
-            node = self.dom.createTextNode(node_value)
+        node = create_node(
+            self.dom,
+            node_type=node_type,
+            node_name=node_name,
+            node_value=node_value,
+            attributes=attributes,
+        )
+        if node is not None:
+            # Inserted nodes only get inserted children, which are split
+            # already.
+            self.split_parents.add(node)
+            self.action_insert_node(parent, child_index, node)
+
+    def action_insert_subtree(self, parent, child_index, properties):
+        node = create_subtree(
+            properties,
+            lambda **properties: create_node(self.dom, **properties),
+            lambda parent, child: parent.appendChild(child),
+        )
         if node is not None:
+            for descendant in walk_dom(node):
+                self.split_parents.add(descendant)
             self.action_insert_node(parent, child_index, node)
 
     def action_insert_node(self, parent, child_index, node):
@@ -49,21 +184,44 @@ class EditScriptRunner(object):
         insert_or_append(parent, node, next_sibling)
         # add node to ins_nodes
         assert node.parentNode is not None
-        node.orig_parent = parent
-        node.orig_next_sibling = next_sibling
         self.ins_nodes.append(node)
 
     # script running #
+    def get_child(self, node, child_index):
+        self.split_children(node)
+        return get_child(node, child_index)
+
+    def split_children(self, node):
+        if not self.split_text or node in self.split_parents:
+            return
+        self.split_parents.add(node)
+        for child in list(node.childNodes):
+            if is_text(child):
+                split_node(child)
+
     def run_edit_script(self):
         """
         Run an xml edit script, and return the new html produced.
+
+        The locations can be lists of indices, or location handles, from
+        Differ.get_edit_script with handles.
         """
         for action, location, properties in self.edit_script:
-            if action == 'delete':
-                node = get_location(self.dom, location)
+            if isinstance(location, list):
+                location = location_handle(location)
+            if action in ('delete', 'delete_subtree'):
+                # Deleting a node takes whatever is left below it along.
+                node = self.locations.find(location)
                 self.action_delete(node)
             elif action == 'insert':
-                parent = get_location(self.dom, location[:-1])
-                child_index = location[-1]
+                parent_location, child_index = location
+                parent = self.locations.find(parent_location)
+                self.split_children(parent)
                 self.action_insert(parent, child_index, **properties)
+            elif action == 'insert_subtree':
+                parent_location, child_index = location
+                parent = self.locations.find(parent_location)
+                self.split_children(parent)
+                self.action_insert_subtree(parent, child_index, properties)
+            self.locations.edited(location)
         return self.dom
@@ -1,24 +1,46 @@
 from htmltreediff.util import (
+    DomTree,
+    as_tree,
     check_text_similarity,
-    is_element,
+    elements_by_tag_name,
     minidom_tostring,
     parse_minidom,
     parse_text,
-    remove_node,
-    unwrap,
-    wrap_inner,
-    wrap_nodes,
 )
-from htmltreediff.changes import dom_diff, distribute
+from htmltreediff.changes import diff_index, distribute, indexed_dom_diff
+
+too_large_html = (
+    '<h2>The differences from the previous version are too large to show '
+    'concisely.</h2>'
+)
 
 
-def diff(old_html, new_html, cutoff=0.0, plaintext=False, pretty=False):
+def diff(old_html, new_html, cutoff=0.0, plaintext=False, pretty=False,
+         matcher=None, approximate=None, budget=None, backend='difflib'):
     """Show the differences between the old and new html document, as html.
 
     Return the document html with extra tags added to show changes. Add <ins>
     tags around newly added sections, and <del> tags to show sections that have
     been deleted.
+
+    Sibling nodes are lined up with the given matcher, one of the names in
+    htmltreediff.matchers, or the default matcher if none is given.
+
+    If the text of the documents is less similar than the cutoff, as
+    util.check_text_similarity measures it, a message saying so is returned
+    instead. For very large documents, pass a number of samples as
+    approximate to check an estimate of their similarity instead, from
+    util.approximate_text_similarity.
+
+    Pass an htmltreediff.Budget to limit the time and work that the diff takes,
+    from the time this is called. If it runs out, the rest of the documents
+    are diffed more coarsely, and budget.degraded is set to show that.
+
+    Text similarity, for the cutoff and for lining up changed nodes, is
+    measured with the given text.WordMatcher backend.
     """
+    if budget is not None:
+        budget.start()
     if plaintext:
         old_dom = parse_text(old_html)
         new_dom = parse_text(new_html)
@@ -26,118 +48,148 @@ def diff(old_html, new_html, cutoff=0.0, plaintext=False, pretty=False):
         old_dom = parse_minidom(old_html)
         new_dom = parse_minidom(new_html)
 
-    # If the two documents are not similar enough, don't show the changes.
-    if not check_text_similarity(old_dom, new_dom, cutoff):
-        return (
-            '<h2>The differences from the previous version are too large to '
-            'show concisely.</h2>'
-        )
+    # The new document is only read through the index from here on, so drop
+    # it.
+    index = diff_index()
+    old_root = index.add(old_dom)
+    new_root = index.add(new_dom)
+    del new_dom
 
-    dom = dom_diff(old_dom, new_dom)
+    # If the two documents are not similar enough, don't show the changes.
+    # The similarity check only gets to matching words if the bounds over
+    # the index tokens can't settle it, and at a cutoff of 0 there is nothing
+    # to check.
+    if cutoff > 0 and not check_text_similarity(
+        old_root,
+        new_root,
+        cutoff,
+        index,
+        approximate=approximate,
+        backend=backend,
+    ):
+        return too_large_html
+    tree = DomTree(old_dom)
+    indexed_dom_diff(
+        tree,
+        old_root,
+        new_root,
+        index,
+        matcher,
+        budget,
+        backend,
+    )
 
     # HTML-specific cleanup.
     if not plaintext:
-        fix_lists(dom)
-        fix_tables(dom)
+        fix_lists(tree)
+        fix_tables(tree)
 
     # Only return html for the document body contents.
-    body_elements = dom.getElementsByTagName('body')
+    dom = old_dom
+    body_elements = elements_by_tag_name(dom, 'body')
     if len(body_elements) == 1:
         dom = body_elements[0]
 
     return minidom_tostring(dom, pretty=pretty)
 
 
-def _internalize_changes_markup(dom, child_tag_names):
+def _internalize_changes_markup(tree, child_tag_names):
     # Delete tags are always ordered first.
-    for del_tag in list(dom.getElementsByTagName('del')):
-        ins_tag = del_tag.nextSibling
+    for del_tag in list(tree.elements_by_tag_name('del')):
+        ins_tag = tree.next_sibling(del_tag)
         # The one child tag of `del_tag` should be child_tag_names
-        if len(del_tag.childNodes) != 1:
+        if len(tree.child_nodes(del_tag)) != 1:
             continue
-        if ins_tag is None or len(ins_tag.childNodes) != 1:
+        if ins_tag is None or len(tree.child_nodes(ins_tag)) != 1:
             continue
-        if ins_tag.tagName != 'ins':
+        if tree.tag_name(ins_tag) != 'ins':
             continue
-        deleted_tag = del_tag.firstChild
-        if not is_element(deleted_tag):
-            continue
-        if deleted_tag.tagName not in child_tag_names:
+        deleted_tag = tree.first_child(del_tag)
+        if tree.tag_name(deleted_tag) not in child_tag_names:
             continue
         # The one child tag of `ins_tag` should be child_tag_names
-        inserted_tag = ins_tag.firstChild
-        if not is_element(inserted_tag):
-            continue
-        if inserted_tag.tagName not in child_tag_names:
+        inserted_tag = tree.first_child(ins_tag)
+        if tree.tag_name(inserted_tag) not in child_tag_names:
             continue
 
-        attributes = dict(
-            [key, value] for key, value in
-            inserted_tag.attributes.items()
-        )
+        attributes = tree.attributes(inserted_tag)
         nodes_to_unwrap = [
             deleted_tag,
             inserted_tag,
         ]
         for n in nodes_to_unwrap:
-            unwrap(n)
-        new_node = wrap_nodes([del_tag, ins_tag], inserted_tag.tagName)
+            tree.unwrap(n)
+        new_node = tree.wrap_nodes(
+            [del_tag, ins_tag],
+            tree.tag_name(inserted_tag),
+        )
         for key, value in attributes.items():
-            new_node.setAttribute(key, value)
+            tree.set_attribute(new_node, key, value)
+
+
+def _parents_tagged(tree, nodes, tag_names):
+    """
+    Return the parents of the nodes that have one of the tag names, each once,
+    in order.
+    """
+    parents = []
+    seen = set()
+    for node in nodes:
+        parent = tree.parent(node)
+        if parent is None or parent in seen:
+            continue
+        if tree.tag_name(parent) in tag_names:
+            seen.add(parent)
+            parents.append(parent)
+    return parents
 
 
 def fix_lists(dom):
     # <ins> and <del> tags are not allowed within <ul> or <ol> tags.
     # Move them to the nearest li, so that the numbering isn't interrupted.
+    tree = as_tree(dom)
 
-    _internalize_changes_markup(dom, set(['li']))
+    _internalize_changes_markup(tree, set(['li']))
 
     # Find all del > li and ins > li sets.
-    del_tags = set()
-    ins_tags = set()
-    for node in list(dom.getElementsByTagName('li')):
-        parent = node.parentNode
-        if parent.tagName == 'del':
-            del_tags.add(parent)
-        elif parent.tagName == 'ins':
-            ins_tags.add(parent)
+    li_nodes = list(tree.elements_by_tag_name('li'))
+    del_tags = _parents_tagged(tree, li_nodes, ('del',))
+    ins_tags = _parents_tagged(tree, li_nodes, ('ins',))
     # Change ins > li into li > ins.
     for ins_tag in ins_tags:
-        distribute(ins_tag)
+        distribute(ins_tag, tree)
     # Change del > li into li.del-li > del.
     for del_tag in del_tags:
-        children = list(del_tag.childNodes)
-        unwrap(del_tag)
+        children = list(tree.child_nodes(del_tag))
+        tree.unwrap(del_tag)
         for c in children:
-            if c.nodeName == 'li':
-                c.setAttribute('class', 'del-li')
-                wrap_inner(c, 'del')
+            if tree.tag_name(c) == 'li':
+                tree.set_attribute(c, 'class', 'del-li')
+                tree.wrap_inner(c, 'del')
 
 
 def fix_tables(dom):
-    _internalize_changes_markup(dom, set(['td', 'th']))
+    tree = as_tree(dom)
+    _internalize_changes_markup(tree, set(['td', 'th']))
 
     # Show table row insertions
-    tags = set()
-    for node in list(dom.getElementsByTagName('tr')):
-        parent = node.parentNode
-        if parent.tagName in ('ins', 'del'):
-            tags.add(parent)
-    for tag in tags:
-        distribute(tag)
+    rows = list(tree.elements_by_tag_name('tr'))
+    for tag in _parents_tagged(tree, rows, ('ins', 'del')):
+        distribute(tag, tree)
     # Show table cell insertions
-    tags = set()
-    for node in list(dom.getElementsByTagName('td') +
-                     dom.getElementsByTagName('th')):
-        parent = node.parentNode
-        if parent.tagName in ('ins', 'del'):
-            tags.add(parent)
-    for tag in tags:
-        distribute(tag)
+    cells = (
+        list(tree.elements_by_tag_name('td')) +
+        list(tree.elements_by_tag_name('th'))
+    )
+    for tag in _parents_tagged(tree, cells, ('ins', 'del')):
+        distribute(tag, tree)
     # All other ins and del tags inside a table but not in a cell are invalid,
     # so remove them.
-    for node in list(dom.getElementsByTagName('ins') +
-                     dom.getElementsByTagName('del')):
-        parent = node.parentNode
-        if parent.tagName in ['table', 'tbody', 'thead', 'tfoot', 'tr']:
-            remove_node(node)
+    changes = (
+        list(tree.elements_by_tag_name('ins')) +
+        list(tree.elements_by_tag_name('del'))
+    )
+    for node in changes:
+        parent = tree.parent(node)
+        if tree.tag_name(parent) in ['table', 'tbody', 'thead', 'tfoot', 'tr']:
+            tree.remove(node)
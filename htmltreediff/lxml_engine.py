@@ -0,0 +1,432 @@
+from StringIO import StringIO
+from xml.dom import Node
+
+import lxml.etree
+import lxml.html
+
+from htmltreediff import html
+from htmltreediff.changes import indexed_dom_diff
+from htmltreediff.util import (
+    NodeIndex,
+    Tree,
+    _write_data,
+    check_text_similarity,
+    parse_lxml,
+    remove_comments,
+    trim_xml,
+)
+
+
+def diff(old_html, new_html, cutoff=0.0, plaintext=False, pretty=False,
+         matcher=None, approximate=None, budget=None, backend='difflib'):
+    """Show the differences between the old and new html document, as html.
+
+    This gives exactly the same output as htmltreediff.html.diff, but parses,
+    diffs and marks up the documents as lxml trees, without ever building a
+    minidom document. Plain text that lxml can't hold, such as text with
+    control characters, is handed over to htmltreediff.html.diff instead.
+    """
+    if budget is not None:
+        budget.start()
+    try:
+        if plaintext:
+            old_root = parse_text_etree(old_html)
+            new_root = parse_text_etree(new_html)
+        else:
+            old_root = parse_etree(old_html)
+            new_root = parse_etree(new_html)
+    except ValueError:
+        if not plaintext:
+            raise
+        return html.diff(
+            old_html,
+            new_html,
+            cutoff,
+            plaintext,
+            pretty,
+            matcher,
+            approximate,
+            budget,
+            backend,
+        )
+
+    index = NodeIndex(
+        children=etree_children,
+        label=etree_label,
+        split_text=True,
+    )
+    old_id = index.add(old_root)
+    new_id = index.add(new_root)
+
+    # If the two documents are not similar enough, don't show the changes.
+    if cutoff > 0 and not check_text_similarity(
+        old_id,
+        new_id,
+        cutoff,
+        index,
+        approximate=approximate,
+        backend=backend,
+    ):
+        return html.too_large_html
+    overlay = Overlay(old_root)
+    indexed_dom_diff(
+        overlay,
+        old_id,
+        new_id,
+        index,
+        matcher,
+        budget,
+        backend,
+    )
+
+    # HTML-specific cleanup.
+    if not plaintext:
+        html.fix_lists(overlay)
+        html.fix_tables(overlay)
+
+    return overlay.tostring(pretty=pretty)
+
+
+# parsing #
+def parse_etree(xml):
+    """
+    Parse html the way parse_minidom does, and return the body element.
+    """
+    xml = remove_comments(xml)
+    xml = xml.strip()
+    return body_element(parse_lxml(xml, strict_xml=False))
+
+
+def body_element(root):
+    """
+    Remove comments and head elements from a parsed lxml tree, the way the
+    conversion to minidom drops them, and return its body element.
+    """
+    # Comments that the regex missed don't survive the conversion to minidom
+    # either, only their tail text does. Which comments those are depends on
+    # the version of libxml2.
+    for comment in list(root.iter(lxml.etree.Comment)):
+        remove_element(comment)
+    for head_element in list(root.iter('head')):
+        remove_element(head_element)
+    if root.tag == 'html':
+        elements = [c for c in root if is_element(c)]
+        if not elements:
+            return lxml.html.Element('body')
+        root = elements[0]
+    assert root.tag == 'body'
+    return root
+
+
+def parse_text_etree(text):
+    root = lxml.html.Element('body')
+    root.text = text
+    return root
+
+
+def remove_element(element):
+    """Remove an element from an lxml tree, but keep its tail text."""
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is None:
+            parent.text = (parent.text or '') + element.tail
+        else:
+            previous.tail = (previous.tail or '') + element.tail
+    parent.remove(element)
+
+
+# reading lxml trees as dom trees #
+def is_element(node):
+    """
+    Whether the node is an element. Text nodes and processing instructions
+    are not.
+    """
+    return (
+        not isinstance(node, (basestring, Text)) and
+        isinstance(node.tag, basestring)
+    )
+
+
+def etree_children(node):
+    """
+    Return the children of an lxml node as a minidom document would have
+    them, with text nodes as plain strings.
+    """
+    if not is_element(node):
+        return []
+    children = []
+    if node.text is not None:
+        children.append(node.text)
+    for child in node:
+        children.append(child)
+        if child.tail is not None:
+            children.append(child.tail)
+    return children
+
+
+def etree_label(node):
+    """Like util.node_label, for the nodes given by etree_children."""
+    if isinstance(node, basestring):
+        return (Node.TEXT_NODE, '#text', node, ())
+    if node.tag is lxml.etree.ProcessingInstruction:
+        return (Node.PROCESSING_INSTRUCTION_NODE, node.target, node.text, ())
+    return (
+        Node.ELEMENT_NODE,
+        node.tag,
+        None,
+        tuple(sorted(node.attrib.items())),
+    )
+
+
+# editing #
+class Text(object):
+    """A text node, in the parts of the tree that have been edited."""
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Overlay(Tree):
+    """
+    Dom-style editing on top of an lxml tree, as a util.Tree.
+
+    The child nodes of an element are read from the lxml tree until the
+    element is first edited, or one of its children is asked for its
+    siblings. Then they are linked up as a list of lxml elements and Text
+    nodes, kept in dicts, so that moving a node takes the same time however
+    many siblings it has. The lxml tree itself is never restructured, so that
+    text and tail strings don't have to be patched up on every move; tostring
+    serializes the combined tree.
+    """
+    def __init__(self, root):
+        self.root = root
+        # The linked elements, with their first and last child.
+        self.first = {}
+        self.last = {}
+        # The parent and siblings of each node of a linked element.
+        self.parents = {}
+        self.next = {}
+        self.previous = {}
+
+    # reading #
+    def _read(self, element):
+        nodes = []
+        if element.text is not None:
+            nodes.append(Text(element.text))
+        for child in element:
+            nodes.append(child)
+            if child.tail is not None:
+                nodes.append(Text(child.tail))
+        return nodes
+
+    def _link(self, element):
+        if element in self.first:
+            return
+        previous = None
+        self.first[element] = None
+        for node in self._read(element):
+            self.parents[node] = element
+            self.previous[node] = previous
+            self.next[node] = None
+            if previous is None:
+                self.first[element] = node
+            else:
+                self.next[previous] = node
+            previous = node
+        self.last[element] = previous
+
+    def _children(self, node):
+        # Read the child nodes without linking them.
+        if node not in self.first:
+            return self._read(node)
+        children = []
+        child = self.first[node]
+        while child is not None:
+            children.append(child)
+            child = self.next[child]
+        return children
+
+    def child_nodes(self, node):
+        if not is_element(node):
+            return []
+        self._link(node)
+        return self._children(node)
+
+    def parent(self, node):
+        if node in self.parents:
+            return self.parents[node]
+        if node is self.root:
+            return None
+        return node.getparent()
+
+    def first_child(self, node):
+        if not is_element(node):
+            return None
+        self._link(node)
+        return self.first[node]
+
+    def next_sibling(self, node):
+        parent = self.parent(node)
+        if parent is None:
+            return None
+        self._link(parent)
+        return self.next[node]
+
+    def previous_sibling(self, node):
+        parent = self.parent(node)
+        if parent is None:
+            return None
+        self._link(parent)
+        return self.previous[node]
+
+    def tag_name(self, node):
+        if is_element(node):
+            return node.tag
+        return None
+
+    def text(self, node):
+        if isinstance(node, Text):
+            return node.data
+        return None
+
+    def attributes(self, node):
+        return dict(node.attrib.items())
+
+    def set_attribute(self, node, key, value):
+        node.set(key, value)
+
+    def elements_by_tag_name(self, tag_name):
+        """Like getElementsByTagName on the document."""
+        elements = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.tag == tag_name:
+                elements.append(node)
+            stack.extend(reversed([
+                c for c in self._children(node) if is_element(c)
+            ]))
+        return elements
+
+    # manipulation #
+    def create_element(self, tag_name):
+        element = self.root.makeelement(tag_name)
+        self.first[element] = None
+        self.last[element] = None
+        self.parents[element] = None
+        return element
+
+    def create_text(self, data):
+        # Fail on missing text the way minidom's createTextNode does.
+        if not isinstance(data, basestring):
+            raise TypeError('node contents must be a string')
+        text = Text(data)
+        self.parents[text] = None
+        return text
+
+    def insert_before(self, parent, node, next_sibling):
+        """
+        Insert the node before next_sibling. If next_sibling is None, append
+        the node last instead.
+        """
+        self.remove(node)
+        self._link(parent)
+        if next_sibling is None:
+            previous = self.last[parent]
+            self.last[parent] = node
+        else:
+            previous = self.previous[next_sibling]
+            self.previous[next_sibling] = node
+        if previous is None:
+            self.first[parent] = node
+        else:
+            self.next[previous] = node
+        self.parents[node] = parent
+        self.previous[node] = previous
+        self.next[node] = next_sibling
+
+    def remove(self, node):
+        """Remove the node from its parent, if it has one."""
+        parent = self.parent(node)
+        if parent is None:
+            return
+        self._link(parent)
+        previous = self.previous.pop(node)
+        next_sibling = self.next.pop(node)
+        if previous is None:
+            self.first[parent] = next_sibling
+        else:
+            self.next[previous] = next_sibling
+        if next_sibling is None:
+            self.last[parent] = previous
+        else:
+            self.previous[next_sibling] = previous
+        self.parents[node] = None
+
+    def normalize(self):
+        """Merge adjacent text nodes and drop empty ones."""
+        for element in list(self.first):
+            texts = []
+            for node in self._children(element) + [None]:
+                if isinstance(node, Text):
+                    texts.append(node)
+                    continue
+                if texts:
+                    self._merge(texts)
+                    texts = []
+
+    def _merge(self, texts):
+        data = ''.join(t.data for t in texts)
+        for text in texts[1:]:
+            self.remove(text)
+        if data:
+            texts[0].data = data
+        else:
+            self.remove(texts[0])
+
+    # serializing #
+    def tostring(self, pretty=False):
+        """Serialize the tree the way util.minidom_tostring does."""
+        writer = StringIO()
+        if pretty:
+            self.writexml(self.root, writer, '', '\t', '\n')
+        else:
+            self.writexml(self.root, writer, '', '', '')
+        return trim_xml(writer.getvalue())
+
+    def writexml(self, node, writer, indent, addindent, newl):
+        # This follows the minidom writexml methods, as patched in util, with
+        # the same stack of nodes and closing tags.
+        stack = [(node, indent)]
+        while stack:
+            node, indent = stack.pop()
+            if node is None:
+                writer.write(indent)
+                continue
+            if isinstance(node, Text):
+                _write_data(writer, "%s%s%s" % (indent, node.data, newl))
+                continue
+            if not is_element(node):
+                writer.write(
+                    "%s<?%s %s?>%s" % (indent, node.target, node.text, newl)
+                )
+                continue
+            writer.write(indent + "<" + node.tag)
+            for a_name, value in sorted(node.attrib.items()):
+                writer.write(" %s=\"" % a_name)
+                _write_data(writer, value)
+                writer.write("\"")
+            children = self._children(node)
+            if not children:
+                writer.write("></%s>%s" % (node.tag, newl))
+            elif len(children) == 1 and isinstance(children[0], Text):
+                writer.write(">")
+                _write_data(writer, children[0].data)
+                writer.write("</%s>%s" % (node.tag, newl))
+            else:
+                writer.write(">" + newl)
+                stack.append((None, "%s</%s>%s" % (indent, node.tag, newl)))
+                for child in reversed(children):
+                    stack.append((child, indent + addindent))
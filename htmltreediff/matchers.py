@@ -0,0 +1,318 @@
+"""
+Sequence matchers for lining up lists of sibling nodes.
+
+A matcher takes two sequences and returns their matching blocks, in the same
+format as difflib.SequenceMatcher.get_matching_blocks: a sorted list of
+(i, j, size) triples, meaning that a[i:i+size] == b[j:j+size], ending with
+the sentinel (len(a), len(b), 0). Items for which isjunk returns true are
+never used to anchor a match.
+
+>>> a = ['one', ' ', 'two', ' ', 'three']
+>>> b = ['one', ' ', 'six', ' ', 'three']
+>>> for name in sorted(matchers):
+...     print name, get_matcher(name)(a, b)
+difflib [(0, 0, 2), (3, 3, 2), (5, 5, 0)]
+histogram [(0, 0, 2), (3, 3, 2), (5, 5, 0)]
+myers [(0, 0, 2), (3, 3, 2), (5, 5, 0)]
+patience [(0, 0, 2), (3, 3, 2), (5, 5, 0)]
+"""
+from bisect import bisect_left
+from difflib import SequenceMatcher
+
+
+def difflib_blocks(a, b, isjunk=None, popular=None):
+    """
+    Match with difflib. This is the default.
+
+    difflib ignores items that are very common in b. To match a window of a
+    longer sequence the way the whole sequence would be matched, pass in the
+    set of items that are popular in the whole sequence.
+    """
+    sm = SequenceMatcher(isjunk, a, b, autojunk=popular is None)
+    if popular:
+        for item in list(sm.b2j):
+            if item in popular:
+                del sm.b2j[item]
+    return [tuple(block) for block in sm.get_matching_blocks()]
+
+
+def myers_blocks(a, b, isjunk=None, popular=None):
+    """
+    Find a longest common subsequence with Myers' O(ND) algorithm, in linear
+    space. Junk items are matched like any other.
+
+    >>> myers_blocks('abcabba', 'cbabac')
+    [(1, 1, 1), (3, 2, 2), (6, 4, 1), (7, 6, 0)]
+    """
+    blocks = []
+    _myers(a, b, 0, len(a), 0, len(b), blocks)
+    return _finish_blocks(blocks, a, b)
+
+
+def patience_blocks(a, b, isjunk=None, popular=None):
+    """
+    Match with patience diff. Items that occur exactly once on both sides
+    anchor the match, and the gaps between anchors are matched recursively.
+    Regions without unique items are matched with myers_blocks.
+
+    >>> patience_blocks(['x', 'a', 'b', 'x'], ['a', 'x', 'b'])
+    [(1, 0, 1), (2, 2, 1), (4, 3, 0)]
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = _trim(a, b, regions.pop(), blocks)
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = unique_anchors(a, b, alo, ahi, blo, bhi, isjunk)
+        if not anchors:
+            _myers(a, b, alo, ahi, blo, bhi, blocks)
+            continue
+        # Each anchor is a match, and splits the region in two.
+        i, j = alo, blo
+        for anchor_i, anchor_j in anchors:
+            blocks.append((anchor_i, anchor_j, 1))
+            regions.append((i, anchor_i, j, anchor_j))
+            i, j = anchor_i + 1, anchor_j + 1
+        regions.append((i, ahi, j, bhi))
+    return _finish_blocks(blocks, a, b)
+
+
+def histogram_blocks(a, b, isjunk=None, popular=None, max_count=64):
+    """
+    Match with histogram diff, as in git. The longest common run through
+    the least frequent item in a anchors the match, and the regions on either
+    side are matched recursively. Items that occur more than max_count times
+    are not used as anchors. Regions with no anchor are matched with
+    myers_blocks.
+
+    >>> histogram_blocks(['x', 'a', 'b', 'x'], ['a', 'x', 'b'])
+    [(1, 0, 1), (2, 2, 1), (4, 3, 0)]
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = _trim(a, b, regions.pop(), blocks)
+        if alo == ahi or blo == bhi:
+            continue
+        positions = {}
+        for i in xrange(alo, ahi):
+            item = a[i]
+            if isjunk is None or not isjunk(item):
+                positions.setdefault(item, []).append(i)
+        best = None  # (count, -size, i, j, size)
+        for j in xrange(blo, bhi):
+            indices = positions.get(b[j])
+            if indices is None or len(indices) > max_count:
+                continue
+            if best is not None and len(indices) > best[0]:
+                continue
+            for i in indices:
+                # Extend the match through i and j both ways.
+                start_i, start_j = i, j
+                while (
+                    start_i > alo and start_j > blo and
+                    a[start_i - 1] == b[start_j - 1]
+                ):
+                    start_i -= 1
+                    start_j -= 1
+                stop_i, stop_j = i + 1, j + 1
+                while stop_i < ahi and stop_j < bhi and a[stop_i] == b[stop_j]:
+                    stop_i += 1
+                    stop_j += 1
+                size = stop_i - start_i
+                candidate = (len(indices), -size, start_i, start_j, size)
+                if best is None or candidate < best:
+                    best = candidate
+        if best is None:
+            _myers(a, b, alo, ahi, blo, bhi, blocks)
+            continue
+        count, _, i, j, size = best
+        blocks.append((i, j, size))
+        regions.append((i + size, ahi, j + size, bhi))
+        regions.append((alo, i, blo, j))
+    return _finish_blocks(blocks, a, b)
+
+
+matchers = {
+    'difflib': difflib_blocks,
+    'myers': myers_blocks,
+    'patience': patience_blocks,
+    'histogram': histogram_blocks,
+}
+
+# The matcher used when none is given. Set this to one of the names in
+# `matchers` to change it globally.
+default_matcher = 'difflib'
+
+
+def get_matcher(matcher=None):
+    """
+    Return a matcher function, given its name or the function itself. If no
+    matcher is given, return the default.
+    """
+    if matcher is None:
+        matcher = default_matcher
+    if callable(matcher):
+        return matcher
+    try:
+        return matchers[matcher]
+    except KeyError:
+        raise ValueError('Unknown matcher: %r' % (matcher,))
+
+
+def _trim(a, b, region, blocks):
+    # Match the common prefix and suffix of a region, and return the rest.
+    alo, ahi, blo, bhi = region
+    i, j = alo, blo
+    while i < ahi and j < bhi and a[i] == b[j]:
+        i += 1
+        j += 1
+    if i > alo:
+        blocks.append((alo, blo, i - alo))
+    size = 0
+    while i < ahi - size and j < bhi - size and \
+            a[ahi - 1 - size] == b[bhi - 1 - size]:
+        size += 1
+    if size:
+        blocks.append((ahi - size, bhi - size, size))
+    return i, ahi - size, j, bhi - size
+
+
+def _myers(a, b, alo, ahi, blo, bhi, blocks):
+    # Split each region at the middle snake of its shortest edit path.
+    regions = [(alo, ahi, blo, bhi)]
+    while regions:
+        alo, ahi, blo, bhi = _trim(a, b, regions.pop(), blocks)
+        if alo == ahi or blo == bhi:
+            continue
+        x, y, u, v = _middle_snake(a, b, alo, ahi, blo, bhi)
+        if u > x:
+            blocks.append((x, y, u - x))
+        regions.append((u, ahi, v, bhi))
+        regions.append((alo, x, blo, y))
+
+
+def _middle_snake(a, b, alo, ahi, blo, bhi):
+    """
+    Return the middle snake (x, y, u, v) of the shortest edit path between
+    a[alo:ahi] and b[blo:bhi], where a[x:u] == b[y:v] is a diagonal run.
+    The region must not start or end with a match.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta % 2 != 0
+    offset = n + m + 1
+    # Furthest x reached on each diagonal k = x - y, searching forward from
+    # the start and backward from the end (in reversed coordinates).
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in xrange((n + m + 1) // 2 + 1):
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (
+                k != d and forward[offset + k - 1] < forward[offset + k + 1]
+            ):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            # Backward diagonal delta - k is forward diagonal k.
+            if odd and -(d - 1) <= delta - k <= d - 1:
+                if x + backward[offset + delta - k] >= n:
+                    return (
+                        alo + start_x, blo + start_y,
+                        alo + x, blo + y,
+                    )
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (
+                k != d and backward[offset + k - 1] < backward[offset + k + 1]
+            ):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + forward[offset + delta - k] >= n:
+                    return (
+                        ahi - x, bhi - y,
+                        ahi - start_x, bhi - start_y,
+                    )
+    raise AssertionError('No middle snake found.')  # pragma: no cover
+
+
+def unique_anchors(a, b, alo, ahi, blo, bhi, isjunk=None):
+    """
+    Find the items that occur exactly once in both a[alo:ahi] and b[blo:bhi],
+    and return the longest run of them that is in the same order on both
+    sides, as a list of (i, j) pairs.
+
+    >>> unique_anchors('abcdx', 'acbdx', 0, 5, 0, 5)
+    [(0, 0), (2, 1), (3, 3), (4, 4)]
+    """
+    def unique_positions(seq, lo, hi):
+        positions = {}
+        for i in xrange(lo, hi):
+            item = seq[i]
+            if isjunk is not None and isjunk(item):
+                continue
+            if item in positions:
+                positions[item] = None
+            else:
+                positions[item] = i
+        return positions
+
+    a_positions = unique_positions(a, alo, ahi)
+    b_positions = unique_positions(b, blo, bhi)
+    pairs = []
+    for j in xrange(blo, bhi):
+        i = a_positions.get(b[j])
+        if i is not None and b_positions.get(b[j]) == j:
+            pairs.append((i, j))
+    pairs.sort()
+
+    # Longest increasing subsequence of j, by patience sorting.
+    tops = []  # the j on top of each pile
+    top_indices = []
+    previous = []
+    for index, (i, j) in enumerate(pairs):
+        pile = bisect_left(tops, j)
+        if pile == len(tops):
+            tops.append(j)
+            top_indices.append(index)
+        else:
+            tops[pile] = j
+            top_indices[pile] = index
+        previous.append(top_indices[pile - 1] if pile else None)
+    anchors = []
+    index = top_indices[-1] if top_indices else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _finish_blocks(blocks, a, b):
+    # Sort the blocks, join adjacent ones, and add the sentinel.
+    blocks.sort()
+    finished = []
+    for i, j, size in blocks:
+        if finished:
+            last_i, last_j, last_size = finished[-1]
+            if last_i + last_size == i and last_j + last_size == j:
+                finished[-1] = (last_i, last_j, last_size + size)
+                continue
+        finished.append((i, j, size))
+    finished.append((len(a), len(b), 0))
+    return finished
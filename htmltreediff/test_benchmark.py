@@ -0,0 +1,59 @@
+from StringIO import StringIO
+
+from nose.tools import assert_equal
+
+from htmltreediff.benchmark import (
+    benchmark_approximate,
+    benchmark_bounds,
+    benchmark_fuzzy,
+    benchmark_ratio,
+    benchmark_tokenize,
+    main,
+)
+from htmltreediff.matchers import matchers
+
+
+def test_main():
+    out = StringIO()
+    main(['benchmark', 'matchers'], out, widths=(50, 100), repeat=1)
+    lines = out.getvalue().splitlines()
+    assert_equal(lines[0], 'matchers')
+    assert_equal(len(lines), 1 + 2 * len(matchers))
+
+
+def test_benchmark_fuzzy():
+    results = list(benchmark_fuzzy(sizes=(30,), repeat=1))
+    assert_equal(len(results), 1)
+    rows, edited, seconds, length, hits, misses = results[0]
+    assert_equal((rows, edited), (60, 5))
+    assert length
+    assert hits + misses
+
+
+def test_benchmark_tokenize():
+    [(characters, tokens, _, _)] = benchmark_tokenize(sizes=(100,), repeat=1)
+    assert characters >= 100
+    assert tokens
+
+
+def test_benchmark_ratio():
+    results = list(benchmark_ratio(widths=(20,), repeat=1))
+    assert_equal([backend for _, _, backend, _, _ in results],
+                 ['difflib', 'lcs'])
+    (_, _, _, _, difflib_ratio), (_, _, _, _, lcs_ratio) = results
+    assert lcs_ratio >= difflib_ratio
+
+
+def test_benchmark_bounds():
+    [result] = benchmark_bounds(sizes=(30,), repeat=1)
+    pairs = result[0]
+    assert_equal(pairs, 30 * 30)
+    assert_equal(sum(result[3:]), pairs)
+
+
+def test_benchmark_approximate():
+    [result] = benchmark_approximate(widths=(20,), edits=5, repeat=1)
+    width, words, _, _, ratio, estimate = result
+    assert_equal(width, 20)
+    assert words
+    assert 0 < estimate <= 1
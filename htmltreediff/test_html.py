@@ -2,8 +2,11 @@ from textwrap import dedent
 
 from nose.tools import assert_equal
 
-from htmltreediff.html import diff
-from htmltreediff.tests import assert_html_equal
+from htmltreediff import Budget, util
+from htmltreediff.benchmark import repetitive_tables, wide_documents
+from htmltreediff.html import diff, too_large_html
+from htmltreediff.lxml_engine import diff as lxml_diff
+from htmltreediff.tests import assert_html_equal, assert_strip_changes
 from htmltreediff.changes import distribute
 from htmltreediff.html import fix_lists, fix_tables
 from htmltreediff.util import (
@@ -180,6 +183,143 @@ def test_cutoff():
     )
 
 
+def test_markup_changes_pass_cutoff():
+    # Changes to the markup alone leave the text as similar as it was.
+    old_html = '<p>one two three four</p>'
+    cases = [
+        '<div><p>one two three four</p></div>',
+        '<blockquote><p>one two three four</p></blockquote>',
+        '<p class="new">one two three four</p>',
+        '<table><tr><td>one two three four</td></tr></table>',
+    ]
+    lists = ('<ul><li>one two</li><li>three four</li></ul>',
+             '<ol><li>one two</li><li>three four</li></ol>')
+    cells = ('<table><tr><td>one two</td><td>three four</td></tr></table>',
+             '<p>one two</p><p>three four</p>')
+    pairs = [(old_html, new_html) for new_html in cases] + [lists, cells]
+    for diff_function in [diff, lxml_diff]:
+        for old_html, new_html in pairs:
+            assert_equal(
+                diff_function(old_html, new_html, cutoff=0.5),
+                diff_function(old_html, new_html),
+            )
+
+
+def test_backend_cutoff():
+    # Wide documents with few changes are similar by the LCS of their words,
+    # but difflib's heuristics miss most of their matching text.
+    old_html, new_html = wide_documents(100, 5)
+    for diff_function in [diff, lxml_diff]:
+        assert_equal(
+            diff_function(old_html, new_html, cutoff=0.5),
+            too_large_html,
+        )
+        assert_equal(
+            diff_function(old_html, new_html, cutoff=0.5, backend='lcs'),
+            diff_function(old_html, new_html, backend='lcs'),
+        )
+
+
+def test_approximate_cutoff():
+    # The estimate turns away documents with nothing in common, and lets
+    # similar ones through to the diff.
+    for diff_function in [diff, lxml_diff]:
+        changes = diff_function(
+            '<h1>totally</h1>',
+            '<h2>different</h2>',
+            cutoff=0.2,
+            approximate=256,
+        )
+        assert_equal(changes, too_large_html)
+        old_html = '<p>one two three</p><p>four five</p>'
+        new_html = '<p>one two three</p><p>four six</p>'
+        assert_equal(
+            diff_function(old_html, new_html, cutoff=0.2, approximate=256),
+            diff_function(old_html, new_html, cutoff=0.2),
+        )
+
+
+def test_budget():
+    # A diff that runs out of budget is flagged as degraded, and still shows
+    # the changes correctly, if more coarsely.
+    old_html = '<p>one two three</p><p>four five six</p>'
+    new_html = '<p>one two seven</p><p>four five six</p>'
+    for diff_function in [diff, lxml_diff]:
+        budget = Budget()
+        changes = diff_function(old_html, new_html, budget=budget)
+        assert not budget.degraded
+        assert_equal(changes, diff_function(old_html, new_html))
+        budget = Budget(comparisons=0)
+        changes = diff_function(old_html, new_html, budget=budget)
+        assert budget.degraded
+        assert_equal(
+            changes,
+            '<del><p>one two three</p></del><ins><p>one two seven</p></ins>'
+            '<p>four five six</p>',
+        )
+        assert_strip_changes(old_html, new_html, changes)
+
+
+def test_budget_clock():
+    # The clock starts over when the diff is called.
+    for diff_function in [diff, lxml_diff]:
+        budget = Budget(seconds=60)
+        budget.started -= 120
+        diff_function('<p>one two</p>', '<p>one three</p>', budget=budget)
+        assert not budget.degraded
+
+
+def test_budget_seconds():
+    # Comparing the text of the tables word by word would take longer than
+    # the time limit, so with a budget the diff estimates it instead.
+    old_html, new_html = repetitive_tables(100)
+    seconds = 0.1
+    text_similarity = util.text_similarity
+    word_pairs = []
+
+    def recording_text_similarity(a, b, index, backend='difflib'):
+        word_pairs.append(len(index.words(a)[0]) * len(index.words(b)[0]))
+        return text_similarity(a, b, index, backend)
+    util.text_similarity = recording_text_similarity
+    try:
+        for diff_function in [diff, lxml_diff]:
+            del word_pairs[:]
+            diff_function(old_html, new_html)
+            assert max(word_pairs) * Budget.word_pair_seconds > seconds
+            del word_pairs[:]
+            diff_function(old_html, new_html, budget=Budget(seconds=seconds))
+            for pairs in word_pairs:
+                assert pairs * Budget.word_pair_seconds <= seconds
+    finally:
+        util.text_similarity = text_similarity
+
+
+def test_budget_exact():
+    # Once the diff falls back to exact matching, it still compares the
+    # children of a node when there are few enough of them for the budget,
+    # and replaces the children that there are too many of.
+    old_html = (
+        '<p>one two three</p><h1>x</h1>'
+        '<div><p>a b c</p><p>d e f</p><p>g h i</p></div>'
+    )
+    new_html = (
+        '<p>one two seven</p><h1>x</h1>'
+        '<div><p>a b z</p><p>d e z</p><p>g h z</p></div>'
+    )
+    for diff_function in [diff, lxml_diff]:
+        budget = Budget(comparisons=3)
+        budget.degrade()
+        changes = diff_function(old_html, new_html, budget=budget)
+        assert_equal(budget.strategy, 'exact')
+        assert_equal(
+            changes,
+            '<p>one two <del>three</del><ins>seven</ins></p><h1>x</h1>'
+            '<div><del><p>a b c</p><p>d e f</p><p>g h i</p></del>'
+            '<ins><p>a b z</p><p>d e z</p><p>g h z</p></ins></div>',
+        )
+        assert_strip_changes(old_html, new_html, changes)
+
+
 def test_html_diff_pretty():
     cases = [
         (
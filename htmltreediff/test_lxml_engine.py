@@ -0,0 +1,101 @@
+import lxml.etree
+from nose.tools import assert_equal, assert_raises
+
+from htmltreediff import html, lxml_engine
+from htmltreediff.tests import all_test_cases
+from htmltreediff.test_util import parse_cases
+
+
+def _diff_or_error(diff, case, **kwargs):
+    try:
+        return diff(case.old_html, case.new_html, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+def test_engines_agree():
+    # The lxml engine gives exactly the same output as the minidom engine.
+    options = [
+        {},
+        {'pretty': True},
+        {'plaintext': True},
+        {'backend': 'lcs'},
+    ]
+    for case in parse_cases(all_test_cases):
+        for kwargs in options:
+            def test():
+                assert_equal(
+                    _diff_or_error(lxml_engine.diff, case, **kwargs),
+                    _diff_or_error(html.diff, case, **kwargs),
+                )
+            test.description = 'test_engines_agree - %s %s' % (
+                case.name,
+                kwargs,
+            )
+            yield test
+
+
+def test_parse_etree():
+    cases = [
+        ('<p>one</p><!-- comment -->tail', '<p>one</p>tail'),
+        ('<html><head><title>t</title></head><body>x</body></html>', 'x'),
+        ('', ''),
+        ('<html><head><title>t</title></head></html>', ''),
+    ]
+    for xml, expected in cases:
+        root = lxml_engine.parse_etree(xml)
+        assert_equal(lxml_engine.Overlay(root).tostring(), expected)
+    # Comments keep their tail text, whether or not they come first in their
+    # parent, and an html element left with no element children gives an
+    # empty body. The trees are built by hand, as libxml2 versions differ in
+    # which comments the regex misses.
+    html_element = lxml.etree.fromstring(
+        '<html><body>a<!--x-->b<em>c</em><!--y-->d</body></html>'
+    )
+    body = lxml_engine.body_element(html_element)
+    assert_equal(lxml.etree.tostring(body), '<body>ab<em>c</em>d</body>')
+    html_element = lxml.etree.fromstring('<html><!--x-->a</html>')
+    body = lxml_engine.body_element(html_element)
+    assert_equal(lxml.etree.tostring(body), '<body/>')
+
+
+def test_engines_agree_on_markup():
+    # Markup that the test cases don't have, and that parses differently in
+    # lxml: processing instructions, comments that the regex misses, and
+    # text that lxml can't hold.
+    cases = [
+        ('<p>a<?php x ?></p>', '<p>b</p>', {}),
+        ('<p>a<?php x ?>c</p>', '<p>a<?php x ?>d</p>', {'pretty': True}),
+        ('<p>a<!--x--!>b</p>', '<p>a c</p>', {}),
+        ('<p><em>a</em><!--x--!>b</p>', '<p><em>a</em> c</p>', {}),
+        ('a\x01b', 'a\x01c', {'plaintext': True}),
+        ('<p>one two three</p>', '<p>four five six</p>', {'cutoff': 0.5}),
+    ]
+    for old_html, new_html, kwargs in cases:
+        assert_equal(
+            lxml_engine.diff(old_html, new_html, **kwargs),
+            html.diff(old_html, new_html, **kwargs),
+        )
+    # Html that lxml won't parse fails in both.
+    declared = u'<?xml version="1.0" encoding="utf-8"?><p>x</p>'
+    for engine in [html, lxml_engine]:
+        assert_raises(ValueError, engine.diff, declared, 'x')
+
+
+def test_overlay():
+    root = lxml_engine.parse_etree('<p>one</p>two<p>three</p>')
+    overlay = lxml_engine.Overlay(root)
+    first, text, last = overlay.child_nodes(root)
+    assert_equal(overlay.next_sibling(root), None)
+    assert_equal(overlay.previous_sibling(root), None)
+    assert_equal(overlay.first_child(text), None)
+    assert_equal(overlay.child_nodes(text), [])
+    # Moving nodes around doesn't touch the lxml tree.
+    overlay.insert_before(root, last, first)
+    overlay.wrap(text, 'em')
+    assert_equal(overlay.previous_sibling(first), last)
+    assert_equal(overlay.tostring(), '<p>three</p><p>one</p><em>two</em>')
+    assert_equal(
+        lxml.etree.tostring(root),
+        '<body><p>one</p>two<p>three</p></body>',
+    )
@@ -0,0 +1,118 @@
+import random
+
+from nose.tools import assert_equal, assert_raises
+
+from htmltreediff.html import diff
+from htmltreediff.matchers import (
+    get_matcher,
+    histogram_blocks,
+    matchers,
+    myers_blocks,
+)
+from htmltreediff.tests import (
+    assert_strip_changes,
+    one_way_test_cases,
+    reverse_test_cases,
+    test_cases,
+)
+from htmltreediff.test_util import parse_cases
+
+
+def lcs_length(a, b):
+    # Length of the longest common subsequence, by dynamic programming.
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in reversed(range(len(a))):
+        for j in reversed(range(len(b))):
+            if a[i] == b[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+    return lengths[0][0]
+
+
+def assert_valid_blocks(blocks, a, b):
+    assert_equal(blocks[-1], (len(a), len(b), 0))
+    i = j = 0
+    for a_start, b_start, size in blocks[:-1]:
+        assert size > 0
+        assert a_start >= i and b_start >= j, blocks
+        assert_equal(a[a_start:a_start + size], b[b_start:b_start + size])
+        i = a_start + size
+        j = b_start + size
+
+
+def random_sequences(count):
+    rand = random.Random(0)
+    for _ in range(count):
+        alphabet = 'abcdefgh'[:rand.randint(1, 8)]
+        yield (
+            ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 20))),
+            ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 20))),
+        )
+
+
+def test_matching_blocks():
+    for name in sorted(matchers):
+        def test():
+            matcher = get_matcher(name)
+            for a, b in random_sequences(200):
+                assert_valid_blocks(matcher(a, b), a, b)
+        test.description = 'test_matching_blocks - %s' % name
+        yield test
+
+
+def test_myers_is_optimal():
+    for a, b in random_sequences(200):
+        blocks = myers_blocks(a, b)
+        assert_equal(sum(size for _, _, size in blocks), lcs_length(a, b))
+
+
+def test_junk_does_not_anchor():
+    a = [' ', 'one', ' ']
+    b = [' ', 'two', ' ']
+    for name in ['patience', 'histogram']:
+        blocks = get_matcher(name)(a, b, lambda item: item == ' ')
+        # Junk is only matched in the common prefix and suffix.
+        assert_equal(blocks, [(0, 0, 1), (2, 2, 1), (3, 3, 0)])
+
+
+def test_histogram_max_count():
+    # Items that occur too often don't anchor the match, so the region is
+    # left to myers_blocks.
+    a = ['x', 'a', 'x']
+    b = ['b', 'x', 'c']
+    assert_equal(histogram_blocks(a, b), [(0, 1, 1), (3, 3, 0)])
+    assert_equal(histogram_blocks(a, b, max_count=1), myers_blocks(a, b))
+
+
+def test_get_matcher():
+    assert get_matcher() is matchers['difflib']
+    assert get_matcher(myers_blocks) is myers_blocks
+    assert_raises(ValueError, get_matcher, 'nonexistent')
+
+
+def _strips_cleanly(case, matcher=None):
+    changes = diff(case.old_html, case.new_html, matcher=matcher)
+    try:
+        assert_strip_changes(case.old_html, case.new_html, changes)
+    except AssertionError:
+        return False
+    return True
+
+
+def test_diff_with_matchers():
+    # Every matcher gives a correct diff, if not always the same one. Table
+    # and list fixups can add cells and items that don't strip away, so only
+    # the cases that strip cleanly with the default matcher are checked.
+    cases = test_cases + reverse_test_cases + one_way_test_cases
+    cases = [case for case in parse_cases(cases) if _strips_cleanly(case)]
+    for name in sorted(matchers):
+        for case in cases:
+            def test():
+                changes = diff(case.old_html, case.new_html, matcher=name)
+                assert_strip_changes(case.old_html, case.new_html, changes)
+            test.description = 'test_diff_with_matchers - %s - %s' % (
+                name,
+                case.name,
+            )
+            yield test
@@ -1,8 +1,22 @@
 # coding: utf8
-from nose.tools import assert_equal
+import random
+from collections import Counter
 
+from nose.tools import assert_equal, assert_raises
+
+import htmltreediff.text
 from htmltreediff.html import diff
-from htmltreediff.text import split_text
+from htmltreediff.text import (
+    Vocabulary,
+    WordMatcher,
+    _word_split_regexes,
+    lcs_match_length,
+    lcs_matches,
+    multi_split,
+    shingle_sketch,
+    sketch_similarity,
+    split_text,
+)
 
 
 def test_text_split():
@@ -42,6 +56,191 @@ def test_text_split():
         yield test
 
 
+def test_split_text_matches_multi_split():
+    # split_text gives the same tokens as splitting by each of the word split
+    # regexes in turn, including where tokens of different kinds run into
+    # each other.
+    rand = random.Random(0)
+    pieces = list(
+        u"0123456789-/&#;_'aAdeIilmMnrsStTv \t\n\xa0.,\u2013\xfc\u0663"
+    ) + [
+        u"I'm", u"we're", u"she'd", u"can't", u"they'll", u'&amp;', u'&#160;',
+        u'1-2', u'3/4',
+    ]
+    for _ in range(2000):
+        text = u''.join(
+            rand.choice(pieces) for _ in range(rand.randint(0, 30))
+        )
+        for value in [text, text.encode('utf8')]:
+            assert_equal(
+                split_text(value),
+                multi_split(value, _word_split_regexes),
+            )
+
+
+def weighted_lcs_length(a, b, weight):
+    # The weighted LCS, by dynamic programming.
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in reversed(range(len(a))):
+        for j in reversed(range(len(b))):
+            lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+            if a[i] == b[j]:
+                lengths[i][j] = max(
+                    lengths[i][j],
+                    lengths[i + 1][j + 1] + weight(a[i]),
+                )
+    return lengths[0][0]
+
+
+def random_word_lists(count):
+    rand = random.Random(0)
+    words = 'the a of quick brown fox jumps over lazy dog'.split() + [' ']
+    for _ in range(count):
+        a = [rand.choice(words) for _ in range(rand.randint(0, 40))]
+        b = list(a)
+        for _ in range(rand.randint(0, 10)):
+            i = rand.randint(0, len(b))
+            if rand.random() < 0.5:
+                b.insert(i, rand.choice(words))
+            elif i < len(b):
+                del b[i]
+        yield a, b
+
+
+def test_lcs_matches():
+    # The matches are a common subsequence, as long as any, also when the
+    # sequences are split up to keep fewer traceback bits.
+    traceback_bits = htmltreediff.text._lcs_traceback_bits
+    try:
+        for bits in [traceback_bits, 1, 20]:
+            htmltreediff.text._lcs_traceback_bits = bits
+            for a, b in random_word_lists(100):
+                matches = lcs_matches(a, b)
+                assert_equal(
+                    len(matches),
+                    weighted_lcs_length(a, b, lambda item: 1),
+                )
+                for i, j in matches:
+                    assert_equal(a[i], b[j])
+                for (i1, j1), (i2, j2) in zip(matches, matches[1:]):
+                    assert i1 < i2 and j1 < j2
+    finally:
+        htmltreediff.text._lcs_traceback_bits = traceback_bits
+
+
+def test_lcs_match_length():
+    # Weighing the longest common subsequence only rarely comes out lighter
+    # than the heaviest one.
+    lighter = 0
+    for a, b in random_word_lists(200):
+        length = lcs_match_length(a, b, len)
+        heaviest = weighted_lcs_length(a, b, len)
+        assert length <= heaviest
+        lighter += length < heaviest
+    assert lighter < 10
+
+
+def test_lcs_word_matcher_index():
+    # The LCS backend doesn't index the words for difflib, unless the
+    # matching blocks are asked for.
+    a = ['one', ' ', 'two', ' ', 'three']
+    b = ['one', ' ', 'four', ' ', 'three']
+    matcher = WordMatcher(a=a, b=b, backend='lcs')
+    assert_equal('%.3f' % matcher.text_ratio(), '0.696')
+    assert_equal(matcher.b2j, None)
+    assert_equal(
+        matcher.get_matching_blocks(),
+        WordMatcher(a=a, b=b).get_matching_blocks(),
+    )
+    matcher.set_seq2(a)
+    assert_equal(matcher.b2j, None)
+    assert_equal(matcher.text_ratio(), 1.0)
+
+
+def test_word_matcher_vocabulary():
+    # Matching word ids gives the same ratios as matching the words.
+    for a, b in random_word_lists(50):
+        vocabulary = Vocabulary()
+        assert_equal(
+            WordMatcher(
+                a=vocabulary.intern(a),
+                b=vocabulary.intern(b),
+                vocabulary=vocabulary,
+            ).text_ratio(),
+            WordMatcher(a=a, b=b).text_ratio(),
+        )
+
+
+def test_lcs_text_ratio_deviation():
+    # The LCS backend finds about as much matching text as difflib, or more.
+    # Most of the time it is the same, but difflib can miss a lot where it
+    # won't line up stopwords, so only the typical deviation is bounded.
+    deviations = []
+    for a, b in random_word_lists(500):
+        difflib_ratio = WordMatcher(a=a, b=b).text_ratio()
+        lcs_ratio = WordMatcher(a=a, b=b, backend='lcs').text_ratio()
+        assert lcs_ratio >= difflib_ratio - 0.05
+        deviations.append(lcs_ratio - difflib_ratio)
+    deviations.sort()
+    assert sum(deviations) / len(deviations) < 0.02
+    assert deviations[len(deviations) * 9 // 10] < 0.02
+
+
+def weighted_jaccard(a, b, weight):
+    # The weight in common over the weight of either, counting repeats.
+    a_counts = Counter(word for word in a if weight(word))
+    b_counts = Counter(word for word in b if weight(word))
+    common = sum(
+        weight(word) * min(count, b_counts[word])
+        for word, count in a_counts.items()
+    )
+    either = sum(
+        weight(word) * max(a_counts[word], b_counts[word])
+        for word in set(a_counts) | set(b_counts)
+    )
+    return float(common) / either if either else 1.0
+
+
+def test_sketch_similarity():
+    # The estimates stay within a few standard errors of the weighted Jaccard
+    # similarity, about 0.03 for 256 samples.
+    rand = random.Random(0)
+    vocabulary = ['w%d' % i for i in range(200)] + ['the', 'a', ' ']
+    weight = WordMatcher()._weight
+    errors = []
+    for _ in range(100):
+        a = [rand.choice(vocabulary) for _ in range(rand.randint(500, 1000))]
+        keep = rand.random()
+        b = [
+            word if rand.random() < keep else rand.choice(vocabulary)
+            for word in a
+        ]
+        estimate = sketch_similarity(
+            shingle_sketch(a, weight),
+            shingle_sketch(b, weight),
+        )
+        errors.append(abs(estimate - weighted_jaccard(a, b, weight)))
+    errors.sort()
+    assert max(errors) < 0.1
+    assert errors[len(errors) * 9 // 10] < 0.05
+
+
+def test_sketch_similarity_shingles():
+    # Single words ignore order, and longer shingles don't.
+    one_two = shingle_sketch(['one', 'two'], len)
+    two_one = shingle_sketch(['two', 'one'], len)
+    assert_equal(sketch_similarity(one_two, two_one), 1.0)
+    one_two = shingle_sketch(['one', 'two'], len, shingle=2)
+    two_one = shingle_sketch(['two', 'one'], len, shingle=2)
+    assert sketch_similarity(one_two, two_one) < 1.0
+    three = shingle_sketch(['three'], len, shingle=2)
+    assert_equal(sketch_similarity(one_two, three), 0.0)
+
+
+def test_unknown_backend():
+    assert_raises(ValueError, WordMatcher, backend='nonexistent')
+
+
 def test_text_diff():
     cases = [
         (
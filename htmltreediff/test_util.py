@@ -1,12 +1,35 @@
-from htmltreediff.diff_core import Differ
-from htmltreediff.edit_script_runner import EditScriptRunner
+import random
+from xml.dom import NotFoundErr
+
+from nose.tools import assert_equal, assert_raises
+
+from htmltreediff import util
+from htmltreediff.diff_core import (
+    Budget,
+    Differ,
+    common_affixes,
+    location_handle,
+    location_list,
+    match_blocks,
+    match_node_hash,
+    popular_digests,
+)
+from htmltreediff.edit_script_runner import EditScriptRunner, LocationCache
 from htmltreediff.changes import (
+    diff_index,
+    indexed_dom_diff,
     split_text_nodes,
     sort_del_before_ins,
     _strip_changes_new,
     _strip_changes_old,
 )
 from htmltreediff.util import (
+    DomTree,
+    NodeIndex,
+    SimilarityCascade,
+    check_text_similarity,
+    dissimilar_pairs,
+    get_location,
     minidom_tostring,
     node_compare,
     parse_minidom,
@@ -113,5 +136,619 @@ def parse_cases(cases):
 def test_node_compare():
     del_node = list(walk_dom(parse_minidom('<del/>')))[-1]
     ins_node = list(walk_dom(parse_minidom('<ins/>')))[-1]
+    text_node = list(walk_dom(parse_minidom('text')))[-1]
     assert -1 == node_compare(del_node, ins_node)
     assert 1 == node_compare(ins_node, del_node)
+    assert 0 == node_compare(text_node, del_node)
+
+
+def test_parse_minidom_clean():
+    dom = parse_minidom(
+        u'<p>a&nbsp;b\n<span>c</span> <font>d</font><style>x</style></p>',
+        clean=True,
+    )
+    assert_equal(minidom_tostring(dom), '<p>a b c d</p>')
+
+
+def test_minidom_child_nodes():
+    # Children are found by identity, as they were before minidom was
+    # patched to do that faster.
+    dom = parse_minidom('<p>one</p><p>one</p><p>one</p>')
+    body = dom.documentElement
+    first, second, third = body.childNodes
+    body.removeChild(second)
+    assert_equal(list(body.childNodes), [first, third])
+    body.insertBefore(second, third)
+    assert_equal(list(body.childNodes), [first, second, third])
+    other = parse_minidom('<p>one</p>').documentElement.firstChild
+    assert_raises(NotFoundErr, body.removeChild, other)
+
+
+def test_walk_dom_elements_only():
+    dom = parse_minidom('<p>one <em>two</em></p>')
+    assert_equal(
+        [node.nodeName for node in walk_dom(dom, elements_only=True)],
+        ['body', 'p', 'em'],
+    )
+
+
+def test_hashable_trees_without_index():
+    # Dom nodes can be compared without an index, or a memo.
+    a = parse_minidom('<p>one two three</p>').documentElement
+    b = parse_minidom('<p>one two three</p>').documentElement
+    c = parse_minidom('<p>one two four</p>').documentElement
+    d = parse_minidom('<p>five six seven</p>').documentElement
+    assert util.HashableTree(a) == util.HashableTree(b)
+    assert not util.HashableTree(a) == util.HashableTree(c)
+    assert util.FuzzyHashableTree(a) == util.FuzzyHashableTree(c)
+    assert not util.FuzzyHashableTree(a) == util.FuzzyHashableTree(d)
+    index = NodeIndex()
+    a_id, d_id = index.add(a), index.add(d)
+    assert not (
+        util.FuzzyHashableTree(a_id, index) ==
+        util.FuzzyHashableTree(d_id, index)
+    )
+    assert check_text_similarity(a, c, 0.5)
+    assert not check_text_similarity(a, d, 0.5)
+
+
+def random_paragraphs(count):
+    rand = random.Random(0)
+    words = 'the one two three four five six seven eight nine'.split()
+    index = NodeIndex()
+    nodes = []
+    for _ in range(count):
+        text = ' '.join(
+            rand.choice(words) for _ in range(rand.randint(0, 8))
+        )
+        nodes.append(index.add(parse_minidom('<p>%s</p>' % text)))
+    return index, nodes
+
+
+def test_dissimilar_pairs():
+    # Pairs are only ruled out if their text really isn't similar.
+    index, nodes = random_paragraphs(60)
+    a_nodes, b_nodes = nodes[:30], nodes[30:]
+    dissimilar = dissimilar_pairs(a_nodes, b_nodes, 0.4, index)
+    assert dissimilar
+    for a in a_nodes:
+        for b in b_nodes:
+            if (a, b) in dissimilar:
+                assert not check_text_similarity(a, b, 0.4, index)
+    assert_equal(dissimilar_pairs([], b_nodes, 0.4, index), set())
+
+
+def test_similarity_cascade():
+    # The bounds only reject pairs that really aren't similar, and every
+    # pair is either rejected by one stage or accepted.
+    index, nodes = random_paragraphs(60)
+    cascade = SimilarityCascade(index)
+    pairs = [(a, b) for a in nodes for b in nodes]
+    for a, b in pairs:
+        ratio = util.text_similarity(a, b, index)
+        similar, cascade_ratio = cascade.similar(a, b, 0.4)
+        assert_equal(similar, ratio >= 0.4)
+        if cascade_ratio is not None:
+            assert_equal(cascade_ratio, ratio)
+    assert_equal(
+        sum(cascade.rejected.values()) + cascade.accepted,
+        len(pairs),
+    )
+    assert cascade.rejected['length']
+    assert cascade.rejected['bitset']
+
+
+def test_dissimilar_pairs_numpy():
+    # The numpy and pure python versions agree, on pairs with and without
+    # any text.
+    index, nodes = random_paragraphs(60)
+    a_nodes, b_nodes = nodes[:30], nodes[30:]
+    dissimilar = dissimilar_pairs(a_nodes, b_nodes, 0.4, index)
+    assert_equal(
+        util._dissimilar_numpy(a_nodes, b_nodes, 0.4, index),
+        dissimilar,
+    )
+    numpy = util.numpy
+    util.numpy = None
+    try:
+        assert_equal(
+            dissimilar_pairs(a_nodes, b_nodes, 0.4, index),
+            dissimilar,
+        )
+    finally:
+        util.numpy = numpy
+
+
+def test_differ_memo():
+    # Similarity results only last as long as the diff.
+    old_dom = parse_minidom('<p>one two three</p><p>four five six</p>')
+    new_dom = parse_minidom('<p>one two seven</p><p>four five eight</p>')
+    differ = Differ(old_dom, new_dom)
+    differ.get_edit_script()
+    assert differ.memo.misses
+    assert_equal(differ.memo.results, {})
+
+
+def test_similarity_memo_cutoffs():
+    # A remembered ratio, bound or rule out only answers for the cutoffs it
+    # decides.
+    index = NodeIndex()
+    a = index.add(parse_minidom('<p>one two three</p>'))
+    b = index.add(parse_minidom('<p>one two four</p>'))
+    c = index.add(parse_minidom(
+        '<p>one two three four five six seven eight nine</p>'
+    ))
+    memo = util.SimilarityMemo(index)
+    assert memo.similar(a, b, 0.5)
+    assert not memo.similar(a, b, 0.6)
+    # The length bound rules a and c out at 0.5, but not at 0.4.
+    assert not memo.similar(a, c, 0.5)
+    assert memo.similar(a, c, 0.4)
+    assert memo.similar(a, c, 0.45)
+    assert_equal((memo.hits, memo.misses), (2, 3))
+    memo.rule_out([(b, c)], 0.4)
+    assert not memo.similar(c, b, 0.5)
+    assert memo.similar(b, c, 0.1)
+    assert_equal(memo.ruled_out, 1)
+    # Text is compared with the memo's backend.
+    memo = util.SimilarityMemo(index, backend='lcs')
+    assert memo.similar(a, c, 0.4)
+    assert_equal(
+        memo.results[(a, c)],
+        (util.text_similarity(a, c, index, 'lcs'), True),
+    )
+    # Once the budget falls back to exact matching, new pairs are still
+    # compared, and once it falls back to replacing blocks, they aren't.
+    budget = Budget()
+    budget.degrade()
+    memo = util.SimilarityMemo(index, budget)
+    assert memo.similar(a, b, 0.5)
+    budget.degrade()
+    assert not memo.similar(a, c, 0.4)
+    assert_equal(memo.misses, 1)
+    # A pair that the time left can't cover is estimated instead.
+    memo = util.SimilarityMemo(index, Budget(seconds=0))
+    memo.similar(a, c, 0.4)
+    assert_equal(
+        memo.results[(a, c)],
+        (util.approximate_text_similarity(a, c, index), True),
+    )
+
+
+def test_similarity_memo_bound():
+    # The pairs in a bounded group that aren't ruled out skip the bounds of
+    # the cascade, and get the same answers as without the group.
+    index, nodes = random_paragraphs(40)
+    memo = util.SimilarityMemo(index)
+    word_pairs = memo.bound(nodes, nodes[20:], 0.4)
+    assert_equal(word_pairs, sum(
+        len(index.words(a)[0]) * len(index.words(b)[0])
+        for a in nodes
+        for b in nodes[20:]
+        if (a, b) not in memo.dissimilar
+    ))
+    for a in nodes:
+        for b in nodes[20:]:
+            assert_equal(
+                memo.similar(a, b, 0.4),
+                util.text_similarity(a, b, index) >= 0.4,
+            )
+    assert memo.ruled_out
+    rejected = memo.cascade.rejected
+    assert_equal(rejected['length'] + rejected['bitset'], 0)
+    assert_equal(rejected['multiset'], 0)
+    assert memo.cascade.accepted
+
+
+def test_differ_budget():
+    # Out of budget, the diff falls back to exact matching and then to
+    # replacing blocks, and the edit script still turns the old document
+    # into the new one.
+    div = '<div><p>%s one two three</p><p>%s four five six</p></div>'
+    old_html = ''.join(div % (letter, letter) for letter in 'abc')
+    new_html = old_html.replace('three', 'seven')
+    cases = [
+        (Budget(), 'full'),
+        (Budget(comparisons=0), 'exact'),
+        (Budget(comparisons=3), 'exact'),
+        (Budget(nodes=7), 'replace'),
+        (Budget(seconds=0), 'exact'),
+    ]
+    for budget, strategy in cases:
+        old_dom = parse_minidom(old_html)
+        new_dom = parse_minidom(new_html)
+        split_text_nodes(old_dom)
+        split_text_nodes(new_dom)
+        edit_script = Differ(old_dom, new_dom, budget=budget).get_edit_script()
+        assert_equal(budget.strategy, strategy)
+        assert_equal(
+            html_patch(old_html, edit_script),
+            minidom_tostring(parse_minidom(new_html)),
+        )
+        if strategy == 'full':
+            assert_equal(edit_script, get_edit_script(old_html, new_html))
+
+
+def test_differ_budget_wide():
+    # A wide node is only matched if the budget can afford its children once
+    # more, and otherwise it is replaced, together with the rest of the tree.
+    old_html = ''.join('<p>%d</p>' % i for i in range(300))
+    new_html = old_html.replace('<p>1</p>', '<p>one</p>')
+    new_html = new_html.replace('<p>290</p>', '')
+    for nodes, strategy in [(2000, 'full'), (1000, 'replace')]:
+        budget = Budget(nodes=nodes)
+        old_dom = parse_minidom(old_html)
+        new_dom = parse_minidom(new_html)
+        split_text_nodes(old_dom)
+        split_text_nodes(new_dom)
+        edit_script = Differ(old_dom, new_dom, budget=budget).get_edit_script()
+        assert_equal(budget.strategy, strategy)
+        assert_equal(
+            html_patch(old_html, edit_script),
+            minidom_tostring(parse_minidom(new_html)),
+        )
+    budget = Budget(seconds=1)
+    budget.spend(nodes=10)
+    assert budget.affords(nodes=10)
+    budget.started -= 0.6
+    assert not budget.affords(nodes=10)
+    assert budget.affords(comparisons=10)
+    assert budget.affords(word_pairs=0.3 / Budget.word_pair_seconds)
+    assert not budget.affords(word_pairs=0.5 / Budget.word_pair_seconds)
+    assert not Budget(comparisons=5).affords(comparisons=10)
+
+
+def test_differ_budget_gap():
+    # A gap whose children have more pairs of words that the bounds let
+    # through than the time left can compare falls back to exact matching.
+    # A single pair is left to the memo.
+    def paragraph(letter, changed):
+        # Numbers spelled with letters, so that they are single words that
+        # the paragraphs don't share.
+        return '<p>%s</p>' % ' '.join(
+            'changed' if i == changed else
+            letter + ''.join('abcdefghij'[int(d)] for d in '%03d' % i)
+            for i in range(1000)
+        )
+    old_html = paragraph('a', None) + paragraph('b', None)
+    new_html = paragraph('a', 500) + paragraph('b', 500)
+    index = NodeIndex()
+    old_children, new_children = affix_children(old_html, new_html, index)
+    # Each new paragraph is paired with the old one and with itself.
+    seconds = Budget.word_pair_seconds * sum(
+        len(index.words(a)[0]) * len(index.words(b)[0])
+        for a, b in zip(old_children + new_children, new_children * 2)
+    )
+    for budget, affords in [
+        (Budget(seconds=2 * seconds), True),
+        (Budget(seconds=seconds / 2), False),
+    ]:
+        differ = Differ(None, None, index=index, budget=budget)
+        budget.start()
+        assert differ.bound_gap(old_children[:1], new_children[:1])
+        assert_equal(differ.bound_gap(old_children, new_children), affords)
+        assert_equal(budget.degraded, not affords)
+
+
+def affix_children(old_html, new_html, index):
+    old_root = index.add(parse_minidom('<div>%s</div>' % old_html))
+    new_root = index.add(parse_minidom('<div>%s</div>' % new_html))
+    return (
+        index.children(index.children(old_root)[0]),
+        index.children(index.children(new_root)[0]),
+    )
+
+
+def test_common_affixes():
+    cases = [
+        # Junk at the edge goes to the window, with the nodes before it.
+        ('<p>one</p><br/><p>six</p>', '<p>one</p><br/><p>new</p>', (0, 0)),
+        ('<p>one</p><p>two</p><br/><p>six</p>',
+         '<p>one</p><p>two</p><br/><p>new</p>', (0, 0)),
+        ('<p>one</p><br/><p>two</p><p>six</p>',
+         '<p>one</p><br/><p>two</p><p>new</p>', (3, 0)),
+        # An affix of only junk is left out.
+        ('<br/>', '<p>x</p><br/>', (0, 0)),
+        ('<br/><p>one</p><br/><p>six</p>',
+         '<br/><p>one</p><br/><p>new</p>', (0, 0)),
+        ('<p>a</p><p>one</p>', '<p>a</p><p>two</p>', (0, 0)),
+        # The affix covers the whole shorter list.
+        ('<p>one</p><p>two</p>', '<p>one</p><p>two</p><p>six</p>', (2, 0)),
+        ('<p>two</p>', '<p>one</p><p>two</p>', (0, 1)),
+        ('<p>one</p><br/>', '<p>one</p><br/><p>six</p>', (0, 0)),
+        # A node that comes again past the affix ends it, and the nodes
+        # before it go to the window as they would for junk.
+        ('<p>one</p><p>two</p><p>six</p>',
+         '<p>one</p><p>two</p><p>new</p><p>two</p>', (0, 0)),
+        ('<p>one</p><br/><p>two</p><p>six</p><p>ten</p>',
+         '<p>one</p><br/><p>two</p><p>six</p><p>new</p><p>six</p>', (2, 0)),
+        # The prefix and suffix could overlap.
+        ('<p>one</p><p>two</p>',
+         '<p>one</p><p>two</p><p>one</p><p>two</p>', (0, 0)),
+        ('<p>one</p><p>two</p><p>six</p>',
+         '<p>one</p><p>two</p><p>six</p><p>six</p>', (0, 0)),
+    ]
+    for old_html, new_html, affixes in cases:
+        index = NodeIndex()
+        old_children, new_children = affix_children(old_html, new_html, index)
+        assert_equal(
+            common_affixes(old_children, new_children, index),
+            affixes,
+        )
+
+
+def test_common_affixes_match_blocks():
+    # Matching the window between the affixes matches the same nodes as
+    # matching the whole lists does.
+    rand = random.Random(0)
+    pieces = [
+        '<p>one</p>', '<p>two</p>', '<p>six</p>', '<p>one two</p>', '<br/>',
+        '<hr/>', '<p>a</p>', ' ', 'x', '<b>y</b>',
+    ]
+
+    def random_html(count):
+        return ''.join(rand.choice(pieces) for _ in range(count))
+
+    def matches(blocks):
+        return set(
+            (a + k, b + k) for a, b, size in blocks for k in range(size)
+        )
+
+    pairs = []
+    for _ in range(1000):
+        old_html = random_html(rand.randint(0, 12))
+        if rand.random() < 0.7:
+            new_html = (
+                random_html(rand.randint(0, 3)) + old_html +
+                random_html(rand.randint(0, 3))
+            )
+        else:
+            new_html = random_html(rand.randint(0, 12))
+        pairs.append((old_html, new_html))
+    # Lists long enough for difflib to treat popular nodes as junk.
+    long_html = (
+        ''.join('<p>%d</p>' % i for i in range(20)) + '<br/><p>x</p>' +
+        '<p>one</p>' * 200 + '%s<p>y</p>'
+    )
+    pairs.append((long_html % '<p>two</p>', long_html % '<p>six</p>'))
+    for old_html, new_html in pairs:
+        index = NodeIndex()
+        old_children, new_children = affix_children(old_html, new_html, index)
+        prefix, suffix = common_affixes(old_children, new_children, index)
+        old_stop = len(old_children) - suffix
+        new_stop = len(new_children) - suffix
+        assert old_stop >= prefix and new_stop >= prefix
+        popular = None
+        if prefix or suffix:
+            popular = popular_digests(new_children, index) or set()
+        window_blocks = match_blocks(
+            match_node_hash,
+            old_children[prefix:old_stop],
+            new_children[prefix:new_stop],
+            index,
+            popular=popular,
+        )
+        blocks = [(0, 0, prefix), (old_stop, new_stop, suffix)] + [
+            (prefix + a, prefix + b, size) for a, b, size in window_blocks
+        ]
+        assert_equal(
+            matches(blocks),
+            matches(match_blocks(
+                match_node_hash,
+                old_children,
+                new_children,
+                index,
+            )),
+        )
+
+
+def test_index_tokens():
+    # The token arrays split each text node just like split_text, even when
+    # nodes are added to the index after it has been tokenized.
+    index, nodes = random_paragraphs(20)
+    index.words(nodes[0])
+    nodes.append(index.add(parse_minidom(
+        u"<p>Don't call 555-1234 <b>after</b> 10/2, Bob&amp;co \xfcber</p>"
+    )))
+    start, stop = index.tokens(nodes[-1])
+    assert start < stop == len(index.token_start)
+    for text_node in index.text_nodes:
+        start, stop = index.tokens(text_node)
+        value = index.text_value(text_node)
+        assert_equal(
+            [
+                index.text_buffer[index.token_start[i]:index.token_stop[i]]
+                for i in range(start, stop)
+            ],
+            util.split_text(value),
+        )
+        assert_equal(list(index.token_nodes[start:stop]),
+                     [text_node] * (stop - start))
+    for node in nodes:
+        assert_equal(
+            [index.vocabulary.words[i] for i in index.words(node)[0]],
+            [
+                word.strip() for word in util.split_text(index.text_buffer[
+                    index.text_start[node]:index.text_stop[node]
+                ]) if word.strip()
+            ],
+        )
+
+
+def test_split_index_tokens():
+    # A split index has one text node per token, and the same words as an
+    # index of the whole text nodes, without tokenizing again.
+    html = u"<p>Don't call 555-1234 <b>after</b> 10/2, Bob&amp;co \xfcber</p>"
+    index = diff_index()
+    root = index.add(parse_minidom(html))
+    assert_equal(index.tokenized, len(index.text_nodes))
+    for text_node in index.text_nodes:
+        start, stop = index.tokens(text_node)
+        assert_equal(stop - start, 1)
+        assert_equal(
+            index.text_buffer[index.token_start[start]:index.token_stop[start]],
+            index.text_value(text_node),
+        )
+    whole_index = NodeIndex()
+    whole_root = whole_index.add(parse_minidom(html))
+    assert_equal(
+        [index.vocabulary.words[i] for i in index.words(root)[0]],
+        [whole_index.vocabulary.words[i]
+         for i in whole_index.words(whole_root)[0]],
+    )
+
+
+def test_split_text_lazily():
+    # Running the edit script on a dom with whole text nodes gives the same
+    # result as on a split dom, and only splits the text that changed.
+    old_html = '<p>one two three</p><p>four five six</p>'
+    new_html = '<p>one two three</p><p>four seven six</p>'
+    edit_script = get_edit_script(old_html, new_html)
+    index = diff_index()
+    old_root = index.add(parse_minidom(old_html))
+    new_root = index.add(parse_minidom(new_html))
+    assert_equal(
+        Differ(old_root, new_root, index=index).get_edit_script(),
+        edit_script,
+    )
+    old_dom = parse_minidom(old_html)
+    runner = EditScriptRunner(old_dom, edit_script, split_text=True)
+    dom = runner.run_edit_script()
+    assert_equal(minidom_tostring(dom), html_patch(old_html, edit_script))
+    first, second = dom.getElementsByTagName('p')
+    assert_equal(len(first.childNodes), 1)
+    assert_equal(len(second.childNodes), 5)
+
+
+def test_markup_splits_edited_text():
+    # Marking up changes as the diff finds them only splits the text nodes
+    # that are edited. Inserting before the first word of a text node doesn't
+    # split it.
+    class SplitRecordingTree(DomTree):
+        def split_text(self, node, pieces):
+            split.append(node.data)
+            return DomTree.split_text(self, node, pieces)
+    cases = [
+        (
+            '<p>one two three</p><p>four five six</p>',
+            '<p>one two three</p><p>four seven six</p>',
+            '<p>one two three</p><p>four <del>five</del><ins>seven</ins> six'
+            '</p>',
+            [u'four five six'],
+        ),
+        (
+            '<p><em>a</em>one two</p><p>three four</p>',
+            '<p><em>a</em>new one two</p><p>three four</p>',
+            '<p><em>a</em><ins>new </ins>one two</p><p>three four</p>',
+            [],
+        ),
+        (
+            '<p>one two three</p>',
+            '<p>one two</p>',
+            '<p>one two<del> three</del></p>',
+            [u'one two three'],
+        ),
+    ]
+    for old_html, new_html, changes_html, split_texts in cases:
+        split = []
+        old_dom = parse_minidom(old_html)
+        index = diff_index()
+        old_root = index.add(old_dom)
+        new_root = index.add(parse_minidom(new_html))
+        tree = SplitRecordingTree(old_dom)
+        indexed_dom_diff(tree, old_root, new_root, index)
+        assert_equal(split, split_texts)
+        assert_equal(minidom_tostring(old_dom), changes_html)
+
+
+def test_location_cache():
+    # Cached lookups find the same nodes as walking from the root each time,
+    # as long as edits are reported.
+    dom = parse_minidom(
+        '<div><p>one</p><p>two <b>three</b></p></div><p>four</p>'
+    )
+    locations = LocationCache(dom.documentElement, util.get_child)
+    p = location_handle([0, 1])
+    for location in [(p, 1), (p, 0), ((p, 1), 0), location_handle([0, 0, 0]),
+                     location_handle([1]), (p, 1)]:
+        assert locations.find(location) is get_location(
+            dom,
+            location_list(location),
+        )
+    # Children of a kept handle take one step.
+    assert_equal(locations.handles[-1], (p, 1))
+    location = locations.find(((p, 1), 0))
+    assert_equal(location.nodeValue, 'three')
+    edited = location_handle([0, 0])
+    node = locations.find(edited)
+    node.parentNode.removeChild(node)
+    locations.edited(edited)
+    for location in [[0, 0, 1], [0, 0], [1, 0]]:
+        assert locations.find(location_handle(location)) is get_location(
+            dom,
+            location,
+        )
+    assert_raises(ValueError, locations.find, location_handle([0, 5]))
+
+
+def test_location_cache_lookups():
+    # Deep edits that mix deletes and inserts in the same parents take a few
+    # child lookups each, with handles or lists, not a walk from the root.
+    paragraphs = ''.join('<p>%d one two</p>' % i for i in range(50))
+    old_html = '<div>' * 30 + paragraphs + '</div>' * 30
+    new_html = old_html.replace('one', 'six')
+
+    class CountingRunner(EditScriptRunner):
+        def get_child(self, node, child_index):
+            lookups.append(child_index)
+            return EditScriptRunner.get_child(self, node, child_index)
+    for handles in [False, True]:
+        old_dom = parse_minidom(old_html)
+        new_dom = parse_minidom(new_html)
+        split_text_nodes(old_dom)
+        split_text_nodes(new_dom)
+        edit_script = Differ(old_dom, new_dom).get_edit_script(
+            handles=handles,
+        )
+        lookups = []
+        runner = CountingRunner(old_dom, edit_script)
+        assert_equal(
+            minidom_tostring(runner.run_edit_script()),
+            minidom_tostring(parse_minidom(new_html)),
+        )
+        assert len(lookups) < 3 * len(edit_script)
+
+
+def test_edit_script_handles():
+    # An edit script with location handles runs just like one with lists.
+    old_html = '<div><p>one two</p><p>three</p></div><p>four five</p>'
+    new_html = '<div><p>one six</p></div><p>four <b>five</b></p>'
+    for subtrees in [False, True]:
+        old_dom = parse_minidom(old_html)
+        new_dom = parse_minidom(new_html)
+        split_text_nodes(old_dom)
+        split_text_nodes(new_dom)
+        differ = Differ(old_dom, new_dom)
+        edit_script = differ.get_edit_script(subtrees, handles=True)
+        assert isinstance(edit_script[0][1], tuple)
+        runner = EditScriptRunner(old_dom, edit_script)
+        assert_equal(
+            minidom_tostring(runner.run_edit_script()),
+            minidom_tostring(parse_minidom(new_html)),
+        )
+
+
+def test_insert_subtree_instructions():
+    # Processing instructions aren't inserted, at the top of a subtree or
+    # inside it.
+    old_dom = parse_minidom('<p>one</p>')
+    new_dom = parse_minidom(
+        '<div><?php x ?><p>two</p></div><?php y ?><p>one</p>'
+    )
+    edit_script = Differ(old_dom, new_dom).get_edit_script(subtrees=True)
+    assert_equal(
+        [action for action, _, _ in edit_script],
+        ['insert_subtree', 'insert_subtree'],
+    )
+    dom = EditScriptRunner(old_dom, edit_script).run_edit_script()
+    assert_equal(minidom_tostring(dom), '<div><p>two</p></div><p>one</p>')
@@ -1,17 +1,26 @@
 # coding: utf8
 
 from pprint import pformat
-from xml.dom import Node
+from xml.dom import Node, minidom
 
 from nose.tools import assert_equal
 
+from htmltreediff.changes import (
+    add_changes_markup,
+    dom_diff,
+    split_text_nodes,
+)
+from htmltreediff.diff_core import Differ
+from htmltreediff.edit_script_runner import EditScriptRunner
 from htmltreediff.html import diff
+from htmltreediff.lxml_engine import diff as lxml_diff
 from htmltreediff.util import (
     parse_minidom,
     parse_text,
     minidom_tostring,
     html_equal,
     is_text,
+    walk_dom,
 )
 from htmltreediff.test_util import (
     reverse_edit_script,
@@ -1330,6 +1339,75 @@ def test_edit_script():
         yield test
 
 
+def test_deep_edit_script():
+    # Deep documents don't hit the recursion limit. Build the documents with
+    # expat, to diff them without the html parsing and markup.
+    depth = 3000
+    old_dom = minidom.parseString(
+        '<body>' + '<div>' * depth + 'one two' + '</div>' * depth + '</body>')
+    new_dom = minidom.parseString(
+        '<body>' + '<div>' * depth + 'one six' + '</div>' * depth + '</body>')
+    assert_equal(len(list(walk_dom(old_dom))), depth + 2)
+    edit_script = Differ(old_dom, new_dom).get_edit_script()
+    location = [0] * (depth + 1)
+    assert edit_script == [
+        ('delete', location, {'node_type': Node.TEXT_NODE,
+                              'node_value': 'one two'}),
+        ('insert', location, {'node_type': Node.TEXT_NODE,
+                              'node_value': 'one six'}),
+    ]
+    # Deleting the whole document doesn't recurse either.
+    empty_dom = minidom.parseString('<body/>')
+    edit_script = Differ(old_dom, empty_dom).get_edit_script()
+    assert_equal(len(edit_script), depth + 1)
+    assert edit_script[0][1] == [0] * (depth + 1)
+    assert edit_script[-1][1] == [0]
+    # Or with a single entry for the subtree, both ways.
+    edit_script = Differ(old_dom, empty_dom).get_edit_script(subtrees=True)
+    assert edit_script == [
+        ('delete_subtree', [0], {'node_type': Node.ELEMENT_NODE,
+                                 'node_name': 'div'}),
+    ]
+    edit_script = Differ(empty_dom, old_dom).get_edit_script(subtrees=True)
+    assert_equal(len(edit_script), 1)
+    action, location, properties = edit_script[0]
+    assert_equal((action, location), ('insert_subtree', [0]))
+    for _ in range(depth):
+        properties, = properties['children']
+    assert_equal(properties, {'node_type': Node.TEXT_NODE,
+                              'node_value': 'one two'})
+
+
+def test_deep_diff():
+    # Nor do they from end to end, in either engine, and the html parser
+    # keeps all of their nesting.
+    depth = 3000
+    old_html = '<div>' * depth + 'one two' + '</div>' * depth
+    new_html = '<div>' * depth + 'one six' + '</div>' * depth
+    changes = (
+        '<div>' * depth + 'one <del>two</del><ins>six</ins>' +
+        '</div>' * depth
+    )
+    for diff_function in [diff, lxml_diff]:
+        assert_equal(diff_function(old_html, new_html, cutoff=0.5), changes)
+
+
+def test_wide_node():
+    # Long lists of siblings are matched in windows between anchors.
+    paragraphs = []
+    for i in range(150):
+        paragraphs.append('<p>note</p>')
+        paragraphs.append('<p>item %d</p>' % (i // 3))
+    old_html = ''.join(paragraphs)
+    paragraphs[151] = '<p>changed</p>'
+    del paragraphs[40]
+    new_html = ''.join(paragraphs)
+    changes = diff(old_html, new_html, cutoff=0.0)
+    assert_strip_changes(old_html, new_html, changes)
+    assert_equal(changes.count('<ins>'), 1)
+    assert_equal(changes.count('<del>'), 2)
+
+
 def test_html_patch():
     for case in parse_cases(all_test_cases):
         # check that applying the diff gives back the same new_html
@@ -1345,6 +1423,53 @@ def test_html_patch():
         yield test
 
 
+def test_dom_diff_matches_edit_script():
+    # Marking up the changes as they are found gives exactly the markup that
+    # running the edit script does.
+    for case in parse_cases(all_test_cases):
+        def test():
+            old_dom = parse_minidom(case.old_html)
+            new_dom = parse_minidom(case.new_html)
+            split_text_nodes(old_dom)
+            split_text_nodes(new_dom)
+            edit_script = Differ(old_dom, new_dom).get_edit_script()
+            runner = EditScriptRunner(old_dom, edit_script)
+            dom = runner.run_edit_script()
+            add_changes_markup(dom, runner.ins_nodes, runner.del_nodes)
+            assert_equal(
+                minidom_tostring(dom_diff(
+                    parse_minidom(case.old_html),
+                    parse_minidom(case.new_html),
+                )),
+                minidom_tostring(dom),
+            )
+        test.description = 'test_dom_diff_matches_edit_script - %s' % (
+            case.name,
+        )
+        yield test
+
+
+def test_subtree_edit_script():
+    # Subtree entries make the same changes as an entry per node.
+    for case in parse_cases(all_test_cases):
+        def test():
+            markup = []
+            for subtrees in [False, True]:
+                old_dom = parse_minidom(case.old_html)
+                new_dom = parse_minidom(case.new_html)
+                split_text_nodes(old_dom)
+                split_text_nodes(new_dom)
+                differ = Differ(old_dom, new_dom)
+                edit_script = differ.get_edit_script(subtrees=subtrees)
+                runner = EditScriptRunner(old_dom, edit_script)
+                dom = runner.run_edit_script()
+                add_changes_markup(dom, runner.ins_nodes, runner.del_nodes)
+                markup.append(minidom_tostring(dom))
+            assert_equal(markup[0], markup[1])
+        test.description = 'test_subtree_edit_script - %s' % case.name
+        yield test
+
+
 def test_cases_sanity():
     # check that removing the ins and del markup gives the original
     sane_cases = (test_cases + reverse_test_cases + one_way_test_cases)
@@ -1,5 +1,7 @@
+import math
 import re
 import string
+from array import array
 
 from difflib import SequenceMatcher, _calculate_ratio
 
@@ -106,8 +108,78 @@ _word_split_regexes = [
 ]
 
 
+def _case_insensitive(word):
+    # Spell out both cases of each letter, so that the pattern can share a
+    # regex with patterns that are case sensitive.
+    return ''.join(
+        '[%s%s]' % (c.lower(), c.upper()) if c.isalpha() else re.escape(c)
+        for c in word
+    )
+
+# The same tokens as _word_split_regexes, found in one pass with a single
+# regex. multi_split carves out all the matches of each regex before trying
+# the next one, so a lower priority token stops where a higher priority one
+# would start. The negative lookaheads do that here, wherever a higher
+# priority token can start on a character the lower one could consume. The
+# whole regex uses re.UNICODE, so the ascii-only classes are spelled out.
+_contraction = '(?:%s)' % '|'.join(_case_insensitive(c) for c in _word_list)
+_phone = r'[0-9]+(?:-[0-9]+)+'
+_date = r'[0-9](?:(?!{phone})[0-9])*(?:/(?:(?!{phone})[0-9])+)+'.format(
+    phone=_phone,
+)
+_punctuation = '[%s]' % re.escape(string.punctuation)
+_token_regex = re.compile('|'.join([
+    # HTML entities.
+    r'&(?:[a-zA-Z0-9_]+|#[0-9]+);',
+    # Special cases.
+    _contraction,
+    # Phone numbers.
+    _phone,
+    # Dates.
+    _date,
+    # Numbers. Phone numbers and dates can only start inside a run of
+    # digits that is followed by a dash or slash.
+    r'[0-9]+(?![0-9/-])',
+    r'[0-9](?:(?!{phone}|{date})[0-9])*'.format(phone=_phone, date=_date),
+    # Punctuation.
+    _punctuation,
+    # Words, without the digits and underscores already split out. Likewise,
+    # contractions can only start inside a word followed by an apostrophe.
+    r"[^\W0-9_]+(?![^\W0-9_]|')",
+    r'[^\W0-9_](?:(?!{contraction})[^\W0-9_])*'.format(
+        contraction=_contraction,
+    ),
+    # Anything else that isn't whitespace.
+    r'[^\s\w%s]+' % re.escape(string.punctuation),
+    # Whitespace.
+    r'\s+',
+]), re.UNICODE)
+
+
 def split_text(text):
-    return multi_split(text, _word_split_regexes)
+    """
+    Split text into words, numbers, punctuation and whitespace. The pieces
+    join back into the original text.
+
+    >>> split_text("Don't call 555-1234 after 10/2, Bob&amp;co")
+    ["Don't", ' ', 'call', ' ', '555-1234', ' ', 'after', ' ', '10/2', ',', \
+' ', 'Bob', '&amp;', 'co']
+    """
+    return _token_regex.findall(text)
+
+
+def token_spans(text, start=0, stop=None):
+    """
+    Yield the (start, stop) offsets of the split_text tokens of
+    text[start:stop], without slicing the text.
+
+    >>> list(token_spans('skip this one', 5))
+    [(5, 9), (9, 10), (10, 13)]
+    """
+    if stop is None:
+        stop = len(text)
+    for match in _token_regex.finditer(text, start, stop):
+        yield match.span()
 
 _stopwords = 'a an and as at by for if in it of or so the to'
 _stopwords = set(_stopwords.strip().lower().split())
@@ -118,17 +190,342 @@ def is_text_junk(word):
     return word.isspace() or word.lower() in _stopwords
 
 
+def length_sums(words, isjunk=is_text_junk):
+    """
+    Return the running totals of non-junk word lengths, starting with zero.
+
+    The total length of words[i:j] is then sums[j] - sums[i].
+    >>> length_sums(['the', 'quick', ' ', 'fox'])
+    [0, 0, 5, 5, 8]
+    """
+    sums = [0]
+    total = 0
+    for word in words:
+        if not (isjunk and isjunk(word)):
+            total += len(word)
+        sums.append(total)
+    return sums
+
+
+class Vocabulary(object):
+    """
+    Map each distinct word to a small integer id, so that word sequences can
+    be stored and matched as arrays of ids. The length of each word, and
+    whether it is junk, are worked out once, when it is first seen.
+
+    >>> vocabulary = Vocabulary()
+    >>> ids = vocabulary.intern(['The', 'quick', 'fox', 'the', 'fox'])
+    >>> ids
+    array('i', [0, 1, 2, 3, 2])
+    >>> vocabulary.words[3], vocabulary.lengths[1], vocabulary.is_junk(3)
+    ('the', 5, True)
+    >>> vocabulary.length_sums(ids)
+    array('i', [0, 0, 5, 8, 8, 11])
+    """
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+        self.lengths = array('i')
+        self.junk = bytearray()
+
+    def intern(self, words):
+        """Return the ids of the words, as an array."""
+        ids = self.ids
+        result = array('i')
+        for word in words:
+            word_id = ids.get(word)
+            if word_id is None:
+                word_id = ids[word] = len(self.words)
+                self.words.append(word)
+                self.lengths.append(len(word))
+                self.junk.append(is_text_junk(word))
+            result.append(word_id)
+        return result
+
+    def is_junk(self, word_id):
+        return bool(self.junk[word_id])
+
+    def length_sums(self, ids):
+        """Return the length_sums of a sequence of word ids."""
+        lengths = self.lengths
+        junk = self.junk
+        sums = array('i', [0])
+        total = 0
+        for word_id in ids:
+            if not junk[word_id]:
+                total += lengths[word_id]
+            sums.append(total)
+        return sums
+
+
+# The most bits of traceback vectors that lcs_matches keeps at once, for
+# about a megabyte.
+_lcs_traceback_bits = 1 << 23
+
+
+def _lcs_vectors(a, b):
+    """
+    Yield the bit vectors of a bit-parallel LCS of a and b, one bit per item
+    of a, before and after each item of b. A zero bit i in a vector is where
+    the LCS of a[:i + 1], with all of b so far, gets one longer.
+    """
+    masks = {}
+    for i, item in enumerate(a):
+        masks[item] = masks.get(item, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    yield v
+    for item in b:
+        mask = masks.get(item)
+        if mask is not None:
+            u = v & mask
+            v = ((v + u) | (v - u)) & full
+        yield v
+
+
+def _lcs_prefix_lengths(a, b):
+    """Return the LCS lengths of b with each prefix of a, a[:0] to a[:]."""
+    for v in _lcs_vectors(a, b):
+        pass
+    lengths = [0]
+    for bit in reversed(format(v, 'b').zfill(len(a))):
+        lengths.append(lengths[-1] + (bit == '0'))
+    return lengths
+
+
+def _lcs_traceback(a, b):
+    rows = list(_lcs_vectors(a, b))
+    matches = []
+    i = len(a)
+    j = len(b)
+    while i and j:
+        if a[i - 1] == b[j - 1]:
+            i -= 1
+            j -= 1
+            matches.append((i, j))
+        elif rows[j] >> (i - 1) & 1:
+            i -= 1
+        else:
+            j -= 1
+    matches.reverse()
+    return matches
+
+
+def lcs_matches(a, b):
+    """
+    Return the index pairs (i, j) of a longest common subsequence of a and
+    b, in order.
+
+    This is a bit-parallel LCS, with a Python integer as the bit vector, one
+    bit per item of a. The vector after each item of b is kept, and the
+    subsequence is traced back through them. Sequences too long to keep all
+    of them are first split in two where the subsequence crosses the middle
+    of b, found from the lengths of both halves, as in Hirschberg's
+    algorithm, until the parts are small enough.
+
+    >>> lcs_matches('abcd', 'acbd')
+    [(0, 0), (1, 2), (3, 3)]
+    """
+    # A common prefix and suffix are always part of a longest common
+    # subsequence.
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    matches = []
+    parts = [(prefix, len(a) - suffix, prefix, len(b) - suffix)]
+    while parts:
+        a_start, a_end, b_start, b_end = parts.pop()
+        part_a = a[a_start:a_end]
+        part_b = b[b_start:b_end]
+        if not part_a or not part_b:
+            continue
+        if (len(part_b) == 1 or
+                len(part_a) * len(part_b) <= _lcs_traceback_bits):
+            matches.extend(
+                (a_start + i, b_start + j)
+                for i, j in _lcs_traceback(part_a, part_b)
+            )
+            continue
+        middle = len(part_b) // 2
+        forward = _lcs_prefix_lengths(part_a, part_b[:middle])
+        backward = _lcs_prefix_lengths(part_a[::-1], part_b[middle:][::-1])
+        n = len(part_a)
+        split = max(range(n + 1), key=lambda i: forward[i] + backward[n - i])
+        parts.append((a_start, a_start + split, b_start, b_start + middle))
+        parts.append((a_start + split, a_end, b_start + middle, b_end))
+    matches.sort()
+    return (
+        [(k, k) for k in range(prefix)] +
+        matches +
+        [(len(a) - suffix + k, len(b) - suffix + k) for k in range(suffix)]
+    )
+
+
+def lcs_match_length(a, b, weight):
+    """
+    Return the total weight of a longest common subsequence of the items of
+    a and b that have any weight, where weight(item) gives the weight of
+    each item, a non-negative integer that is the same for equal items.
+
+    The subsequence is the longest by count, from lcs_matches, and its items
+    are weighed afterwards, so that each item takes one bit however heavy it
+    is. That is at most the weight of the heaviest common subsequence, and
+    usually the same.
+
+    >>> lcs_match_length('abcd', 'acbd', lambda item: 1)
+    3
+    >>> lcs_match_length(['quick', 'brown', 'fox'], ['fox', 'quick'], len)
+    5
+    """
+    a = [item for item in a if weight(item)]
+    b = [item for item in b if weight(item)]
+    return sum(weight(a[i]) for i, _ in lcs_matches(a, b))
+
+
+_mask64 = (1 << 64) - 1
+
+
+def shingle_sketch(words, weight, samples=256, shingle=1):
+    """
+    Return a weighted MinHash sketch of a word sequence, for estimating its
+    overlap with other sequences with sketch_similarity.
+
+    Every word with a weight starts a shingle of up to `shingle` words with
+    a weight, and the shingle gets the weight of its first word. Repeats of
+    a shingle are told apart by their occurrence number, so that the sketch
+    stands for the multiset of shingles.
+
+    The shingles are hashed into `samples` bins, and each bin keeps the
+    shingle with the lowest rank, -log(u) / weight for a hash u in (0, 1).
+    Those ranks are exponentially distributed, so the lowest one in a bin is
+    a sample of the shingles in it, picked in proportion to their weight.
+
+    >>> sketch = shingle_sketch(['quick', 'fox'], len, samples=4)
+    >>> len(sketch), len([entry for entry in sketch if entry is not None])
+    (4, 2)
+    """
+    weighted = [(word, weight(word)) for word in words]
+    weighted = [(word, w) for word, w in weighted if w]
+    words = [word for word, _ in weighted]
+    sketch = [None] * samples
+    occurrences = {}
+    log = math.log
+    mask = _mask64
+    for i, (word, w) in enumerate(weighted):
+        key = tuple(words[i:i + shingle])
+        occurrence = occurrences[key] = occurrences.get(key, 0) + 1
+        # The splitmix64 finalizer, inlined.
+        x = hash((key, occurrence)) & mask
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & mask
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & mask
+        x ^= x >> 31
+        # The bin comes from the low bits of the hash, and u from the high
+        # bits of a multiple of it.
+        u = ((((x * 0x9e3779b97f4a7c15) & mask) >> 11) + 0.5) / (1 << 53)
+        entry = (-log(u) / w, x)
+        sample = x % samples
+        if sketch[sample] is None or entry < sketch[sample]:
+            sketch[sample] = entry
+    return sketch
+
+
+def sketch_similarity(a, b):
+    """
+    Estimate the weighted Jaccard similarity of the shingles of two
+    sequences, the weight they have in common over the weight of either,
+    from their shingle_sketch.
+
+    In each bin that isn't empty in both, the lowest ranked of the two
+    entries is a weighted sample of the shingles of either sequence, which
+    the sequences have in common exactly when both sketches hold it. The
+    fraction of such bins has a standard error of about
+    sqrt(J * (1 - J) / samples) for a similarity of J, which is at most
+    0.031 for 256 samples and 0.016 for 1024. Sequences with fewer shingles
+    than samples leave bins empty and get a rougher estimate, but identical
+    sequences always get 1.0 and sequences with no shingles in common 0.0.
+
+    >>> a = shingle_sketch(['one', 'two', 'three'], len)
+    >>> b = shingle_sketch(['one', 'two', 'four'], len)
+    >>> sketch_similarity(a, a), sketch_similarity(a, b)
+    (1.0, 0.5)
+    >>> sketch_similarity([None], [None])
+    1.0
+    """
+    bins = 0
+    matches = 0
+    for a_entry, b_entry in zip(a, b):
+        if a_entry is None and b_entry is None:
+            continue
+        bins += 1
+        if a_entry == b_entry:
+            matches += 1
+    if not bins:
+        return 1.0
+    return float(matches) / bins
+
+
 class WordMatcher(SequenceMatcher):
     """
     WordMatcher is a SequenceMatcher that can measure the similarity of
     sequences of words based on the total length of matching words.
+
+    Callers that compare the same word lists many times can pass in their
+    length_sums as a_sums and b_sums, instead of having them recomputed.
+
+    Given a Vocabulary, the sequences are arrays of word ids from it, which
+    are faster to compare than the words themselves.
+
+    The backend is the way matching words are found for text_ratio:
+    'difflib' uses the matching blocks of the SequenceMatcher, and 'lcs'
+    weighs a longest common subsequence of the non-junk words by their
+    length, with lcs_match_length. The LCS usually finds as much matching
+    text or more, without difflib's heuristics for popular words.
     """
-    def __init__(self, isjunk=is_text_junk, a=None, b=None):
+    backends = ['difflib', 'lcs']
+
+    def __init__(self, isjunk=is_text_junk, a=None, b=None,
+                 a_sums=None, b_sums=None, vocabulary=None,
+                 backend='difflib'):
         if a is None:
             a = []
         if b is None:
             b = []
+        if vocabulary is not None:
+            isjunk = vocabulary.is_junk
+        if backend not in self.backends:
+            raise ValueError('Unknown text ratio backend: %r' % backend)
+        self.backend = backend
+        self.vocabulary = vocabulary
         SequenceMatcher.__init__(self, isjunk, a, b)
+        self.a_sums = a_sums
+        self.b_sums = b_sums
+
+    def set_seq1(self, a):
+        SequenceMatcher.set_seq1(self, a)
+        self.a_sums = None
+
+    def set_seq2(self, b):
+        if self.backend == 'lcs' and b is not self.b:
+            # The LCS doesn't use difflib's index of b, so it is only built
+            # if the matching blocks are asked for.
+            self.b = b
+            self.matching_blocks = self.opcodes = None
+            self.fullbcount = None
+            self.b2j = None
+        else:
+            SequenceMatcher.set_seq2(self, b)
+        self.b_sums = None
+
+    def get_matching_blocks(self):
+        if self.b2j is None:
+            b, self.b = self.b, None
+            SequenceMatcher.set_seq2(self, b)
+        return SequenceMatcher.get_matching_blocks(self)
 
     def text_ratio(self):
         """Return a measure of the sequences' word similarity (float in [0,1]).
@@ -146,10 +543,14 @@ class WordMatcher(SequenceMatcher):
         '1.000'
         >>> '%.3f' % m.text_ratio() # text ratio is accurate
         '1.000'
+        >>> m = WordMatcher(a=['abcdef', '12'], b=['abcdef', '34'],
+        ...                 backend='lcs')
+        >>> '%.3f' % m.text_ratio()
+        '0.750'
         """
         return _calculate_ratio(
             self.match_length(),
-            self._text_length(self.a) + self._text_length(self.b),
+            self._a_sums()[-1] + self._b_sums()[-1],
         )
 
     def match_length(self):
@@ -157,17 +558,36 @@ class WordMatcher(SequenceMatcher):
         Find the total length of all words that match between the two
         sequences.
         """
+        if self.backend == 'lcs':
+            return lcs_match_length(self.a, self.b, self._weight)
+        sums = self._a_sums()
         length = 0
         for match in self.get_matching_blocks():
             a, b, size = match
-            length += self._text_length(self.a[a:a + size])
+            length += sums[a + size] - sums[a]
         return length
 
-    def _text_length(self, word_sequence):
-        # Find the length of non-junk text in the sequence.
-        return sum(self._word_length(word) for word in word_sequence)
+    def _a_sums(self):
+        if self.a_sums is None:
+            self.a_sums = self._length_sums(self.a)
+        return self.a_sums
 
-    def _word_length(self, word):
+    def _b_sums(self):
+        if self.b_sums is None:
+            self.b_sums = self._length_sums(self.b)
+        return self.b_sums
+
+    def _weight(self, word):
+        # The length of a word, or zero for junk, as in the length sums.
+        if self.vocabulary is not None:
+            if self.vocabulary.junk[word]:
+                return 0
+            return self.vocabulary.lengths[word]
         if self.isjunk and self.isjunk(word):
             return 0
         return len(word)
+
+    def _length_sums(self, words):
+        if self.vocabulary is not None:
+            return self.vocabulary.length_sums(words)
+        return length_sums(words, self.isjunk)
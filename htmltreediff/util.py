@@ -1,8 +1,21 @@
+import hashlib
 import re
+from array import array
+from bisect import bisect_left
+from difflib import _calculate_ratio
 from textwrap import dedent
 from xml.dom import minidom, Node
-
-from htmltreediff.text import WordMatcher, split_text
+from xml.dom.minicompat import NodeList
+
+from htmltreediff.text import (
+    Vocabulary,
+    WordMatcher,
+    is_text_junk,
+    shingle_sketch,
+    sketch_similarity,
+    split_text,
+    token_spans,
+)
 
 # DOM utilities ##
 # parsing and cleaning #
@@ -12,6 +25,11 @@ import lxml.etree
 import lxml.sax
 from HTMLParser import HTMLParser
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
 def _write_data(writer, data):
     "Writes datachars to writer."
     if data:
@@ -24,44 +42,88 @@ def writexml(self, writer, indent="", addindent="", newl=""):
     # indent = current indentation
     # addindent = indentation to add to higher levels
     # newl = newline string
-    writer.write(indent+"<" + self.tagName)
-
-    attrs = self._get_attributes()
-    a_names = sorted(attrs.keys())
-
-    for a_name in a_names:
-        writer.write(" %s=\"" % a_name)
-        minidom._write_data(writer, attrs[a_name].value)
-        writer.write("\"")
-    if self.childNodes:
-        writer.write(">")
-        if (len(self.childNodes) == 1 and
-            self.childNodes[0].nodeType == Node.TEXT_NODE):
-            self.childNodes[0].writexml(writer, '', '', '')
-        else:
-            writer.write(newl)
-            for node in self.childNodes:
-                node.writexml(writer, indent+addindent, addindent, newl)
+    # Change against master: the child elements are written from a stack
+    # rather than recursively, so that deep documents can't hit the
+    # recursion limit. Closing tags go on the stack as (None, text).
+    stack = [(self, indent)]
+    while stack:
+        node, indent = stack.pop()
+        if node is None:
             writer.write(indent)
-        writer.write("</%s>%s" % (self.tagName, newl))
-    else:
-        # Change against master: qutebrowser doesn't handle short tags
-        # well. Font type escapes out, this is problem with <pre><code/></pre>
-        writer.write("></%s>%s"%(self.tagName, newl))
+            continue
+        if node.nodeType != Node.ELEMENT_NODE:
+            node.writexml(writer, indent, addindent, newl)
+            continue
+        writer.write(indent+"<" + node.tagName)
+
+        attrs = node._get_attributes()
+        a_names = sorted(attrs.keys())
+
+        for a_name in a_names:
+            writer.write(" %s=\"" % a_name)
+            minidom._write_data(writer, attrs[a_name].value)
+            writer.write("\"")
+        if node.childNodes:
+            writer.write(">")
+            if (len(node.childNodes) == 1 and
+                node.childNodes[0].nodeType == Node.TEXT_NODE):
+                node.childNodes[0].writexml(writer, '', '', '')
+                writer.write("</%s>%s" % (node.tagName, newl))
+            else:
+                writer.write(newl)
+                stack.append(
+                    (None, indent + "</%s>%s" % (node.tagName, newl)))
+                for child in reversed(node.childNodes):
+                    stack.append((child, indent+addindent))
+        else:
+            # Change against master: qutebrowser doesn't handle short tags
+            # well. Font type escapes out, this is problem with
+            # <pre><code/></pre>
+            writer.write("></%s>%s"%(node.tagName, newl))
+
+
+def _node_list_index(self, node):
+    # Change against master: nodes are found by identity. Nodes don't define
+    # equality, so that is what list.index compares anyway, but comparing
+    # old-style instances is slow enough that inserting and removing the
+    # children of a wide node took most of the time of a diff.
+    for i, child in enumerate(self):
+        if child is node:
+            return i
+    raise ValueError('node is not in the list')
+
+
+def _node_list_remove(self, node):
+    del self[_node_list_index(self, node)]
+
 
 # Monkey patch minidom...
 minidom._write_data = _write_data
 minidom.Element.writexml = writexml
+NodeList.index = _node_list_index
+NodeList.remove = _node_list_remove
 
-def parse_lxml_dom(xml, strict_xml=True):
+# Without huge_tree, libxml2 stops parsing at a depth of 256, and the html
+# parser silently drops the rest of the document.
+_xml_parser = lxml.etree.XMLParser(huge_tree=True)
+_html_parser = lxml.html.HTMLParser(huge_tree=True)
+
+
+def parse_lxml(xml, strict_xml=True):
     if strict_xml:
         parse_func = lxml.etree.fromstring
+        parser = _xml_parser
     else:
         parse_func = lxml.html.document_fromstring
+        parser = _html_parser
     try:
-        tree = parse_func(xml)
+        return parse_func(xml, parser=parser)
     except lxml.etree.XMLSyntaxError:
-        tree = parse_func('<body>%s</body>' % xml)
+        return parse_func('<body>%s</body>' % xml, parser=parser)
+
+
+def parse_lxml_dom(xml, strict_xml=True):
+    tree = parse_lxml(xml, strict_xml=strict_xml)
 
     handler = SAX2DOM()
     lxml.sax.saxify(tree, handler)
@@ -99,12 +161,12 @@ def parse_minidom(xml, clean=False, strict_xml=False):
                 unwrap(node)
             elif node.nodeName == 'span':
                 unwrap(node)
-    dom.normalize()
+    normalize_dom(dom)
 
     # Make sure that the body element is the top of the dom.
-    for head_element in dom.getElementsByTagName('head'):
+    for head_element in elements_by_tag_name(dom, 'head'):
         remove_node(head_element)
-    for html_element in dom.getElementsByTagName('html'):
+    for html_element in elements_by_tag_name(dom, 'html'):
         unwrap(html_element)
     if not dom.documentElement:
         dom = parse_lxml_dom('', strict_xml=True)
@@ -176,6 +238,19 @@ def minidom_tostring(dom, pretty=False):
         xml = dom.toprettyxml()
     else:
         xml = dom.toxml()
+    return trim_xml(xml)
+
+
+def trim_xml(xml):
+    """
+    Strip the xml declaration and the body element from serialized xml, and
+    remove indentation.
+
+    >>> trim_xml('<?xml version="1.0" ?><body/>')
+    ''
+    >>> trim_xml('<body><p>one</p></body>')
+    '<p>one</p>'
+    """
     xml = remove_xml_declaration(xml)
     if xml == '<body/>':
         return ''
@@ -190,66 +265,479 @@ def html_equal(a_html, b_html):
         return True
     a_dom = parse_minidom(a_html)
     b_dom = parse_minidom(b_html)
-    a_dom_tree = HashableTree(a_dom.documentElement)
-    b_dom_tree = HashableTree(b_dom.documentElement)
-    return a_dom_tree == b_dom_tree
+    index = NodeIndex()
+    a = index.add(a_dom)
+    b = index.add(b_dom)
+    return index.digest(a) == index.digest(b)
+
+
+def node_label(node):
+    """Return a node's type, name, value and sorted attributes as a tuple."""
+    return (
+        node.nodeType,
+        node.nodeName,
+        node.nodeValue,
+        tuple(sorted(attribute_dict(node).items())),
+    )
+
+
+# Bytes in a subtree digest. NodeIndex keeps them all in one bytearray.
+digest_size = hashlib.sha1().digest_size
+
+
+def _label_digest(label):
+    # Encode each part with its length, so that the digest can't be fooled by
+    # separator characters inside names or values.
+    parts = []
+    node_type, node_name, node_value, attributes = label
+    for value in [node_type, node_name, node_value] + [
+        item for pair in attributes for item in pair
+    ]:
+        if value is None:
+            parts.append('-')
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        parts.append('%d:%s' % (len(value), value))
+    return hashlib.sha1(''.join(parts)).digest()
 
 
-class HashableNode(object):
-    def __init__(self, node):
-        self.node = node
+def child_nodes(node):
+    return node.childNodes
 
-    def __eq__(self, other):
-        return (self.node.nodeType == other.node.nodeType and
-                self.node.nodeName == other.node.nodeName and
-                self.node.nodeValue == other.node.nodeValue and
-                attribute_dict(self.node) == attribute_dict(other.node))
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
 
-    def __hash__(self):
-        attributes = frozenset(attribute_dict(self.node).items())
-        return hash((self.node.nodeType,
-                     self.node.nodeName,
-                     self.node.nodeValue,
-                     attributes))
+class NodeIndex(object):
+    """
+    A compact, read-only copy of one or more documents, for diffing.
+
+    Every node gets an integer id, in document order, and the tree is kept as
+    a struct of arrays indexed by node id: parent, first child and next
+    sibling links, an interned label id, and the span of the node's text in
+    one shared text buffer. The text of a whole subtree is one slice of that
+    buffer.
+
+    Subtree digests are computed once, bottom-up, so that comparing two
+    nodes or two whole subtrees afterwards is an array lookup. Digests only
+    depend on node content, so subtrees from different documents in the same
+    index compare equal exactly when HashableTree would consider them equal.
+
+    The documents are read through the `children` and `label` functions,
+    which default to minidom. Other tree types can be indexed, and then
+    diffed, by passing in equivalent functions; see htmltreediff.lxml_engine.
+
+    With split_text, each text node is indexed as one text node per
+    split_text token, the way changes.split_text_nodes splits a dom, so the
+    documents themselves are left alone. The text is split as it is added,
+    and the pieces are the tokens, so it is never split again.
+
+    >>> dom = parse_minidom('<p>one</p><p>two</p><p>one</p>')
+    >>> index = NodeIndex()
+    >>> body = index.add(dom)
+    >>> a, b, c = index.children(body)
+    >>> index.digest(a) == index.digest(c)
+    True
+    >>> index.digest(a) == index.digest(b)
+    False
+    >>> index.label(a) is index.label(b)
+    True
+    >>> index.text_value(index.first_child[b])
+    u'two'
+    >>> index = NodeIndex(split_text=True)
+    >>> p = index.first_child[index.add(parse_minidom('<p>one two</p>'))]
+    >>> [index.text_value(child) for child in index.children(p)]
+    [u'one', u' ', u'two']
+    """
+    def __init__(self, dom=None, children=child_nodes, label=node_label,
+                 split_text=False):
+        self.get_children = children
+        self.get_label = label
+        self.split_text = split_text
+        # Interned labels, with text node values left out. Those are kept in
+        # the text buffer instead.
+        self.labels = {}  # label -> label id
+        self.label_table = []
+        self.label_digests = []
+        # Per node arrays, indexed by node id. Missing links are -1.
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.label_ids = array('i')
+        self.text_start = array('i')
+        self.text_stop = array('i')
+        # Subtree digests, digest_size bytes per node.
+        self.digests = bytearray()
+        self.significant = bytearray()  # whether it has any non-junk text
+        # Each text value is followed by a space in the buffer, so that the
+        # text of neighbouring nodes doesn't run together.
+        self.text_parts = []
+        self.text_length = 0
+        self._text_buffer = None
+        self.junk_text = {}  # text node value -> is_text_junk(value)
+        # The text is split into tokens the way split_text splits each text
+        # node: by tokenize(), all at once, or with split_text, as the pieces
+        # are added. Per token arrays, in buffer
+        # order, give the text node it comes from, its offsets in the
+        # buffer, and the id of its word in the vocabulary, or -1 for
+        # whitespace.
+        self.text_nodes = array('i')  # text node ids, in buffer order
+        self.tokenized = 0  # how many of the text nodes are tokenized
+        self.token_nodes = array('i')
+        self.token_start = array('i')
+        self.token_stop = array('i')
+        self.token_words = array('i')
+        self.token_word_ids = {}  # token -> word id
+        self.vocabulary = Vocabulary()
+        self.word_profiles = {}
+        self.word_counts = {}
+        self.signatures = {}
+        self.sketches = {}  # (node, samples, shingle) -> sketch
+        if dom is not None:
+            self.add(dom)
+
+    def add(self, dom):
+        """Index every node in the given dom or subtree. Return its id."""
+        # allow calling this on a document as well as as node
+        if hasattr(dom, 'documentElement'):
+            dom = dom.documentElement
+
+        root = len(self.label_ids)
+        last_child = {}
+        stack = [(dom, -1, self.get_label(dom))]
+        while stack:
+            node, parent, label = stack.pop()
+            node_id = len(self.label_ids)
+            self.parent.append(parent)
+            self.first_child.append(-1)
+            self.next_sibling.append(-1)
+            if parent >= 0:
+                previous = last_child.get(parent, -1)
+                if previous < 0:
+                    self.first_child[parent] = node_id
+                else:
+                    self.next_sibling[previous] = node_id
+                last_child[parent] = node_id
+
+            node_type, node_name, node_value, attributes = label
+            self.text_start.append(self.text_length)
+            if node_type == Node.TEXT_NODE:
+                if self.split_text and node_value:
+                    # The piece is one token.
+                    self._add_token(
+                        node_id,
+                        self.text_length,
+                        self.text_length + len(node_value),
+                        node_value,
+                    )
+                self.text_nodes.append(node_id)
+                self.text_parts.append(node_value)
+                self.text_parts.append(u' ')
+                self.text_length += len(node_value) + 1
+                self._text_buffer = None
+                label = (node_type, node_name, None, attributes)
+            self.text_stop.append(self.text_length)
+            label_id = self.labels.get(label)
+            if label_id is None:
+                label_id = self.labels[label] = len(self.label_table)
+                self.label_table.append(label)
+                self.label_digests.append(_label_digest(label))
+            self.label_ids.append(label_id)
+
+            if node is not None:
+                stack.extend(reversed(self._child_entries(node, node_id)))
+        if self.split_text:
+            self.tokenized = len(self.text_nodes)
+
+        # Fill in the subtree values bottom-up. Children always have higher
+        # ids than their parent.
+        new_ids = range(root, len(self.label_ids))
+        self.digests.extend(bytearray(digest_size * len(new_ids)))
+        self.significant.extend([0] * len(new_ids))
+        for node_id in reversed(new_ids):
+            text = self.text_value(node_id)
+            if text is not None:
+                # Text nodes are not interned by value, so they get their
+                # own digest.
+                label = self.label(node_id)
+                self._set_digest(node_id, hashlib.sha1(
+                    _label_digest(label)
+                ).digest())
+                self.significant[node_id] = not self.is_junk_text(text)
+                continue
+            digest = hashlib.sha1(self.label_digests[self.label_ids[node_id]])
+            significant = False
+            child = self.first_child[node_id]
+            while child >= 0:
+                digest.update(self.digest(child))
+                significant = significant or self.significant[child]
+                self.text_stop[node_id] = self.text_stop[child]
+                child = self.next_sibling[child]
+            self._set_digest(node_id, digest.digest())
+            self.significant[node_id] = significant
+        return root
+
+    def _child_entries(self, node, node_id):
+        # The children of a node to add, with their parent and label. With
+        # split_text, each piece of a text node stands in for it, with no
+        # node of its own.
+        entries = []
+        for child in self.get_children(node):
+            label = self.get_label(child)
+            node_type, node_name, node_value, attributes = label
+            if not self.split_text or node_type != Node.TEXT_NODE:
+                entries.append((child, node_id, label))
+                continue
+            pieces = [
+                node_value[start:stop]
+                for start, stop in token_spans(node_value)
+            ] or [node_value]
+            for piece in pieces:
+                entries.append((
+                    None,
+                    node_id,
+                    (node_type, node_name, piece, attributes),
+                ))
+        return entries
+
+    @property
+    def text_buffer(self):
+        if self._text_buffer is None:
+            self._text_buffer = u''.join(self.text_parts)
+            self.text_parts = [self._text_buffer]
+        return self._text_buffer
+
+    def children(self, node):
+        """Return the list of child ids of a node."""
+        children = []
+        child = self.first_child[node]
+        while child >= 0:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def label(self, node):
+        label = self.label_table[self.label_ids[node]]
+        if label[0] == Node.TEXT_NODE:
+            node_type, node_name, node_value, attributes = label
+            return (node_type, node_name, self.text_value(node), attributes)
+        return label
+
+    def text_value(self, node):
+        """Return the node's text if it is a text node, otherwise None."""
+        if self.label_table[self.label_ids[node]][0] != Node.TEXT_NODE:
+            return None
+        # Leave out the separator.
+        return self.text_buffer[self.text_start[node]:self.text_stop[node] - 1]
+
+    def digest(self, node):
+        start = node * digest_size
+        return bytes(self.digests[start:start + digest_size])
+
+    def _set_digest(self, node, digest):
+        start = node * digest_size
+        self.digests[start:start + digest_size] = digest
+
+    def has_significant_text(self, node):
+        """Whether any text node in the subtree is not junk."""
+        return bool(self.significant[node])
+
+    def is_junk_text(self, text):
+        junk = self.junk_text.get(text)
+        if junk is None:
+            junk = self.junk_text[text] = is_text_junk(text)
+        return junk
+
+    def tokenize(self):
+        """
+        Split the text of all the text nodes added so far into tokens, in
+        one pass over the text buffer.
+
+        >>> index = NodeIndex(parse_minidom('<p>one two</p><p>three</p>'))
+        >>> index.tokenize()
+        >>> index.token_start, index.token_stop
+        (array('i', [0, 3, 4, 8]), array('i', [3, 4, 7, 13]))
+        >>> [index.vocabulary.words[w] if w >= 0 else None
+        ...  for w in index.token_words]
+        [u'one', None, u'two', u'three']
+        """
+        buffer = self.text_buffer
+        for node in self.text_nodes[self.tokenized:]:
+            # Leave out the separator.
+            stop = self.text_stop[node] - 1
+            for token_start, token_stop in token_spans(
+                buffer,
+                self.text_start[node],
+                stop,
+            ):
+                self._add_token(
+                    node,
+                    token_start,
+                    token_stop,
+                    buffer[token_start:token_stop],
+                )
+        self.tokenized = len(self.text_nodes)
+
+    def _add_token(self, node, start, stop, token):
+        word_id = self.token_word_ids.get(token)
+        if word_id is None:
+            word = token.strip()
+            word_id = self.token_word_ids[token] = (
+                self.vocabulary.intern([word])[0] if word else -1
+            )
+        self.token_nodes.append(node)
+        self.token_start.append(start)
+        self.token_stop.append(stop)
+        self.token_words.append(word_id)
+
+    def tokens(self, node):
+        """
+        Return the range of tokens in the node's text, as indexes into the
+        token arrays.
+        """
+        if self.tokenized < len(self.text_nodes):
+            self.tokenize()
+        return (
+            bisect_left(self.token_start, self.text_start[node]),
+            bisect_left(self.token_start, self.text_stop[node]),
+        )
+
+    def words(self, node):
+        """
+        Return the significant words below the node, as an array of ids in
+        self.vocabulary, and their length_sums.
+
+        Word profiles are computed on first use and kept for the lifetime of
+        the index, and they are read off the token arrays, so no text is
+        tokenized more than once.
+        """
+        profile = self.word_profiles.get(node)
+        if profile is None:
+            start, stop = self.tokens(node)
+            ids = array('i', [
+                word_id for word_id in self.token_words[start:stop]
+                if word_id >= 0
+            ])
+            profile = self.word_profiles[node] = (
+                ids,
+                self.vocabulary.length_sums(ids),
+            )
+        return profile
+
+    def counts(self, node):
+        """
+        Return how many times each non-junk word occurs below the node, as a
+        dict from word ids to counts.
+        """
+        counts = self.word_counts.get(node)
+        if counts is None:
+            counts = self.word_counts[node] = {}
+            junk = self.vocabulary.junk
+            for word_id in self.words(node)[0]:
+                if not junk[word_id]:
+                    counts[word_id] = counts.get(word_id, 0) + 1
+        return counts
+
+    # Word ids are spread over this many buckets in a signature.
+    signature_buckets = 64
+
+    def signature(self, node):
+        """
+        Return a small signature of the non-junk words below the node: a
+        bitset of the buckets that its word ids fall in, and the total length
+        of the words in each bucket.
+        """
+        signature = self.signatures.get(node)
+        if signature is None:
+            lengths = self.vocabulary.lengths
+            buckets = self.signature_buckets
+            bits = 0
+            weights = [0] * buckets
+            for word_id, count in self.counts(node).iteritems():
+                bucket = word_id % buckets
+                bits |= 1 << bucket
+                weights[bucket] += lengths[word_id] * count
+            signature = self.signatures[node] = (bits, weights)
+        return signature
+
+    def sketch(self, node, samples=256, shingle=1):
+        """
+        Return the shingle_sketch of the non-junk words below the node,
+        weighted by length.
+        """
+        key = (node, samples, shingle)
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            lengths = self.vocabulary.lengths
+            junk = self.vocabulary.junk
+            sketch = self.sketches[key] = shingle_sketch(
+                self.words(node)[0],
+                lambda word: 0 if junk[word] else lengths[word],
+                samples,
+                shingle,
+            )
+        return sketch
 
 
 class HashableTree(object):
-    def __init__(self, node):
+    """
+    Compare whole subtrees, using the digests from a NodeIndex.
+
+    The node is given by its id in the index. If no index is given, the node
+    is a dom node, and an index is built for its subtree.
+    """
+    def __init__(self, node, index=None):
+        if index is None:
+            index = NodeIndex()
+            node = index.add(node)
         self.node = node
+        self.digest = index.digest(node)
 
     def __eq__(self, other):
         if not hasattr(other, 'node'):
             return False
 
-        return (HashableNode(self.node) == HashableNode(other.node) and
-                [HashableTree(c) for c in self.node.childNodes] ==
-                [HashableTree(c) for c in other.node.childNodes])
+        return self.digest == other.digest
 
     def __hash__(self):
-        child_hashes = hash(tuple(
-            HashableTree(c) for c in self.node.childNodes
-        ))
-        return hash((HashableNode(self.node), child_hashes))
+        return hash(self.digest)
 
 
 class FuzzyHashableTree(object):
+    """
+    Compare subtrees by the similarity of their text.
+
+    The node is given by its id in the index. If no index is given, the node
+    is a dom node. A SimilarityMemo can be given, to share the results of
+    comparing two nodes between all the trees compared in one diff.
+    """
     cutoff = 0.4
 
-    def __init__(self, node):
+    def __init__(self, node, index=None, memo=None):
         self.node = node
+        self.index = index
+        if index is None:
+            self.label = node_label(node)
+        else:
+            self.label = index.label(node)
+        self.memo = memo
 
     def __eq__(self, other):
         if not hasattr(other, 'node'):
             return False
 
-        if HashableNode(self.node) != HashableNode(other.node):
+        if self.label != other.label:
             return False
 
         # Check for a fuzzy match.
-        if check_text_similarity(self.node, other.node, cutoff=self.cutoff):
+        if self.memo is not None:
+            return self.memo.similar(self.node, other.node, self.cutoff)
+        if check_text_similarity(
+            self.node,
+            other.node,
+            cutoff=self.cutoff,
+            index=self.index,
+        ):
             return True
 
         return False
@@ -257,7 +745,241 @@ class FuzzyHashableTree(object):
     def __hash__(self):
         # This will never be equal if the top level tag in the tree is
         # different. Beyond that, we can't make any guarantees.
-        return hash(HashableNode(self.node))
+        return hash(self.label)
+
+
+class SimilarityCascade(object):
+    """
+    Decide whether the text of two nodes in a NodeIndex is similar, trying
+    upper bounds on the ratio of matching text first, from the cheapest and
+    loosest to the most expensive and exact:
+
+    - length: the matching text is no longer than the shorter text.
+    - bitset: in each signature bucket that both nodes have words in, the
+      matching text is no longer than the smaller bucket total.
+    - multiset: the matching text of each word is its length times the
+      smaller of its two counts, at most.
+    - exact: text_similarity, with the given WordMatcher backend, or
+      approximate_text_similarity for pairs too large to compare word by
+      word.
+
+    Each stage only passes on the pairs that it can't reject. Pairs that are
+    already known to pass the bounds, because dissimilar_pairs has checked
+    them, go straight to the exact stage. The number of pairs rejected by
+    each stage is counted in self.rejected, and the number of similar pairs
+    in self.accepted.
+
+    >>> index = NodeIndex()
+    >>> a = index.add(parse_minidom('<p>one two three</p>'))
+    >>> b = index.add(parse_minidom('<p>one two four</p>'))
+    >>> c = index.add(parse_minidom('<p>a long paragraph of text</p>'))
+    >>> cascade = SimilarityCascade(index)
+    >>> cascade.similar(a, b, 0.4), cascade.similar(a, c, 0.4)
+    ((True, 0.5714285714285714), (False, None))
+    >>> cascade.rejected['bitset'], cascade.accepted
+    (1, 1)
+    """
+    stages = ['length', 'bitset', 'multiset', 'exact']
+
+    def __init__(self, index, backend='difflib'):
+        self.index = index
+        self.backend = backend
+        self.rejected = dict((stage, 0) for stage in self.stages)
+        self.accepted = 0
+
+    def similar(self, a, b, cutoff, bounded=False):
+        """
+        Return whether the text of a and b is at least cutoff similar, and
+        the ratio, or None if a bound ruled the pair out.
+        """
+        ratio, exact = self.ratio(a, b, cutoff, bounded)
+        return ratio >= cutoff, (ratio if exact else None)
+
+    def ratio(self, a, b, cutoff, bounded=False, approximate=False):
+        """
+        Return the ratio of a and b, or a bound on it that is below the
+        cutoff, and whether it is the exact ratio. With bounded, the pair is
+        known to pass the bounds at this cutoff, and they are skipped. With
+        approximate, the last stage estimates the ratio from sketches, and
+        the estimate is returned as the exact ratio.
+        """
+        index = self.index
+        a_total = index.words(a)[1][-1]
+        b_total = index.words(b)[1][-1]
+        total = a_total + b_total
+        stages = self.stages[-1:] if bounded else self.stages
+        for stage in stages:
+            if stage == 'length':
+                ratio = _calculate_ratio(min(a_total, b_total), total)
+            elif stage == 'bitset':
+                ratio = _calculate_ratio(self._bitset_bound(a, b), total)
+            elif stage == 'multiset':
+                ratio = _calculate_ratio(
+                    multiset_overlap(
+                        index.counts(a),
+                        index.counts(b),
+                        index.vocabulary.lengths,
+                    ),
+                    total,
+                )
+            elif approximate:
+                ratio = approximate_text_similarity(a, b, index)
+            else:
+                ratio = text_similarity(a, b, index, self.backend)
+            if ratio < cutoff:
+                self.rejected[stage] += 1
+                return ratio, stage == 'exact'
+        self.accepted += 1
+        return ratio, True
+
+    def _bitset_bound(self, a, b):
+        a_bits, a_weights = self.index.signature(a)
+        b_bits, b_weights = self.index.signature(b)
+        common = a_bits & b_bits
+        bound = 0
+        while common:
+            low = common & -common
+            bucket = low.bit_length() - 1
+            bound += min(a_weights[bucket], b_weights[bucket])
+            common ^= low
+        return bound
+
+
+def multiset_overlap(a_counts, b_counts, lengths):
+    """
+    Return an upper bound on the length of the matching text of two word
+    multisets, given as dicts from word ids to counts: the sum over each word
+    of its length times the smaller of its two counts.
+
+    >>> multiset_overlap({0: 2, 1: 1}, {0: 1, 2: 3}, [3, 5, 4])
+    3
+    """
+    if len(a_counts) > len(b_counts):
+        a_counts, b_counts = b_counts, a_counts
+    overlap = 0
+    for word, count in a_counts.iteritems():
+        other = b_counts.get(word)
+        if other is not None:
+            overlap += lengths[word] * min(count, other)
+    return overlap
+
+
+class SimilarityMemo(object):
+    """
+    Remember how similar pairs of nodes in a NodeIndex are, so that each pair
+    is only compared once per diff.
+
+    The ratio isn't symmetric, so results are kept for (a, b) in the order
+    they were compared, by self.cascade. A result is the ratio, or the bound
+    that ruled the pair out, and it is checked against the cutoff of each
+    call. A bound only rules a pair out up to the cutoff it was found at, so
+    a lower cutoff compares the pair again.
+
+    Whole groups of nodes can be bounded up front, with bound(). The pairs
+    that dissimilar_pairs rules out are then counted as ruled_out, not as
+    hits, and the pairs that it lets through skip the bounds of the cascade,
+    so that no pair is bounded twice.
+
+    Comparisons are spent from the budget, if one is given, and once it falls
+    back to replacing blocks, pairs that haven't been compared yet count as
+    not similar. A
+    comparison of more pairs of words than the budget has time left for is
+    estimated with approximate_text_similarity instead. Text is compared with
+    the given WordMatcher backend.
+
+    >>> index = NodeIndex()
+    >>> a = index.add(parse_minidom('<p>one two three</p>'))
+    >>> b = index.add(parse_minidom('<p>one two four</p>'))
+    >>> memo = SimilarityMemo(index)
+    >>> memo.similar(a, b, 0.4), memo.similar(a, b, 0.6)
+    (True, False)
+    >>> memo.results[(a, b)]
+    (0.5714285714285714, True)
+    >>> memo.hits, memo.misses
+    (1, 1)
+    """
+    def __init__(self, index, budget=None, backend='difflib'):
+        self.index = index
+        self.budget = budget
+        self.cascade = SimilarityCascade(index, backend)
+        self.results = {}  # (a, b) -> (ratio or bound, exact)
+        self.dissimilar = {}  # (a, b) -> cutoff
+        self.groups = {}  # node -> (group number, cutoff)
+        self.group_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.ruled_out = 0
+
+    def rule_out(self, pairs, cutoff):
+        """Rule out pairs whose ratio is known to be below the cutoff."""
+        for pair in pairs:
+            self.dissimilar[pair] = cutoff
+
+    def bound(self, a_nodes, b_nodes, cutoff):
+        """
+        Bound the pairs of nodes from a_nodes and b_nodes all at once, with
+        dissimilar_pairs. Every node is in at most one group at a time.
+
+        Return how many pairs of words the pairs that aren't ruled out have
+        between them, which is how much comparing them could cost.
+        """
+        dissimilar = dissimilar_pairs(a_nodes, b_nodes, cutoff, self.index)
+        self.rule_out(dissimilar, cutoff)
+        group = (self.group_count, cutoff)
+        self.group_count += 1
+        for node in a_nodes + b_nodes:
+            self.groups[node] = group
+        word_pairs = (
+            sum(self.word_count(a) for a in a_nodes) *
+            sum(self.word_count(b) for b in b_nodes)
+        )
+        for a, b in dissimilar:
+            word_pairs -= self.word_count(a) * self.word_count(b)
+        return word_pairs
+
+    def word_count(self, node):
+        return len(self.index.words(node)[0])
+
+    def similar(self, a, b, cutoff):
+        dissimilar = self.dissimilar
+        if dissimilar:
+            limit = dissimilar.get((a, b), dissimilar.get((b, a)))
+            if limit is not None and cutoff >= limit:
+                self.ruled_out += 1
+                return False
+        result = self.results.get((a, b))
+        if result is not None and (result[1] or result[0] < cutoff):
+            self.hits += 1
+            return result[0] >= cutoff
+        approximate = False
+        if self.budget is not None:
+            if self.budget.strategy == 'replace':
+                return False
+            approximate = not self.budget.affords(
+                word_pairs=self.word_count(a) * self.word_count(b),
+            )
+            self.budget.spend(comparisons=1)
+        self.misses += 1
+        group = self.groups.get(a)
+        bounded = (
+            group is not None and
+            group == self.groups.get(b) and
+            cutoff <= group[1]
+        )
+        ratio, exact = self.results[(a, b)] = self.cascade.ratio(
+            a,
+            b,
+            cutoff,
+            bounded,
+            approximate,
+        )
+        return ratio >= cutoff
+
+    def clear(self):
+        """Drop the results, keeping the counts."""
+        self.results = {}
+        self.dissimilar = {}
+        self.groups = {}
 
 
 def attribute_dict(node):
@@ -344,13 +1066,6 @@ def get_location(dom, location):
     return node
 
 
-def ancestors(node):
-    ancestor = node
-    while ancestor:
-        yield ancestor
-        ancestor = ancestor.parentNode
-
-
 def _print_helper(node):
     tag_name = 'Text'
     if hasattr(node, 'tagName'):
@@ -382,65 +1097,264 @@ def walk_dom(dom, elements_only=False):
         dom = dom.documentElement
 
     def walk(node):
-        if not node:
-            return
-        if elements_only and not is_element(node):
-            return
-        yield node
-        for child in node.childNodes:
-            for descendant in walk(child):
-                yield descendant
+        # Walk with an explicit stack rather than nested generators, so that
+        # deep trees cost nothing extra per node, and can't hit the recursion
+        # limit.
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not node:
+                continue
+            if elements_only and not is_element(node):
+                continue
+            yield node
+            stack.extend(reversed(node.childNodes))
     return walk(dom)
 
 
-def check_text_similarity(a_dom, b_dom, cutoff):
-    """Check whether two dom trees have similar text or not."""
-    a_words = list(tree_words(a_dom))
-    b_words = list(tree_words(b_dom))
+def elements_by_tag_name(dom, tag):
+    """
+    Like getElementsByTagName on a document, without recursion.
 
-    sm = WordMatcher(a=a_words, b=b_words)
-    if sm.text_ratio() >= cutoff:
-        return True
-    return False
+    >>> dom = parse_minidom('<p>one <b>two</b></p><p>three</p>')
+    >>> [minidom_tostring(p) for p in elements_by_tag_name(dom, 'p')]
+    ['<p>one <b>two</b></p>', '<p>three</p>']
+    """
+    return [
+        node for node in walk_dom(dom, elements_only=True)
+        if node.tagName == tag
+    ]
+
+
+def normalize_dom(dom):
+    """
+    Like minidom's normalize, merge adjacent text nodes and remove empty ones,
+    without recursion.
+
+    >>> dom = parse_minidom('<p>one <b></b></p>')
+    >>> p = dom.documentElement.firstChild
+    >>> _ = p.insertBefore(dom.createTextNode('two'), p.lastChild)
+    >>> _ = p.appendChild(dom.createTextNode(''))
+    >>> len(p.childNodes)
+    4
+    >>> normalize_dom(dom)
+    >>> len(p.childNodes), minidom_tostring(p)
+    (2, '<p>one two<b></b></p>')
+    """
+    for node in list(walk_dom(dom, elements_only=True)):
+        children = []
+        texts = []
+        for child in node.childNodes + [None]:
+            if child is not None and is_text(child):
+                texts.append(child)
+                continue
+            if texts:
+                data = ''.join(text.data for text in texts)
+                if data:
+                    texts[0].data = data
+                    children.append(texts.pop(0))
+                for text in texts:
+                    text.unlink()
+                texts = []
+            if child is not None:
+                children.append(child)
+        previous = None
+        for child in children:
+            child.previousSibling = previous
+            child.nextSibling = None
+            if previous is not None:
+                previous.nextSibling = child
+            previous = child
+        node.childNodes[:] = children
+
+
+def check_text_similarity(a_dom, b_dom, cutoff, index=None, cascade=None,
+                          approximate=None, backend='difflib'):
+    """Check whether two dom trees have similar text or not.
+
+    Pass a NodeIndex to reuse word profiles between calls; the trees are then
+    given by their node ids in the index. Pass a SimilarityCascade over the
+    index to count the pairs that each of its stages rejects. Otherwise, the
+    text is compared with the given WordMatcher backend.
+
+    Pass a number of samples as approximate to check the estimate of
+    approximate_text_similarity instead, for documents too large to compare
+    word by word.
+    """
+    if index is None:
+        index = NodeIndex()
+        a_dom = index.add(a_dom)
+        b_dom = index.add(b_dom)
+    if approximate:
+        ratio = approximate_text_similarity(a_dom, b_dom, index, approximate)
+        return ratio >= cutoff
+    if cascade is None:
+        cascade = SimilarityCascade(index, backend)
+    similar, ratio = cascade.similar(a_dom, b_dom, cutoff)
+    return similar
+
+
+def text_similarity(a, b, index, backend='difflib'):
+    """
+    Return the text_ratio of the words below two nodes in an index, with the
+    given WordMatcher backend.
+    """
+    a_words, a_sums = index.words(a)
+    b_words, b_sums = index.words(b)
+    sm = WordMatcher(
+        a=a_words,
+        b=b_words,
+        a_sums=a_sums,
+        b_sums=b_sums,
+        vocabulary=index.vocabulary,
+        backend=backend,
+    )
+    return sm.text_ratio()
+
+
+def approximate_text_similarity(a, b, index, samples=256, shingle=1):
+    """
+    Estimate the similarity of the words below two nodes in an index from
+    their sketches, in time linear in the number of words.
+
+    With single word shingles, this estimates the ratio of the text that
+    could match if the words were in any order: each word's length times the
+    smaller of its two counts, as in the multiset bound of SimilarityCascade.
+    That is at least the text_similarity, and equal to it when no words have
+    moved. Longer shingles take word order into account, but each changed
+    word then counts against up to `shingle` of them, so scattered edits give
+    a lower estimate than text_similarity.
+
+    The ratio is 2 * J / (1 + J) for the weighted Jaccard similarity J that
+    sketch_similarity estimates, so its standard error is at most
+    2 / (1 + J) ** 2 times that of J. Near a ratio of 0.5 that is about
+    0.033 for the default 256 samples, and it halves with every fourfold
+    increase in samples.
+
+    >>> index = NodeIndex()
+    >>> a = index.add(parse_minidom('<p>one two three</p>'))
+    >>> b = index.add(parse_minidom('<p>three two one</p>'))
+    >>> approximate_text_similarity(a, b, index)
+    1.0
+    >>> approximate_text_similarity(a, b, index, shingle=2) < 1.0
+    True
+    """
+    jaccard = sketch_similarity(
+        index.sketch(a, samples, shingle),
+        index.sketch(b, samples, shingle),
+    )
+    return 2 * jaccard / (1 + jaccard)
+
+
+def dissimilar_pairs(a_nodes, b_nodes, cutoff, index):
+    """
+    Return the pairs (a, b) of nodes from the two lists whose text is
+    certainly less similar than the cutoff, by the measure in
+    check_text_similarity.
+
+    This is the multiset_overlap bound of SimilarityCascade, for all the
+    pairs together, with numpy if it is installed. Pairs that can't reach the
+    cutoff even then are ruled out without comparing their word sequences.
+
+    >>> index = NodeIndex()
+    >>> a = index.add(parse_minidom('<p>one two three</p>'))
+    >>> b = index.add(parse_minidom('<p>three two one</p>'))
+    >>> c = index.add(parse_minidom('<p>four five six</p>'))
+    >>> names = {a: 'a', b: 'b', c: 'c'}
+    >>> pairs = dissimilar_pairs([a, c], [b, c], 0.4, index)
+    >>> sorted((names[x], names[y]) for x, y in pairs)
+    [('a', 'c'), ('c', 'b')]
+    """
+    if not a_nodes or not b_nodes:
+        return set()
+    if numpy is not None:
+        return _dissimilar_numpy(a_nodes, b_nodes, cutoff, index)
+    return _dissimilar_python(a_nodes, b_nodes, cutoff, index)
+
+
+def _dissimilar_python(a_nodes, b_nodes, cutoff, index):
+    lengths = index.vocabulary.lengths
+    a_counts = [index.counts(a) for a in a_nodes]
+    a_totals = [index.words(a)[1][-1] for a in a_nodes]
+    dissimilar = set()
+    for b in b_nodes:
+        b_counts = index.counts(b)
+        b_total = index.words(b)[1][-1]
+        for a, counts, total in zip(a_nodes, a_counts, a_totals):
+            overlap = multiset_overlap(counts, b_counts, lengths)
+            if _calculate_ratio(overlap, total + b_total) < cutoff:
+                dissimilar.add((a, b))
+    return dissimilar
+
+
+def _dissimilar_numpy(a_nodes, b_nodes, cutoff, index):
+    # One row of word counts per node in a_nodes, over all the words in
+    # both lists.
+    vocabulary = {}
+    for node in a_nodes + b_nodes:
+        for word in index.counts(node):
+            vocabulary.setdefault(word, len(vocabulary))
+    lengths = index.vocabulary.lengths
+    weights = numpy.zeros(len(vocabulary), dtype=numpy.int64)
+    for word, column in vocabulary.iteritems():
+        weights[column] = lengths[word]
+    counts = numpy.zeros((len(a_nodes), len(vocabulary)), dtype=numpy.int64)
+    for row, node in enumerate(a_nodes):
+        for word, count in index.counts(node).iteritems():
+            counts[row, vocabulary[word]] = count
+
+    overlaps = numpy.zeros((len(a_nodes), len(b_nodes)), dtype=numpy.int64)
+    for column, node in enumerate(b_nodes):
+        b_counts = index.counts(node)
+        if not b_counts:
+            continue
+        words = numpy.array(
+            [vocabulary[word] for word in b_counts],
+            dtype=numpy.intp,
+        )
+        values = numpy.array(b_counts.values(), dtype=numpy.int64)
+        overlaps[:, column] = numpy.minimum(counts[:, words], values).dot(
+            weights[words])
+
+    a_totals = numpy.array([index.words(a)[1][-1] for a in a_nodes])
+    b_totals = numpy.array([index.words(b)[1][-1] for b in b_nodes])
+    lengths = a_totals[:, numpy.newaxis] + b_totals[numpy.newaxis, :]
+    # Same as difflib's _calculate_ratio, including 1.0 for no text.
+    ratios = numpy.ones(lengths.shape)
+    nonempty = lengths > 0
+    ratios[nonempty] = 2.0 * overlaps[nonempty] / lengths[nonempty]
+    rows, columns = numpy.nonzero(ratios < cutoff)
+    return set(
+        (a_nodes[row], b_nodes[column])
+        for row, column in zip(rows.tolist(), columns.tolist())
+    )
 
 
 def tree_words(node):
     """Return all the significant text below the given node as a list of words.
     >>> list(tree_words(parse_minidom(
     ...     '<h1>one</h1> two <div>three<em>four</em></div>')))
-    ['one', 'two', 'three', 'four']
+    [u'one', u'two', u'three', u'four']
     >>> list(tree_words(parse_minidom(
     ...     '<ol><li>AAA</li>BBB<li>CCC</li></ol>')))
-    ['AAA', 'BBB', 'CCC']
+    [u'AAA', u'BBB', u'CCC']
     """
-    for word in split_text(tree_text(node)):
-        word = word.strip()
-        if word:
-            yield word
-
-
-def tree_text(node):
-    """
-    >>> tree_text(parse_minidom(
-    ...     '<h1>one</h1>two<div>three<em>four</em></div>'))
-    'one two three four'
-    >>> tree_text(parse_minidom(
-    ...     '<ol><li>AAA</li>BBB<li>CCC</li></ol>'))
-    'AAA BBB CCC'
-    """
-    text = []
-    for descendant in walk_dom(node):
-        if is_text(descendant):
-            text.append(descendant.nodeValue)
-    return ' '.join(text)
+    index = NodeIndex()
+    words = index.vocabulary.words
+    return [words[word_id] for word_id in index.words(index.add(node))[0]]
 
 
 # manipulation #
-def copy_dom(dom):
-    new_dom = minidom.Document()
-    doc = new_dom.importNode(dom.documentElement, deep=True)
-    new_dom.documentElement = doc
-    return new_dom
+def split_node(node):
+    """Split a text node into one text node per word, in place."""
+    pieces = split_text(node.nodeValue)
+    if len(pieces) <= 1:
+        return
+    parent = node.parentNode
+    for piece in pieces:
+        piece_node = node.ownerDocument.createTextNode(piece)
+        parent.insertBefore(piece_node, node)
+    remove_node(node)
 
 
 def remove_node(node):
@@ -508,3 +1422,162 @@ def node_compare(a, b):
     except AttributeError:
         pass
     return 0
+
+
+# trees #
+class Tree(object):
+    """
+    The editing operations that the markup code in changes and html uses, so
+    that the same code marks up a minidom document, through DomTree, and an
+    lxml tree, through lxml_engine.Overlay.
+
+    Subclasses give the root, and these methods: parent, child_nodes,
+    first_child, next_sibling, previous_sibling, tag_name, text, attributes,
+    set_attribute, create_element, create_text, insert_before, remove,
+    normalize and elements_by_tag_name. The rest are made of those.
+    """
+    def is_element(self, node):
+        return self.tag_name(node) is not None
+
+    def append_child(self, parent, node):
+        self.insert_before(parent, node, None)
+
+    def create_node(
+        self,
+        node_type=None,
+        node_name=None,
+        node_value=None,
+        attributes=None,
+    ):
+        """
+        Create a node from the node properties of an edit script entry.
+        Return None for node types that don't get inserted.
+        """
+        node = None
+        if node_type == Node.ELEMENT_NODE:
+            node = self.create_element(node_name)
+            if attributes:
+                for key, value in attributes.items():
+                    self.set_attribute(node, key, value)
+        elif node_type == Node.TEXT_NODE:
+            node = self.create_text(node_value)
+        return node
+
+    def split_text(self, node, pieces):
+        """
+        Replace a text node with one text node per piece of its text, and
+        return the new nodes.
+        """
+        parent = self.parent(node)
+        nodes = [self.create_text(piece) for piece in pieces]
+        for piece_node in nodes:
+            self.insert_before(parent, piece_node, node)
+        self.remove(node)
+        return nodes
+
+    def wrap(self, node, tag):
+        """Wrap the given tag around a node."""
+        return self.wrap_nodes([node], tag)
+
+    def wrap_nodes(self, nodes, tag):
+        """Just like wrap, but for more than one tag at a time"""
+        wrap_node = self.create_element(tag)
+        parent = self.parent(nodes[0])
+        if parent is not None:
+            self.insert_before(parent, wrap_node, nodes[0])
+        for node in nodes:
+            self.append_child(wrap_node, node)
+        return wrap_node
+
+    def wrap_inner(self, node, tag):
+        """Wrap the given tag around the contents of a node."""
+        children = list(self.child_nodes(node))
+        wrap_node = self.create_element(tag)
+        for c in children:
+            self.append_child(wrap_node, c)
+        self.append_child(node, wrap_node)
+
+    def unwrap(self, node):
+        """Remove a node, replacing it with its children."""
+        parent = self.parent(node)
+        for child in list(self.child_nodes(node)):
+            self.insert_before(parent, child, node)
+        self.remove(node)
+
+
+class DomTree(Tree):
+    """The Tree operations on a minidom document."""
+    def __init__(self, dom):
+        self.dom = dom
+        self.root = dom.documentElement
+
+    def parent(self, node):
+        if node is self.root:
+            return None
+        return node.parentNode
+
+    def child_nodes(self, node):
+        return node.childNodes
+
+    def first_child(self, node):
+        return node.firstChild
+
+    def next_sibling(self, node):
+        return node.nextSibling
+
+    def previous_sibling(self, node):
+        return node.previousSibling
+
+    def tag_name(self, node):
+        if node.nodeType == Node.ELEMENT_NODE:
+            return node.tagName
+        return None
+
+    def text(self, node):
+        if node.nodeType == Node.TEXT_NODE:
+            return node.data
+        return None
+
+    def attributes(self, node):
+        return attribute_dict(node)
+
+    def set_attribute(self, node, key, value):
+        node.setAttribute(key, value)
+
+    def create_element(self, tag):
+        return self.dom.createElement(tag)
+
+    def create_text(self, data):
+        return self.dom.createTextNode(data)
+
+    def insert_before(self, parent, node, next_sibling):
+        insert_or_append(parent, node, next_sibling)
+
+    def remove(self, node):
+        if node.parentNode is not None:
+            remove_node(node)
+
+    def wrap(self, node, tag):
+        return wrap(node, tag)
+
+    def wrap_nodes(self, nodes, tag):
+        return wrap_nodes(nodes, tag)
+
+    def wrap_inner(self, node, tag):
+        wrap_inner(node, tag)
+
+    def unwrap(self, node):
+        unwrap(node)
+
+    def normalize(self):
+        normalize_dom(self.dom)
+
+    def elements_by_tag_name(self, tag):
+        return elements_by_tag_name(self.dom, tag)
+
+
+def as_tree(dom):
+    """Return a DomTree for a minidom document, or the Tree it is given."""
+    if isinstance(dom, Tree):
+        return dom
+    return DomTree(dom)